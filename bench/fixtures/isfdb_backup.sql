@@ -0,0 +1,34 @@
+DROP TABLE IF EXISTS `authors`;
+CREATE TABLE `authors` (
+  `author_id` int(11) NOT NULL auto_increment,
+  `author_canonical` mediumtext,
+  `author_legalname` mediumtext,
+  PRIMARY KEY  (`author_id`)
+) ENGINE=MyISAM;
+INSERT INTO `authors` VALUES (1,'Stephen King','King, Stephen Edwin'),(2,'Peter Straub',NULL),(3,'O\'Brien, it''s (odd)','x');
+CREATE TABLE `pub_authors` (
+  `pa_id` int(11) NOT NULL auto_increment,
+  `author_id` int(11) default NULL,
+  `pub_id` int(11) default NULL,
+  PRIMARY KEY  (`pa_id`)
+);
+INSERT INTO `pub_authors` VALUES (1,1,4638),(2,2,4638),(3,3,5);
+CREATE TABLE `pubs` (
+  `pub_id` int(11) NOT NULL auto_increment,
+  `pub_title` mediumtext,
+  `pub_tag` varchar(64),
+  `pub_year` date default NULL,
+  `publisher_id` int(11) default NULL,
+  `pub_pages` varchar(64),
+  `pub_ptype` varchar(255),
+  `pub_ctype` enum('ANTHOLOGY','NOVEL'),
+  `pub_isbn` varchar(32),
+  `pub_frontimage` varchar(255),
+  PRIMARY KEY  (`pub_id`)
+);
+INSERT INTO `pubs` VALUES (4638,'Black House','BLCKHSTXXX','2001-09-15',7,'625','hc','NOVEL','0375504397','http://x/y.jpg|http://credit'),(5,'Odd (Book)','T','0000-00-00',NULL,NULL,'pb','ANTHOLOGY',NULL,NULL);
+CREATE TABLE `publishers` (
+  `publisher_id` int(11) NOT NULL,
+  `publisher_name` mediumtext
+);
+INSERT INTO `publishers` VALUES (7,'Random House');
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Offline benchmarks for the ISFDB plugin. The parsing benchmarks use the
+pages in fixtures/, the end-to-end ones run against the stand-in server in
+server.py, so nothing touches isfdb.org. Install the plugin, then:
+
+	calibre-customize -b isfdb-plugin
+	calibre-debug -e bench/run.py -- --books 200 --concurrency 8 --latency 50
+
+Numbers are in milliseconds. Use --json to keep a machine readable copy.
+'''
+
+import os, sys, time, json, shutil, tempfile, argparse
+from Queue import Queue, Empty
+from threading import Thread, Event, RLock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from server import start_server, add_server_options, server_options, load_fixture
+
+def summarize(samples):
+	'''
+	Latency percentiles, in ms, of a list of durations in seconds.
+	'''
+	if not samples:
+		return {'count': 0}
+	s = sorted(samples)
+	pick = lambda p: s[min(len(s) - 1, int(round(p * (len(s) - 1))))] * 1000
+	return {'count': len(s), 'mean': sum(s) / len(s) * 1000, 'min': s[0] * 1000,
+		'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': s[-1] * 1000}
+
+def repeat(func, n):
+	samples = []
+	for i in range(n):
+		start = time.time()
+		func()
+		samples.append(time.time() - start)
+	return summarize(samples)
+
+def make_isbn(n):
+	'''
+	The n-th of a run of ISBN-13s with valid check digits.
+	'''
+	body = '978%09d' % n
+	check = (10 - sum((3 if i % 2 else 1) * int(d) for i, d in enumerate(body)) % 10) % 10
+	return body + unicode(check)
+
+def parse_page(name):
+	from calibre_plugins.isfdb.parse import page_to_tree
+	return page_to_tree(load_fixture(name).strip())
+
+def bench_parsing(plugin, log, n):
+	from calibre_plugins.isfdb.worker import Worker
+	from calibre_plugins.isfdb.parse import SearchResults
+	results = {}
+	results['create_query'] = repeat(lambda: plugin.create_query(log, title='Black House',
+		authors=['Stephen King', 'Peter Straub']), n)
+
+	results['search_page_to_tree'] = repeat(lambda: parse_page('adv_search_results.html'), n)
+	page = load_fixture('adv_search_results.html')
+	title_tokens = list(plugin.get_title_tokens('Black House'))
+	author_tokens = list(plugin.get_author_tokens(['Stephen King', 'Peter Straub']))
+	def search_results(max_results):
+		# Fed the way a download arrives, stopping once enough rows match
+		sr = SearchResults(title_tokens, author_tokens, max_results)
+		for i in range(0, len(page), 4096):
+			if sr.feed(page[i:i + 4096]):
+				break
+		return sr.close()
+	results['SearchResults_all_rows'] = repeat(lambda: search_results(1000), n)
+	results['SearchResults_first_match'] = repeat(lambda: search_results(1), n)
+
+	results['details_page_to_tree'] = repeat(lambda: parse_page('pl.html'), n)
+	root = parse_page('pl.html')
+	def parse_details():
+		record = Worker(plugin.BASE_URL + '/cgi-bin/pl.cgi?4638', Queue(), log, 0, plugin).parse_details(root)
+		assert record is not None
+	results['Worker.parse_details'] = repeat(parse_details, n)
+	return results
+
+def run_concurrently(jobs, concurrency):
+	'''
+	Run the callables in jobs on concurrency threads. Returns the duration of
+	each job and the wall clock time of the whole run.
+	'''
+	pending = list(reversed(jobs))
+	samples = []
+	lock = RLock()
+	def work():
+		while True:
+			with lock:
+				if not pending:
+					return
+				job = pending.pop()
+			start = time.time()
+			job()
+			with lock:
+				samples.append(time.time() - start)
+	start = time.time()
+	threads = [Thread(target=work) for i in range(concurrency)]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return samples, time.time() - start
+
+def bench_end_to_end(plugin, log, server, opts):
+	results = {}
+	abort = Event()
+	def drain(q):
+		items = []
+		while True:
+			try:
+				items.append(q.get_nowait())
+			except Empty:
+				return items
+
+	from calibre_plugins.isfdb.stats import stats
+	def scenario(name, jobs):
+		before = server.requests
+		stats.reset()
+		samples, elapsed = run_concurrently(jobs, opts.concurrency)
+		summary = summarize(samples)
+		summary['books_per_second'] = len(jobs) / elapsed
+		summary['requests'] = server.requests - before
+		# Where the time went, per phase, as seen by the plugin
+		summary['stats'] = stats.snapshot()
+		results[name] = summary
+
+	def identify(**kwargs):
+		def job():
+			rq = Queue()
+			plugin.identify(log, rq, abort, timeout=opts.timeout, **kwargs)
+			drain(rq)
+		return job
+	def download_cover(**kwargs):
+		def job():
+			rq = Queue()
+			plugin.download_cover(log, rq, abort, timeout=opts.timeout, **kwargs)
+			drain(rq)
+		return job
+
+	authors = ['Stephen King', 'Peter Straub']
+	isbns = [make_isbn(i) for i in range(opts.books)]
+	scenario('identify_isbn', [identify(title='Black House', authors=authors, identifiers={'isbn': isbn})
+		for isbn in isbns])
+	scenario('identify_title_author', [identify(title='Black House', authors=authors)
+		for i in range(max(1, opts.books // 10))])
+	# The records cached above once they have expired, revalidated rather
+	# than downloaded again
+	import calibre_plugins.isfdb.config as cfg
+	cfg.option_overrides[cfg.KEY_CACHE_TTL] = 1e-9
+	scenario('identify_isbn_revalidate', [identify(title='Black House', authors=authors, identifiers={'isbn': isbn})
+		for isbn in isbns])
+	cfg.option_overrides[cfg.KEY_CACHE_TTL] = 0
+	# Covers for books identified above come from the cache, the rest need resolving
+	scenario('download_cover_cached', [download_cover(title='Black House', authors=authors,
+		identifiers={'isbn': isbn}) for isbn in isbns])
+	scenario('download_cover_cold', [download_cover(title='Black House', authors=authors,
+		identifiers={'isbn': make_isbn(opts.books + i)}) for i in range(opts.books)])
+	# Several editions to choose the biggest cover from
+	scenario('download_cover_editions', [download_cover(title='Black House', authors=authors)
+		for i in range(max(1, opts.books // 10))])
+	return results
+
+def print_results(title, results):
+	print('\n' + title)
+	columns = ('count', 'mean', 'p50', 'p90', 'p99', 'max')
+	print('%-28s' % '' + ''.join('%10s' % c for c in columns) + '%10s%10s' % ('books/s', 'requests'))
+	for name, r in sorted(results.items()):
+		row = '%-28s' % name + ''.join('%10.2f' % r[c] if c != 'count' else '%10d' % r[c] for c in columns)
+		if 'books_per_second' in r:
+			row += '%10.1f%10d' % (r['books_per_second'], r['requests'])
+		print(row)
+
+def print_phases(results):
+	for name, r in sorted(results.items()):
+		print('\n%s (ms)' % name)
+		for phase, t in sorted(r['stats']['timers'].items(), key=lambda x: -x[1]['total_ms']):
+			print('  %-26s%8d%12.1f%10.2f%10.1f' % (phase, t['count'], t['total_ms'], t['mean_ms'], t['max_ms']))
+		print('  ' + ', '.join('%s=%d' % item for item in sorted(r['stats']['counters'].items())))
+
+def main(args):
+	parser = argparse.ArgumentParser(prog='calibre-debug -e bench/run.py --')
+	parser.add_argument('--iterations', type=int, default=200, help='Repetitions of each parsing benchmark')
+	parser.add_argument('--books', type=int, default=100, help='Books per end-to-end scenario')
+	parser.add_argument('--concurrency', type=int, default=8, help='Simultaneous identify/download_cover calls')
+	parser.add_argument('--max-downloads', type=int, default=5, help='Override for the plugin\'s KEY_MAX_DOWNLOADS')
+	parser.add_argument('--timeout', type=int, default=30)
+	parser.add_argument('--skip-network', action='store_true', help='Only run the parsing benchmarks')
+	parser.add_argument('--json', help='Also write the results to this file')
+	parser.add_argument('--phases', action='store_true', help='Break the end-to-end scenarios down by phase')
+	parser.add_argument('--event-loop', action='store_true', help='Make downloads on the event loop')
+	parser.add_argument('--connections', type=int, default=32, help='Connections the event loop opens to the server')
+	parser.add_argument('--title-details', action='store_true', help='Also read series and tags from title records')
+	add_server_options(parser)
+	opts = parser.parse_args(args[1:] if args[:1] == ['--'] else args)
+
+	from calibre.customize.ui import find_plugin
+	from calibre.utils.logging import ThreadSafeLog
+	plugin = find_plugin('ISFDB')
+	import calibre_plugins.isfdb.config as cfg
+	from calibre_plugins.isfdb.cache import open_cache
+
+	# Leave the user's preferences and cache alone
+	tdir = tempfile.mkdtemp(prefix='isfdb-bench-')
+	open_cache(os.path.join(tdir, 'cache.sqlite'))
+	cfg.option_overrides.update({
+		cfg.KEY_MAX_DOWNLOADS: opts.max_downloads,
+		cfg.KEY_MAX_THREADS: opts.concurrency,
+		cfg.KEY_REQUESTS_PER_SECOND: 10000,
+		cfg.KEY_CACHE_TTL: 0,
+		cfg.KEY_BACKEND: cfg.BACKEND_HTML,
+		cfg.KEY_EVENT_LOOP: opts.event_loop,
+		cfg.KEY_EVENT_LOOP_CONNECTIONS: opts.connections,
+		cfg.KEY_TITLE_DETAILS: opts.title_details,
+	})
+	log = ThreadSafeLog(level=ThreadSafeLog.ERROR)
+
+	report = {'options': vars(opts)}
+	try:
+		report['parsing'] = bench_parsing(plugin, log, opts.iterations)
+		print_results('Parsing (ms per call)', report['parsing'])
+		if not opts.skip_network:
+			server = start_server(**server_options(opts))
+			plugin.set_base_url(server.base_url)
+			report['end_to_end'] = bench_end_to_end(plugin, log, server, opts)
+			print_results('End to end against %s (ms per book)' % server.base_url, report['end_to_end'])
+			if opts.phases:
+				print_phases(report['end_to_end'])
+			server.shutdown()
+	finally:
+		shutil.rmtree(tdir, ignore_errors=True)
+
+	if opts.json:
+		with open(opts.json, 'wb') as f:
+			json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+A local stand-in for the parts of isfdb.org the plugin talks to, serving the
+pages in fixtures/ with optional latency and errors. It needs nothing beyond
+the standard library, so it can also be run on its own:
+
+	python bench/server.py --port 8000 --latency 80 --error-rate 0.02
+'''
+
+import os, re, sys, time, gzip, random, struct, argparse, hashlib
+from threading import Thread
+from collections import Counter
+from cStringIO import StringIO
+from urlparse import urlsplit
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def load_fixture(name):
+	with open(os.path.join(FIXTURES, name), 'rb') as f:
+		return f.read()
+
+def isbn_to_pub_id(isbn):
+	'''
+	Every ISBN maps to a stable publication id, so runs are repeatable.
+	'''
+	return 1000 + int(hashlib.md5(isbn).hexdigest()[:8], 16) % 900000
+
+# Fixture pages never change
+LAST_MODIFIED = 'Mon, 02 Mar 2015 12:00:00 GMT'
+# Rows per page of adv_search_results.cgi
+SEARCH_PAGE_SIZE = 100
+SEARCH_ROW = re.compile(br'<tr class="table\d">.*?</tr>\n', re.DOTALL)
+
+# What the web API answers for an ISBN it does not know
+NO_RECORDS_XML = b'<?xml version="1.0" encoding="iso-8859-1" ?>\n<ISFDB>\n  <Records>0</Records>\n</ISFDB>\n'
+
+def fake_jpeg(width, height, size=24 * 1024):
+	'''
+	A JPEG header carrying the given dimensions, padded out to size bytes.
+	Enough for anything that only reads the header.
+	'''
+	app0 = b'\xff\xe0' + struct.pack(b'>H', 16) + b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+	sof0 = b'\xff\xc0' + struct.pack(b'>HBHHB', 17, 8, height, width, 3) + b'\x01\x22\x00\x02\x11\x01\x03\x11\x01'
+	data = b'\xff\xd8' + app0 + sof0
+	return data + b'\x00' * (size - len(data) - 2) + b'\xff\xd9'
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+
+	daemon_threads = True
+	allow_reuse_address = True
+	# The default backlog of 5 drops connections when many clients connect
+	# at once, which then stall for a second waiting to retry
+	request_queue_size = 128
+
+	def __init__(self, address, latency=0, jitter=0, error_rate=0, timeout_rate=0, miss_rate=0, validators=True,
+			search_rows=None):
+		HTTPServer.__init__(self, address, StandInHandler)
+		self.latency, self.jitter = latency / 1000, jitter / 1000
+		self.error_rate, self.timeout_rate, self.miss_rate = error_rate, timeout_rate, miss_rate
+		# isfdb.org's CGI pages come without ETag and Last-Modified
+		self.validators = validators
+		# Rows a title/author search finds, over as many pages as it takes;
+		# None for just those of the fixture page
+		self.search_rows = search_rows
+		self.requests = 0
+		self.paths = Counter()
+		self.fixtures = dict((name, load_fixture(name)) for name in os.listdir(FIXTURES))
+
+	@property
+	def base_url(self):
+		return 'http://%s:%d' % self.server_address
+
+	def search_page(self, query):
+		'''
+		A page of search results, with the rows of the fixture repeated
+		under new publication ids to make up search_rows in all.
+		'''
+		page = self.page('adv_search_results.html')
+		if self.search_rows is None:
+			return page
+		rows = SEARCH_ROW.findall(page)
+		start = re.search(r'START=(\d+)', query)
+		start = int(start.group(1)) if start else 0
+		count = max(0, min(SEARCH_PAGE_SIZE, self.search_rows - start))
+		body = b''.join(re.sub(br'pl\.cgi\?\d+', b'pl.cgi?%d' % (1000000 + i), rows[i % len(rows)])
+			for i in range(start, start + count))
+		first, last = SEARCH_ROW.search(page), list(SEARCH_ROW.finditer(page))[-1]
+		return page[:first.start()] + body + page[last.end():]
+
+	def page(self, name):
+		# Keep every link, including cover images, pointing at us
+		return self.fixtures[name].replace(b'http://www.isfdb.org', self.base_url.encode('ascii')) \
+			.replace(b'http://images.amazon.com', self.base_url.encode('ascii'))
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+	# Send each response in one go; writing the status line and headers
+	# separately runs into Nagle's algorithm and delayed ACKs on keep-alive
+	# connections, adding ~40ms to every request.
+	wbufsize = -1
+	# Bodies bigger than a segment (the cover images) would otherwise wait
+	# out the same delayed ACK on their last segment
+	disable_nagle_algorithm = True
+
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		server = self.server
+		server.requests += 1
+		server.paths[urlsplit(self.path).path] += 1
+		delay = server.latency + random.uniform(-server.jitter, server.jitter)
+		if delay > 0:
+			time.sleep(delay)
+		if random.random() < server.timeout_rate:
+			time.sleep(60)
+			return
+		if random.random() < server.error_rate:
+			return self.send(503, b'Service temporarily unavailable', 'text/plain', {'Retry-After': '1'})
+
+		parts = urlsplit(self.path)
+		path, query = parts.path, parts.query
+		if path == '/cgi-bin/se.cgi':
+			isbn = re.search(r'arg=([0-9Xx]+)', query)
+			isbn = isbn.group(1) if isbn else ''
+			if not isbn or random.Random(isbn).random() < server.miss_rate:
+				return self.send(200, server.page('se_isbn_nomatch.html'))
+			return self.send(302, b'', headers={'Location': '%s/cgi-bin/pl.cgi?%d' % (server.base_url, isbn_to_pub_id(isbn))})
+		if path == '/cgi-bin/adv_search_results.cgi':
+			return self.send(200, server.search_page(query))
+		if path == '/cgi-bin/pl.cgi':
+			# Every publication has a cover of its own
+			return self.send_record(server.page('pl.html').replace(b'/images/P/034547063X',
+				b'/images/P/' + query.encode('ascii')))
+		if path == '/cgi-bin/title.cgi':
+			return self.send_record(server.page('title.html'))
+		if path == '/cgi-bin/rest/getpub.cgi' and random.Random(query).random() < server.miss_rate:
+			return self.send(200, NO_RECORDS_XML, 'text/xml')
+		if path in ('/cgi-bin/rest/getpub.cgi', '/cgi-bin/rest/getpub_by_internal_ID.cgi'):
+			return self.send_record(server.page('getpub.xml'), 'text/xml')
+		if path.startswith('/images/'):
+			seed = random.Random(path)
+			image = fake_jpeg(seed.randint(200, 1200), seed.randint(300, 1800))
+			# Image hosts answer ranged requests, and do not compress images
+			match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+			if match is not None:
+				start = int(match.group(1))
+				end = min(int(match.group(2) or len(image) - 1), len(image) - 1)
+				return self.send(206, image[start:end+1], 'image/jpeg', {'Content-Range':
+					'bytes %d-%d/%d' % (start, end, len(image))}, compress=False)
+			return self.send(200, image, 'image/jpeg', compress=False)
+		self.send(404, b'<html><head><title>404 - Not Found</title></head></html>')
+
+	def send_record(self, body, content_type='text/html; charset=iso-8859-1'):
+		'''
+		Send a record page with validators, or a 304 if the client has it.
+		'''
+		if not self.server.validators:
+			return self.send(200, body, content_type)
+		etag = '"%s"' % hashlib.md5(body).hexdigest()
+		headers = {'ETag': etag, 'Last-Modified': LAST_MODIFIED}
+		if self.headers.get('If-None-Match') == etag or (self.headers.get('If-None-Match') is None
+				and self.headers.get('If-Modified-Since') == LAST_MODIFIED):
+			return self.send(304, b'', content_type, headers)
+		self.send(200, body, content_type, headers)
+
+	def send(self, code, body, content_type='text/html; charset=iso-8859-1', headers=None, compress=True):
+		headers = dict(headers or {})
+		if body and compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+			buf = StringIO()
+			with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+				f.write(body)
+			body = buf.getvalue()
+			headers['Content-Encoding'] = 'gzip'
+		self.send_response(code)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+def start_server(port=0, **kwargs):
+	'''
+	Start a stand-in server on a background thread and return it. Port 0
+	picks a free port; see server.base_url.
+	'''
+	server = StandInServer(('127.0.0.1', port), **kwargs)
+	t = Thread(target=server.serve_forever, name='ISFDB stand-in server')
+	t.daemon = True
+	t.start()
+	return server
+
+def add_server_options(parser):
+	parser.add_argument('--latency', type=float, default=0, help='Added delay per request, in ms')
+	parser.add_argument('--jitter', type=float, default=0, help='Random +/- variation of the delay, in ms')
+	parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests answered with a 503')
+	parser.add_argument('--timeout-rate', type=float, default=0, help='Fraction of requests that never get an answer')
+	parser.add_argument('--miss-rate', type=float, default=0, help='Fraction of ISBNs the server does not know')
+	parser.add_argument('--no-validators', action='store_true', help='Send record pages without ETag and Last-Modified, '
+		'as isfdb.org does')
+
+def server_options(opts):
+	return dict(latency=opts.latency, jitter=opts.jitter, error_rate=opts.error_rate,
+		timeout_rate=opts.timeout_rate, miss_rate=opts.miss_rate, validators=not opts.no_validators)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Local stand-in for isfdb.org')
+	parser.add_argument('--port', type=int, default=8000)
+	add_server_options(parser)
+	opts = parser.parse_args()
+	server = StandInServer(('127.0.0.1', opts.port), **server_options(opts))
+	print('Serving on %s' % server.base_url)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		sys.exit(0)
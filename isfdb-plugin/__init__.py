@@ -7,10 +7,11 @@ __license__   = 'GPL v3'
 __copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
 __docformat__ = 'restructuredtext en'
 
-import time
+import re
 from urllib import quote
 from Queue import Queue, Empty
 from collections import OrderedDict
+from threading import Event
 
 from lxml.html import fromstring, tostring
 
@@ -21,6 +22,25 @@ from calibre.utils.icu import lower
 from calibre.utils.cleantext import clean_ascii_chars
 from calibre.utils.localization import get_udc
 
+# Identify calls between two logged stats summaries
+STATS_LOG_INTERVAL = 25
+
+class Lookup(object):
+
+	'''
+	An identify in progress. Stands in for its result queue so that
+	download_cover can wait for it and see what it found.
+	'''
+
+	def __init__(self, result_queue):
+		self.result_queue = result_queue
+		self.results = []
+		self.done = Event()
+
+	def put(self, mi):
+		self.results.append(mi)
+		self.result_queue.put(mi)
+
 class ISFDB(Source):
 # http://manual.calibre-ebook.com/plugins.html#module-calibre.ebooks.metadata.sources.base
 	name = 'ISFDB'
@@ -30,14 +50,50 @@ class ISFDB(Source):
 	minimum_calibre_version = (0, 8, 0)
 
 	capabilities = frozenset(['identify', 'cover'])
-	touched_fields = frozenset(['title', 'authors', 'identifier:isfdb', 'identifier:isbn', 'publisher', 'pubdate', 'comments'])
+	publication_fields = frozenset(['title', 'authors', 'identifier:isfdb', 'identifier:isbn', 'publisher', 'pubdate',
+		'comments'])
 	has_html_comments = False
-	supports_gzip_transfer_encoding = False
+	supports_gzip_transfer_encoding = True
 	cached_cover_url_is_reliable = True
 
 	BASE_URL = 'http://www.isfdb.org'
 	SEARCH_URL = BASE_URL + '/cgi-bin/se.cgi?'
 	ADV_SEARCH_URL = BASE_URL + '/cgi-bin/adv_search_results.cgi?'
+	REST_URL = BASE_URL + '/cgi-bin/rest/'
+
+	def __init__(self, *args, **kwargs):
+		Source.__init__(self, *args, **kwargs)
+		self._session = None
+		self._lookups = {}
+		# Bounded in place of calibre's plain dicts; the on-disk cache has
+		# the rest
+		from calibre_plugins.isfdb.cache import LRUCache, IDENTIFIER_CACHE_BYTES, COVER_URL_CACHE_BYTES
+		self._isbn_to_identifier_cache = LRUCache(IDENTIFIER_CACHE_BYTES)
+		self._identifier_to_cover_url_cache = LRUCache(COVER_URL_CACHE_BYTES)
+		# Book key -> the cover urls of every edition identify matched
+		self._cover_candidates = LRUCache(COVER_URL_CACHE_BYTES)
+
+	@property
+	def touched_fields(self):
+		'''
+		Series and tags only come from title records, which are not
+		downloaded unless KEY_TITLE_DETAILS is on.
+		'''
+		import calibre_plugins.isfdb.config as cfg
+		if cfg.get_option(cfg.KEY_TITLE_DETAILS):
+			return self.publication_fields | frozenset(['series', 'tags'])
+		return self.publication_fields
+
+	@classmethod
+	def set_base_url(cls, base_url):
+		'''
+		Point the plugin at another server, such as the stand-in used by the
+		benchmarks.
+		'''
+		cls.BASE_URL = base_url.rstrip('/')
+		cls.SEARCH_URL = cls.BASE_URL + '/cgi-bin/se.cgi?'
+		cls.ADV_SEARCH_URL = cls.BASE_URL + '/cgi-bin/adv_search_results.cgi?'
+		cls.REST_URL = cls.BASE_URL + '/cgi-bin/rest/'
 
 	def config_widget(self):
 		'''
@@ -46,6 +102,108 @@ class ISFDB(Source):
 		from calibre_plugins.isfdb.config import ConfigWidget
 		return ConfigWidget(self)
 
+	@property
+	def session(self):
+		'''
+		Keep-alive connection pool shared by identify, the workers and
+		download_cover.
+		'''
+		with self.cache_lock:
+			if self._session is None:
+				from calibre_plugins.isfdb.session import Session
+				from calibre_plugins.isfdb.ratelimit import get_limiter
+				self._session = Session(limiter=get_limiter())
+			return self._session
+
+	def open_url(self, url, timeout, headers=None, consumer=None, future=None):
+		'''
+		Download url with Session.open or, when KEY_EVENT_LOOP is on, on the
+		event loop with this thread only waiting for the response. future is
+		a response already asked for with Session.open_async. A consumer only
+		sees a response from the event loop once it has arrived in full.
+		'''
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.session import feed_consumer
+		if future is None:
+			if not cfg.get_option(cfg.KEY_EVENT_LOOP):
+				return self.session.open(url, timeout=timeout, headers=headers, consumer=consumer)
+			future = self.session.open_async(url, timeout=timeout, headers=headers)
+		response = future.result()
+		if consumer is not None:
+			feed_consumer(response, consumer)
+		return response
+
+	@property
+	def metadata_cache(self):
+		from calibre_plugins.isfdb.cache import get_cache
+		return get_cache()
+
+	def queue_record(self, record, relevance, result_queue):
+		'''
+		Turn a parsed or cached publication record into a Metadata result,
+		remembering its ISBN and cover url for later cover downloads.
+		'''
+		from calibre_plugins.isfdb.worker import record_to_metadata
+		mi = record_to_metadata(record)
+		mi.source_relevance = relevance
+
+		isfdb_id = record['isfdb_id']
+		isbn = check_isbn(record.get('isbn'))
+		if isbn:
+			self.cache_isbn_to_identifier(isbn, isfdb_id)
+		if record.get('cover_url'):
+			self.cache_identifier_to_cover_url(isfdb_id, record['cover_url'])
+
+		self.clean_downloaded_metadata(mi)
+		result_queue.put(mi)
+
+	def title_details(self, log, record, timeout):
+		'''
+		The work level data (see cache.WORK_FIELDS) of a publication record,
+		from the title record of the work, or None if KEY_TITLE_DETAILS is
+		off or the work is not known. Editions of the same work share one
+		download of it, whether they ask at the same time or later on.
+		'''
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.pool import get_flights
+		if not cfg.get_option(cfg.KEY_TITLE_DETAILS):
+			return None
+		title_id = record.get('title_id') or self.metadata_cache.get_title_id(record['isfdb_id'])
+		if not title_id:
+			return None
+		return get_flights().do(('title', title_id), self._title_record, log, title_id, timeout)
+
+	def _title_record(self, log, title_id, timeout):
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.parse import page_to_tree
+		from calibre_plugins.isfdb.stats import stats
+		from calibre_plugins.isfdb.worker import parse_title_record
+		work = self.metadata_cache.get_title(title_id, cfg.get_option(cfg.KEY_CACHE_TTL) * 24 * 60 * 60)
+		stats.count('title_cache_misses' if work is None else 'title_cache_hits')
+		if work is not None:
+			return work
+		url = '%s/cgi-bin/title.cgi?%s' % (ISFDB.BASE_URL, title_id)
+		log.info('Fetching title record: %s' % url)
+		try:
+			root = page_to_tree(self.open_url(url, timeout).read().strip())
+			with stats.timer('details_extract'):
+				work = parse_title_record(root)
+		except:
+			log.exception('Failed to read title record: %r' % url)
+			return None
+		self.metadata_cache.put_title(title_id, work)
+		return work
+
+	@property
+	def offline_index(self):
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.offline import get_index, DEFAULT_INDEX_PATH
+		return get_index(cfg.get_option(cfg.KEY_OFFLINE_INDEX) or DEFAULT_INDEX_PATH)
+
+	def cli_main(self, args):
+		from calibre_plugins.isfdb.cli import main
+		main(self, args[1:])
+
 	def get_book_url(self, identifiers):
 		isfdb_id = identifiers.get('isfdb', None)
 		if isfdb_id:
@@ -57,6 +215,7 @@ class ISFDB(Source):
 		if isbn is not None:
 			return '%stype=ISBN&arg=%s' % (ISFDB.SEARCH_URL, isbn)
 		
+		title_tokens = author_tokens = search_title = search_author = None
 		if title:
 			title = title.replace('?', '')
 			title_tokens = self.get_title_tokens(title, strip_joiners=False, strip_subtitle=True)
@@ -93,27 +252,101 @@ class ISFDB(Source):
 				isfdb_id = self.cached_isbn_to_identifier(isbn)
 		if isfdb_id is not None:
 			url = self.cached_identifier_to_cover_url(isfdb_id)
+			if url is None:
+				import calibre_plugins.isfdb.config as cfg
+				index = self.offline_index if cfg.get_option(cfg.KEY_BACKEND) == cfg.BACKEND_OFFLINE else None
+				record = index.get(isfdb_id) if index is not None else None
+				if record is not None and record['cover_url']:
+					url = record['cover_url']
+					self.cache_identifier_to_cover_url(isfdb_id, url)
 		return url
 
+	# The ISBN -> ISFDB id and ISFDB id -> cover url maps are kept in
+	# calibre's in-memory dicts and mirrored to the on-disk cache, so that
+	# download_cover can work for books identified in an earlier session.
+
+	def cache_isbn_to_identifier(self, isbn, identifier):
+		# Under both forms of the ISBN, which pages and users give either way
+		from calibre_plugins.isfdb.cache import isbn_forms
+		with self.cache_lock:
+			for form in isbn_forms(isbn):
+				if self._isbn_to_identifier_cache.get(form, None) != identifier:
+					self._isbn_to_identifier_cache[form] = identifier
+					self.metadata_cache.put_identifier(form, identifier)
+
+	def cached_isbn_to_identifier(self, isbn):
+		from calibre_plugins.isfdb.stats import stats
+		with self.cache_lock:
+			identifier = self._isbn_to_identifier_cache.get(isbn, None)
+			if identifier is None:
+				identifier = self.metadata_cache.get_identifier(isbn)
+				if identifier is not None:
+					self._isbn_to_identifier_cache[isbn] = identifier
+			stats.count('isbn_cache_misses' if identifier is None else 'isbn_cache_hits')
+			return identifier
+
+	def cache_identifier_to_cover_url(self, id_, url):
+		with self.cache_lock:
+			if self._identifier_to_cover_url_cache.get(id_, None) != url:
+				self._identifier_to_cover_url_cache[id_] = url
+				self.metadata_cache.put_cover_url(id_, url)
+
 	def cached_identifier_to_cover_url(self, id_):
+		from calibre_plugins.isfdb.stats import stats
 		with self.cache_lock:
 			url = self._get_cached_identifier_to_cover_url(id_)
 			if not url:
 				# Try for a "small" image in the cache
 				url = self._get_cached_identifier_to_cover_url('small/' + id_)
+			stats.count('cover_url_cache_misses' if not url else 'cover_url_cache_hits')
 			return url
 
 	def _get_cached_identifier_to_cover_url(self, id_):
 		# This must only be called once we have the cache lock
 		url = self._identifier_to_cover_url_cache.get(id_, None)
-		if not url:
-			# We could not get a url for this particular id.
-			for key in self._identifier_to_cover_url_cache.keys():
-				if key.startswith('key_prefix'):
-					return self._identifier_to_cover_url_cache[key]
+		if url is None:
+			url = self.metadata_cache.get_cover_url(id_)
+			if url is not None:
+				self._identifier_to_cover_url_cache[id_] = url
 		return url
 
 	def identify(self, log, result_queue, abort, title=None, authors=None, identifiers={}, timeout=30):
+		'''
+		Registers the lookup while it runs, so that a download_cover for the
+		same book can wait for it instead of repeating the work.
+		'''
+		from calibre_plugins.isfdb.stats import stats
+		key = self._book_key(title, authors, identifiers)
+		lookup = Lookup(result_queue)
+		with self.cache_lock:
+			self._lookups.setdefault(key, []).append(lookup)
+		try:
+			with stats.timer('identify'):
+				return self._identify(log, lookup, abort, title=title, authors=authors,
+						identifiers=identifiers, timeout=timeout)
+		finally:
+			self._remember_cover_candidates(key, lookup.results)
+			with self.cache_lock:
+				self._lookups[key].remove(lookup)
+				if not self._lookups[key]:
+					del self._lookups[key]
+			lookup.done.set()
+			# calibre only calls identify and download_cover, so show the
+			# running totals from here
+			stats.log_summary_every(log, 'identify', STATS_LOG_INTERVAL)
+
+	def _remember_cover_candidates(self, key, results):
+		'''
+		Keep the cover urls of identify results, best first, under the book
+		looked for and under each result, so that download_cover can choose
+		the biggest whichever of them it is asked for.
+		'''
+		results = sorted(results, key=lambda mi: mi.source_relevance)
+		urls = tuple(self._cover_urls(results))
+		for k in [key] + [self._book_key(mi.title, mi.authors, mi.identifiers) for mi in results]:
+			self._cover_candidates[k] = urls
+
+	def _identify(self, log, result_queue, abort, title=None, authors=None, identifiers={}, timeout=30):
         log.info("identify")
 		'''
 		Note this method will retry without identifiers automatically if no
@@ -124,40 +357,109 @@ class ISFDB(Source):
 		# Instead we will go straight to the URL for that book.
 		isfdb_id = identifiers.get('isfdb', None)
 		isbn = check_isbn(identifiers.get('isbn', None))
-		br = self.browser
+
+		# Answer straight from the local cache when we have a fresh record.
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.stats import stats
+		max_age = cfg.get_option(cfg.KEY_CACHE_TTL) * 24 * 60 * 60
+		record = known_id = None
+		if isfdb_id:
+			record = self.metadata_cache.get(isfdb_id, max_age)
+		elif isbn and max_age > 0:
+			known_id = self.cached_isbn_to_identifier(isbn)
+			if known_id:
+				record = self.metadata_cache.get(known_id, max_age)
+		stats.count('record_cache_misses' if record is None else 'record_cache_hits')
+		if record is not None:
+			log.info('Using cached record for ISFDB id: %s' % record['isfdb_id'])
+			work = self.title_details(log, record, timeout)
+			self.queue_record(dict(record, **work) if work else record, 0, result_queue)
+			return None
+
+		backend = cfg.get_option(cfg.KEY_BACKEND)
+		if backend == cfg.BACKEND_OFFLINE:
+			return self._identify_offline(log, result_queue, title, authors, isfdb_id, isbn)
+		use_xml = backend == cfg.BACKEND_XML
+		if known_id:
+			# A book page we have validators for is revalidated straight
+			# away, saving the search
+			if self.metadata_cache.get_validators(self._details_url(known_id, use_xml)) is not None:
+				log.info('Revalidating expired record for ISFDB id: %s' % known_id)
+				isfdb_id = known_id
 		if isfdb_id:
 			matches.append('%s/cgi-bin/pl.cgi?%s' % (ISFDB.BASE_URL, isfdb_id))
 		else:
 			title = get_udc().decode(title)
 			authors = authors or []
 			authors = [get_udc().decode(a) for a in authors]
+			# Optionally send the title/author query we may fall back to along
+			# with the ISBN query, rather than only once the ISBN has failed.
+			fallback = fallback_results = None
+			if isbn and title and authors and cfg.get_option(cfg.KEY_PARALLEL_QUERIES):
+				fallback_query = self.create_query(log, title=title, authors=authors)
+				fallback_results = self._search_results(log, title, authors, timeout)
+				log.info('Querying in parallel: %s' % fallback_query)
+				fallback = self._search_ahead(fallback_query, timeout, fallback_results)
+			if isbn and use_xml:
+				# The web API answers an ISBN with complete publication records,
+				# so there is neither a redirect nor a details page to follow.
+				if self._identify_isbn_xml(log, isbn, result_queue, timeout):
+					if fallback is not None:
+						fallback_results.cancel()
+					return None
+				log.info('Failed to find match for ISBN: %s' % isbn)
+				# Fall back to title/author, as for an ISBN search below
+				if not (title and authors):
+					return None
+				isbn = None
+				identifiers = dict((k, v) for k, v in identifiers.iteritems() if k != 'isbn')
 			query = self.create_query(log, title=title, authors=authors, identifiers=identifiers)
+			if isbn and self._known_missing(log, query):
+				# Go straight to the title/author search we would fall back to
+				if not (title and authors):
+					return None
+				isbn = None
+				identifiers = dict((k, v) for k, v in identifiers.iteritems() if k != 'isbn')
+				query = self.create_query(log, title=title, authors=authors, identifiers=identifiers)
 			if query is None:
 				log.error('Insufficient metadata to construct query. Alas!')
 				return
+			if not isbn and self._known_missing(log, query):
+				return None
 			isbn_match_failed = False
+			# Title/author results are matched while the page downloads
+			results = None if isbn else self._search_results(log, title, authors, timeout)
 			try:
-				log.info('Querying: %s' % query)
-				response = br.open_novisit(query, timeout=timeout)
-				raw = response.read().decode('cp1252', errors='replace').strip()
+				if fallback is not None and not isbn:
+					# Already on its way: the XML API had nothing for the ISBN
+					results = fallback_results
+					location, raw = fallback.result()
+				else:
+					log.info('Querying: %s' % query)
+					location, raw = self._search(query, timeout, results)
 				
 				if isbn:
 					# Check whether we got redirected to a book page for ISBN searches.
 					# If we did, will use the url.
 					# If we didn't then treat it as no matches on ISFDB
-					location = response.geturl()
 					# If not an exact match on ISBN we can get a search results page back
 					# XMS: This may be terribly different for ISFDB.
 					# XMS: HOWEVER: 1563890933 returns multiple results!
 					isbn_match_failed = location.find('/pl.cgi') < 0
-					if raw.find('found 0 matches') == -1 and not isbn_match_failed:
+					if raw.find(b'found 0 matches') == -1 and not isbn_match_failed:
 						log.info('ISBN match location: %r' % location)
 						matches.append(location)
+						if fallback is not None:
+							# No need to read the title/author results
+							fallback_results.cancel()
+						# The page may list the ISBN in its other form
+						self.cache_isbn_to_identifier(isbn, re.search('(\d+)$', location).group(1))
 			except Exception as e:
 				if isbn and callable(getattr(e, 'getcode', None)) and e.getcode() == 404:
 					# We did a lookup by ISBN but did not find a match
 					# We will fallback to doing a lookup by title author
 					log.info('Failed to find match for ISBN: %s' % isbn)
+					self._remember_missing(query)
 				elif callable(getattr(e, 'getcode', None)) and e.getcode() == 404:
 					log.error('No matches for identify query')
 					return as_unicode(e)
@@ -169,120 +471,324 @@ class ISFDB(Source):
 			# For successful ISBN-based searches we have already done everything we need to.
 			# So anything from this point below is for title/author based searches.
 			if not isbn or isbn_match_failed:
-				try:
-					root = fromstring(clean_ascii_chars(raw))
-				except:
-					msg = 'Failed to parse ISFDB page for query'
-					log.exception(msg)
-					return msg
+				if results is None:
+					# An ISBN search that listed several books instead of
+					# redirecting to one
+					results = self._search_results(log, title, authors, timeout)
+					results.feed(raw)
 				# Now grab the matches from the search results, provided the
 				# title and authors appear to be for the same book
-				self._parse_search_results(log, title, authors, root, matches, timeout)
+				self._collect_search_results(log, results, matches, query, timeout)
 
 		if abort.is_set():
 			return
 
+		if not matches and isbn and title and authors:
+			# Nothing for the ISBN, so fall back to title/author, using the
+			# parallel query's response if we sent one.
+			log.info('No matches found with identifiers, retrying using only title and authors')
+			query = self.create_query(log, title=title, authors=authors)
+			if self._known_missing(log, query):
+				return None
+			try:
+				if fallback is not None:
+					results = fallback_results
+					fallback.result()
+				else:
+					results = self._search_results(log, title, authors, timeout)
+					log.info('Querying: %s' % query)
+					self._search(query, timeout, results)
+			except Exception as e:
+				log.exception('Failed to make identify query')
+				return as_unicode(e)
+			self._collect_search_results(log, results, matches, query, timeout)
+
+			if abort.is_set():
+				return
+
 		if not matches:
-			if identifiers and title and authors:
-				log.info('No matches found with identifiers, retrying using only title and authors')
-				return self.identify(log, result_queue, abort, title=title, authors=authors, timeout=timeout)
 			log.error('No matches found with query: %r' % query)
 			return
 
-		from calibre_plugins.isfdb.worker import Worker
-		workers = [Worker(url, result_queue, br, log, i, self) for i, url in enumerate(matches)]
-
-		for w in workers:
-			w.start()
-			# Don't send all requests at the same time
-			time.sleep(0.1)
+		from calibre_plugins.isfdb.pool import JobGroup, get_pool
+		from calibre_plugins.isfdb.worker import revalidation_headers
+		if use_xml:
+			from calibre_plugins.isfdb.xmlapi import XMLWorker as Worker
+			matches = [self._details_url(re.search('(\d+)$', url).group(1), use_xml) for url in matches]
+		else:
+			from calibre_plugins.isfdb.worker import Worker
+		jobs = JobGroup(get_pool())
+		event_loop = cfg.get_option(cfg.KEY_EVENT_LOOP)
+		for i, url in enumerate(matches):
+			worker = Worker(url, result_queue, log, i, self)
+			if event_loop:
+				# Download on the event loop, parse on the pool once it arrives
+				worker.response = self.session.open_async(url, timeout=timeout,
+						headers=revalidation_headers(self.metadata_cache, url))
+				jobs.submit_after(worker.response, worker.run)
+			else:
+				jobs.submit(worker.run)
+		with stats.timer('details_wait'):
+			jobs.wait(abort, timeout)
 
-		while not abort.is_set():
-			a_worker_is_alive = False
-			for w in workers:
-				w.join(0.2)
-				if abort.is_set():
-					break
-				if w.is_alive():
-					a_worker_is_alive = True
-			if not a_worker_is_alive:
-				break
-		
 		return None
 
-	def _parse_search_results(self, log, orig_title, orig_authors, root, matches, timeout):
-		UNSUPPORTED_FORMATS = [] # is there anything to exclude?
-		
-		results = root.xpath('//div[@id="main"]/table/tr')
-		if not results:
-			log.info('Unable to parse search results.')
+	def _details_url(self, isfdb_id, use_xml):
+		if use_xml:
+			return '%sgetpub_by_internal_ID.cgi?%s' % (ISFDB.REST_URL, isfdb_id)
+		return '%s/cgi-bin/pl.cgi?%s' % (ISFDB.BASE_URL, isfdb_id)
+
+	def _search(self, query, timeout, results=None, future=None):
+		'''
+		Run a search query, returning the url we ended up at and the raw page.
+		If results (see _search_results) is given the page is fed to it as it
+		arrives, and only read as far as needed to find enough matches. See
+		open_url for future.
+		'''
+		if results is not None:
+			results.url = query
+		response = self.open_url(query, timeout, future=future,
+				consumer=None if results is None else results.feed)
+		if results is not None:
+			results.close()
+		return response.geturl(), response.read().strip()
+
+	def _search_ahead(self, query, timeout, results):
+		'''
+		Start _search in the background, returning a Future for what it
+		returns. With KEY_EVENT_LOOP on, the search only takes up a thread of
+		the shared pool once the page has arrived.
+		'''
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.pool import get_pool, submit_future, submit_future_after
+		if not cfg.get_option(cfg.KEY_EVENT_LOOP):
+			return submit_future(get_pool(), self._search, query, timeout, results)
+		download = self.session.open_async(query, timeout=timeout)
+		return submit_future_after(get_pool(), download, self._search, query, timeout, results, download)
+
+	def _search_results(self, log, title, authors, timeout):
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.parse import SearchResults
+		return SearchResults(list(self.get_title_tokens(title)), list(self.get_author_tokens(authors)),
+				cfg.get_option(cfg.KEY_MAX_DOWNLOADS), lambda results: self._prefetch(log, results, timeout))
+
+	def _prefetch(self, log, results, timeout):
+		'''
+		Start downloading the page after the one results is reading, which
+		looks like a full one, unless the pages so far already have enough
+		matching rows. See SearchResults.
+		'''
+		from calibre_plugins.isfdb.parse import next_search_page_url
+		url = next_search_page_url(results.url or '')
+		if url is None or results.found() >= results.max_results:
 			return
+		log.info('Prefetching: %s' % url)
+		upcoming = results.sibling()
+		upcoming.download = self._search_ahead(url, timeout, upcoming)
+		results.next_page = upcoming
 
-		def ismatch(title, authors):
-			authors = lower(' '.join(authors))
-			title = lower(title)
-			match = not title_tokens
-			for t in title_tokens:
-				if lower(t) in title:
-					match = True
-					break
-			amatch = not author_tokens
-			for a in author_tokens:
-				if lower(a) in authors:
-					amatch = True
-					break
-			if not author_tokens: amatch = True
-			return match and amatch
+	def _collect_search_results(self, log, results, matches, query, timeout):
+		'''
+		Add the best matches of a search, whose first page has been fed to
+		results, to matches. Further pages are only read while there are
+		fewer matching rows than KEY_MAX_DOWNLOADS.
+		'''
+		from calibre_plugins.isfdb.rank import best
+		candidates = []
+		for page in self._search_pages(log, query, results, timeout):
+			candidates.extend(page.candidates)
+			if len(candidates) >= results.max_results:
+				break
+		if not results.rows and not results.no_records:
+			log.info('Unable to parse search results.')
+		urls = best(candidates, results.max_results)
+		if candidates:
+			log.info('Fetching the best %d of %d matching search results' % (len(urls), len(candidates)))
+		elif results.rows or results.no_records:
+			# Only when ISFDB answered; a page we could not read proves nothing
+			self._remember_missing(query)
+		for url in urls:
+			if url not in matches:
+				matches.append(url)
+
+	def _search_pages(self, log, query, results, timeout):
+		'''
+		Lazily page through a search, given the SearchResults its first page
+		has been read into. Yields a SearchResults per page. Each page after
+		the first was requested while the one before it was still arriving
+		(see _prefetch), and is cancelled if that page turns out to be the
+		last or the pages so far have enough matching rows.
+		'''
+		from calibre_plugins.isfdb.stats import stats
+		while True:
+			results.close()
+			upcoming = results.next_page
+			if upcoming is not None and (not results.full or results.found() >= results.max_results):
+				upcoming.cancel()
+				stats.count('search_pages_cancelled')
+				upcoming = None
+			try:
+				yield results
+			except GeneratorExit:
+				# The caller has all it needs
+				if upcoming is not None:
+					upcoming.cancel()
+					stats.count('search_pages_cancelled')
+				raise
+			if upcoming is None:
+				return
+			try:
+				upcoming.download.result()
+			except:
+				log.exception('Failed to fetch search results page: %r' % upcoming.url)
+				return
+			results = upcoming
 
+	def _known_missing(self, log, query):
+		'''
+		Whether query found nothing the last time it was run, within
+		KEY_MISSING_TTL days.
+		'''
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.stats import stats
+		max_age = cfg.get_option(cfg.KEY_MISSING_TTL) * 24 * 60 * 60
+		if self.metadata_cache.is_missing(query, max_age):
+			stats.count('missing_cache_hits')
+			log.info('No match on ISFDB last time for: %s' % query)
+			return True
+		return False
+
+	def _remember_missing(self, query):
 		import calibre_plugins.isfdb.config as cfg
-		max_results = cfg.plugin_prefs[cfg.STORE_NAME][cfg.KEY_MAX_DOWNLOADS]
+		if cfg.get_option(cfg.KEY_MISSING_TTL) > 0:
+			self.metadata_cache.put_missing(query)
 
-		for result in results:
-			if not result.xpath('td'):
-				continue # header
-			
-			#log.info('Looking at result:')
-			title = result.xpath('td')[0].text_content().strip()
-
-			contributors = result.xpath('td[3]/a')
-			authors = []
-			for c in contributors:
-				author = c.text_content().split(',')[0]
-				#log.info('Found author:',author)
-				if author.strip():
-					authors.append(author.strip())
-				#log.info('Looking at tokens:',author)
-				
-			title_tokens = list(self.get_title_tokens(orig_title))
-			author_tokens = list(self.get_author_tokens(orig_authors))
-			#log.info('Considering search result: %s %s' % (title, authors))
-			if not ismatch(title, authors):
-				#log.error('Rejecting as not close enough match: %s %s' % (title, authors))
-				continue
-
-			# Validate that the format is one we are interested in
-			format_details = result.xpath('td[8]/text()')
-			valid_format = False
-			for format in format_details:
-				#log.info('**Found format: %s'%format)
-				if format.lower() not in UNSUPPORTED_FORMATS:
-					valid_format = True
-					break
-			result_url = None
-			if valid_format:
-				# Get the detailed url to query next
-				result_url = ''.join(result.xpath('td[1]/a/@href'))
-				#log.info('**Found href: %s'%result_url)
-
-			if result_url:
-				matches.append(result_url)
-				if len(matches) >= max_results:
-					break
+	def _identify_offline(self, log, result_queue, title, authors, isfdb_id, isbn):
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.offline import search_tokens
+		index = self.offline_index
+		if index is None:
+			msg = 'The offline ISFDB index has not been built'
+			log.error(msg)
+			return msg
+
+		records = []
+		if isfdb_id:
+			records = [r for r in [index.get(isfdb_id)] if r is not None]
+		elif isbn:
+			records = index.find_isbn(isbn)
+		if not records and (title or authors):
+			title_tokens = search_tokens(self.get_title_tokens(title.replace('?', ''),
+				strip_joiners=False, strip_subtitle=True)) if title else []
+			author_tokens = search_tokens(self.get_author_tokens(authors, only_first_author=True)) if authors else []
+			records = index.search(title_tokens, author_tokens, cfg.get_option(cfg.KEY_MAX_DOWNLOADS))
+
+		if not records:
+			log.error('No matches found in the offline index')
+		for i, record in enumerate(records):
+			self.queue_record(record, i, result_queue)
+		return None
 
+	def _identify_isbn_xml(self, log, isbn, result_queue, timeout):
+		from calibre_plugins.isfdb.xmlapi import parse_publications, XML_NO_RECORDS
+		query = '%sgetpub.cgi?%s' % (ISFDB.REST_URL, isbn)
+		if self._known_missing(log, query):
+			return False
+		log.info('Querying: %s' % query)
+		try:
+			raw = self.open_url(query, timeout).read()
+			records = list(parse_publications(raw))
+		except:
+			log.exception('Failed to make ISBN query: %r' % query)
+			return False
+		if not records and XML_NO_RECORDS.search(raw) is not None:
+			self._remember_missing(query)
+		for i, record in enumerate(records):
+			self.metadata_cache.put(record)
+			self.queue_record(record, i, result_queue)
+		return bool(records)
+
+	def identify_batch(self, log, books, abort, timeout=30):
+		'''
+		Identify many books in one go. books is an iterable of
+		(title, authors, identifiers) tuples. Yields (index, results) as each
+		book completes, in completion order, where results is the list of
+		Metadata objects identify would have queued for that book.
+
+		Books that share an ISFDB id, ISBN or title/author query are only
+		looked up once. Up to KEY_MAX_THREADS searches run at a time, feeding
+		their detail fetches to the shared pool as they find matches.
+		'''
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.pool import WorkerPool
+
+		lookups = OrderedDict()
+		for i, (title, authors, identifiers) in enumerate(books):
+			identifiers = identifiers or {}
+			key = self._book_key(title, authors, identifiers)
+			if key not in lookups:
+				lookups[key] = ((title, authors, identifiers), [])
+			lookups[key][1].append(i)
+		log.info('Batch of %d books needs %d lookups' % (sum(len(l[1]) for l in lookups.values()), len(lookups)))
+
+		done = Queue()
+		def lookup(key, title, authors, identifiers):
+			rq = Queue()
+			try:
+				if not abort.is_set():
+					self.identify(log, rq, abort, title=title, authors=authors,
+							identifiers=identifiers, timeout=timeout)
+			except:
+				log.exception('Batch identify failed for: %r' % (key,))
+			finally:
+				results = []
+				while True:
+					try:
+						results.append(rq.get_nowait())
+					except Empty:
+						break
+				results.sort(key=lambda mi: mi.source_relevance)
+				done.put((key, results))
+
+		searches = WorkerPool(cfg.get_option(cfg.KEY_MAX_THREADS), 'ISFDB batch search')
+		try:
+			for key, (args, indices) in lookups.items():
+				searches.submit(lookup, key, *args)
+			for n in range(len(lookups)):
+				key, results = done.get()
+				if abort.is_set():
+					return
+				for j, i in enumerate(lookups[key][1]):
+					# Duplicates get their own copies to modify as they please
+					yield i, results if j == 0 else [mi.deepcopy() for mi in results]
+		finally:
+			searches.shutdown()
+			from calibre_plugins.isfdb.stats import stats
+			stats.log_summary(log)
+
+	def _book_key(self, title, authors, identifiers):
+		isfdb_id = identifiers.get('isfdb', None)
+		if isfdb_id:
+			return ('isfdb', isfdb_id)
+		isbn = check_isbn(identifiers.get('isbn', None))
+		if isbn:
+			return ('isbn', isbn)
+		return ('query', lower(title or ''), tuple(lower(a) for a in authors or []))
 
 	def download_cover(self, log, result_queue, abort, title=None, authors=None, identifiers={}, timeout=30):
+		'''
+		When the book's editions have different covers, only the start of
+		each is read to find the biggest, which is then the one downloaded.
+		That includes the editions an earlier identify matched besides the
+		one whose cover url is known.
+		'''
 		cached_url = self.get_cached_cover_url(identifiers)
-		if cached_url is None:
+		if cached_url is not None:
+			others = self._cover_candidates.get(self._book_key(title, authors, identifiers), ())
+			urls = [cached_url] + [url for url in others if url != cached_url]
+		else:
+			urls = self._resolve_cover_urls(log, abort, title, authors, identifiers, timeout)
+		if not urls:
 			log.info('No cached cover found, running identify')
 			rq = Queue()
 			self.identify(log, rq, abort, title=title, authors=authors,
@@ -296,24 +802,134 @@ class ISFDB(Source):
 				except Empty:
 					break
 			results.sort(key=self.identify_results_keygen(title=title, authors=authors, identifiers=identifiers))
-			for mi in results:
-				cached_url = self.get_cached_cover_url(mi.identifiers)
-				if cached_url is not None:
-					break
-		if cached_url is None:
+			urls = self._cover_urls(results)
+		if not urls:
 			log.info('No cover found')
 			return
 
 		if abort.is_set():
 			return
-		br = self.browser
+		cdata = None
+		if len(urls) > 1:
+			import calibre_plugins.isfdb.config as cfg
+			from calibre_plugins.isfdb.covers import largest_cover
+			log.info('Comparing %d covers' % len(urls))
+			probe = largest_cover(log, self.session, urls, timeout, cfg.get_option(cfg.KEY_EVENT_LOOP))
+			if probe is not None:
+				urls, cdata = [probe.url], probe.data
+			if abort.is_set():
+				return
+		cached_url = urls[0]
 		log.info('Downloading cover from:', cached_url)
 		try:
-			cdata = br.open_novisit(cached_url, timeout=timeout).read()
+			if cdata is None:
+				cdata = self.open_url(cached_url, timeout).read()
 			result_queue.put((self, cdata))
 		except:
 			log.exception('Failed to download cover from:', cached_url)
 
+	def _cover_urls(self, results):
+		'''
+		The distinct cover urls of identify results, best result first.
+		'''
+		urls = []
+		for mi in results:
+			url = self.get_cached_cover_url(mi.identifiers)
+			if url is not None and url not in urls:
+				urls.append(url)
+		return urls
+
+	def _resolve_cover_urls(self, log, abort, title, authors, identifiers, timeout):
+		'''
+		Find just the cover urls, with as little work as possible: wait for a
+		running identify of the same book, or fetch the one page holding the
+		cover for an ISFDB id or ISBN. Returns an empty list if a full
+		identify is needed after all.
+		'''
+		with self.cache_lock:
+			running = list(self._lookups.get(self._book_key(title, authors, identifiers), []))
+		if running:
+			log.info('Waiting for the running identify of this book')
+			for lookup in running:
+				lookup.done.wait(timeout)
+				urls = self._cover_urls(sorted(lookup.results, key=lambda mi: mi.source_relevance))
+				if urls:
+					return urls
+			return []
+
+		return self._lookup_cover_urls(log, abort, identifiers, timeout)
+
+	def _lookup_cover_urls(self, log, abort, identifiers, timeout):
+		import calibre_plugins.isfdb.config as cfg
+		backend = cfg.get_option(cfg.KEY_BACKEND)
+		isfdb_id = identifiers.get('isfdb', None)
+		isbn = check_isbn(identifiers.get('isbn', None))
+		if backend == cfg.BACKEND_OFFLINE or abort.is_set() or not (isfdb_id or isbn):
+			return []
+
+		try:
+			if backend == cfg.BACKEND_XML:
+				from calibre_plugins.isfdb.xmlapi import parse_publications, XML_NO_RECORDS
+				if isfdb_id:
+					query = '%sgetpub_by_internal_ID.cgi?%s' % (ISFDB.REST_URL, isfdb_id)
+				else:
+					query = '%sgetpub.cgi?%s' % (ISFDB.REST_URL, isbn)
+					if self._known_missing(log, query):
+						return []
+				log.info('Looking up cover url: %s' % query)
+				# An ISBN can be shared by several editions, each with a cover
+				urls = []
+				raw = self.open_url(query, timeout).read()
+				records = list(parse_publications(raw))
+				if not records and not isfdb_id and XML_NO_RECORDS.search(raw) is not None:
+					self._remember_missing(query)
+				for record in records:
+					self.metadata_cache.put(record)
+					if check_isbn(record['isbn']):
+						self.cache_isbn_to_identifier(check_isbn(record['isbn']), record['isfdb_id'])
+					if record['cover_url']:
+						self.cache_identifier_to_cover_url(record['isfdb_id'], record['cover_url'])
+						if record['cover_url'] not in urls:
+							urls.append(record['cover_url'])
+				return urls
+
+			from calibre_plugins.isfdb.parse import page_to_tree, NO_RECORDS
+			from calibre_plugins.isfdb.worker import Worker
+			if isfdb_id:
+				query = '%s/cgi-bin/pl.cgi?%s' % (ISFDB.BASE_URL, isfdb_id)
+			else:
+				query = self.create_query(log, identifiers={'isbn': isbn})
+				if self._known_missing(log, query):
+					return []
+			log.info('Looking up cover url: %s' % query)
+			response = self.open_url(query, timeout)
+			raw = response.read().strip()
+			# An ISBN search redirects straight to the book page on an exact match
+			match = re.search('/pl\.cgi\?(\d+)$', response.geturl())
+			if match is None:
+				if not isfdb_id and NO_RECORDS.search(raw) is not None:
+					self._remember_missing(query)
+				return []
+			# Keep the whole record, as identify would have
+			worker = Worker(response.geturl(), None, log, 0, self)
+			info = response.info()
+			worker.validators = (info.get('etag'), info.get('last-modified'))
+			record = worker.parse_details(page_to_tree(raw))
+			if record is None:
+				return []
+			worker.store([record])
+			url = record.get('cover_url')
+		except:
+			log.exception('Failed to look up cover url')
+			return []
+
+		isfdb_id = match.group(1)
+		if isbn:
+			self.cache_isbn_to_identifier(isbn, isfdb_id)
+		if url:
+			self.cache_identifier_to_cover_url(isfdb_id, url)
+		return [url] if url else []
+
 if __name__ == '__main__': # tests
 	# To run these test use:
 	# calibre-debug -e __init__.py
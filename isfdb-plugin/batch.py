@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import csv, io, json, time
+from Queue import Queue, Empty
+from threading import Event
+
+from calibre_plugins.isfdb.stats import stats
+
+def parse_identifiers(value):
+	'''
+	A dict of identifiers from calibre's identifiers column form,
+	isbn:...,isfdb:... .
+	'''
+	identifiers = {}
+	for item in (value or '').split(','):
+		kind, sep, val = item.partition(':')
+		if sep and kind.strip() and val.strip():
+			identifiers[kind.strip().lower()] = val.strip()
+	return identifiers
+
+def make_book(fields):
+	'''
+	(title, authors, identifiers) from a row of the input. Authors are a
+	list or, as in calibre, a string separated by &. Identifiers come from
+	an identifiers column (dict or isbn:...,isfdb:... string) and from
+	isbn/isfdb columns of their own.
+	'''
+	title = fields.get('title') or ''
+	authors = fields.get('authors') or []
+	if not isinstance(authors, list):
+		authors = [a.strip() for a in authors.split('&') if a.strip()]
+	identifiers = fields.get('identifiers') or {}
+	if not isinstance(identifiers, dict):
+		identifiers = parse_identifiers(identifiers)
+	for kind in ('isbn', 'isfdb'):
+		if fields.get(kind):
+			identifiers[kind] = unicode(fields[kind]).strip()
+	return title, authors, identifiers
+
+def read_books(path):
+	'''
+	The books in a CSV file with a header row, or in a file of JSON
+	objects a line (.jsonl, .json), as (title, authors, identifiers).
+	Either way the fields are title, authors, identifiers, isbn and isfdb,
+	all optional.
+	'''
+	if path.lower().endswith(('.jsonl', '.json')):
+		with io.open(path, encoding='utf-8') as f:
+			return [make_book(json.loads(line)) for line in f if line.strip()]
+	with open(path, 'rb') as f:
+		rows = list(csv.DictReader(f))
+	return [make_book(dict((k.strip().lower(), v.decode('utf-8').strip())
+		for k, v in row.items() if k and v)) for row in rows]
+
+def metadata_to_dict(mi):
+	'''
+	The fields of a Metadata object identify fills in, as plain data.
+	'''
+	pubdate = getattr(mi, 'pubdate', None)
+	return {
+		'title': mi.title,
+		'authors': mi.authors,
+		'identifiers': mi.get_identifiers(),
+		'publisher': mi.publisher,
+		'pubdate': pubdate.isoformat() if pubdate is not None else None,
+		'series': mi.series,
+		'series_index': mi.series_index if mi.series else None,
+		'tags': mi.tags,
+		'comments': mi.comments,
+		'has_cover': bool(getattr(mi, 'has_cover', False)),
+		'source_relevance': getattr(mi, 'source_relevance', None),
+	}
+
+def drain(q):
+	items = []
+	while True:
+		try:
+			items.append(q.get_nowait())
+		except Empty:
+			return items
+
+def run_batch(plugin, log, books, concurrency=4, covers=False, abort=None, timeout=30):
+	'''
+	Identify books ((title, authors, identifiers) tuples) concurrency at a
+	time and, if covers is set, download each one's cover too. Yields a
+	dict per book as it completes, in completion order: its index in
+	books, the results of identify, the cover (as bytes under 'cover_data')
+	and how long each step took.
+	'''
+	from calibre_plugins.isfdb.pool import WorkerPool
+	abort = abort or Event()
+	done = Queue()
+
+	def lookup(i, title, authors, identifiers):
+		out = {'index': i, 'title': title, 'authors': authors, 'identifiers': identifiers}
+		start = time.time()
+		try:
+			rq = Queue()
+			plugin.identify(log, rq, abort, title=title, authors=authors,
+					identifiers=identifiers, timeout=timeout)
+			results = sorted(drain(rq), key=lambda mi: mi.source_relevance)
+			out['results'] = [metadata_to_dict(mi) for mi in results]
+			out['identify_seconds'] = time.time() - start
+			if covers and not abort.is_set():
+				cover_start = time.time()
+				# Look the cover up by the identifiers found, as calibre does
+				found = dict(identifiers)
+				if results:
+					found.update(results[0].get_identifiers())
+				rq = Queue()
+				plugin.download_cover(log, rq, abort, title=title, authors=authors,
+						identifiers=found, timeout=timeout)
+				images = drain(rq)
+				out['cover_data'] = images[0][1] if images else None
+				out['cover_seconds'] = time.time() - cover_start
+		except Exception as e:
+			log.exception('Batch failed for book %d' % i)
+			out['error'] = unicode(e) or e.__class__.__name__
+		out['seconds'] = time.time() - start
+		done.put(out)
+
+	searches = WorkerPool(concurrency, 'ISFDB batch')
+	try:
+		for i, (title, authors, identifiers) in enumerate(books):
+			searches.submit(lookup, i, title, authors, identifiers)
+		for n in range(len(books)):
+			yield done.get()
+	finally:
+		abort.set()
+		searches.shutdown()
+
+def write_batch(plugin, log, books, output, concurrency=4, covers=False, cover_dir=None,
+		report=None, timeout=30):
+	'''
+	Run run_batch and stream its results to the file object output, a JSON
+	object a line, with covers saved to cover_dir (if given) as
+	<index>.jpg. Returns a summary of the run: books done, books with a
+	match, errors, wall clock time, books per second and the plugin's stats.
+	'''
+	import os
+	report = report or (lambda msg: None)
+	stats.reset()
+	started = time.time()
+	n = found = errors = 0
+	abort = Event()
+	try:
+		for n, out in enumerate(run_batch(plugin, log, books, concurrency, covers, abort, timeout), 1):
+			data = out.pop('cover_data', None)
+			if covers:
+				out['cover_bytes'] = len(data) if data else 0
+				if data and cover_dir:
+					out['cover_path'] = os.path.join(cover_dir, '%d.jpg' % out['index'])
+					with open(out['cover_path'], 'wb') as f:
+						f.write(data)
+			found += bool(out.get('results'))
+			errors += 'error' in out
+			output.write(unicode(json.dumps(out, ensure_ascii=False, sort_keys=True)) + '\n')
+			output.flush()
+			report('[%d/%d] %s: %d results in %.2fs' % (n, len(books),
+				out['title'] or out['identifiers'], len(out.get('results', [])), out['seconds']))
+	except KeyboardInterrupt:
+		abort.set()
+		report('Interrupted')
+	elapsed = time.time() - started
+	return {'books': n, 'found': found, 'errors': errors, 'seconds': elapsed,
+		'books_per_second': n / max(elapsed, 0.001), 'stats': stats.snapshot()}
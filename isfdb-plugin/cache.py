@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, sys, time, json, zlib, sqlite3
+from collections import OrderedDict
+from threading import RLock
+
+from calibre.constants import config_dir
+
+from calibre_plugins.isfdb.stats import stats
+
+# Lives next to the plugin's JSON preferences (plugins/ISFDB.json).
+DEFAULT_CACHE_PATH = os.path.join(config_dir, 'plugins', 'ISFDB.sqlite')
+
+RECORD_FIELDS = ('isfdb_id', 'isbn', 'title', 'authors', 'publisher', 'pubdate', 'comments', 'cover_url')
+# Shared by all editions of a work, from its title record
+WORK_FIELDS = ('series', 'series_index', 'tags')
+# Publication types whose credits ISFDB lists under "Editors", for the
+# backends that see the type rather than the page
+EDITED_TYPES = ('ANTHOLOGY', 'MAGAZINE', 'FANZINE')
+
+# A max_age for records that are wanted however old they are
+ANY_AGE = float('inf')
+
+# Memory for the in-process caches, which a long bulk download would
+# otherwise grow without limit
+IDENTIFIER_CACHE_BYTES = 2 * 1024 * 1024
+COVER_URL_CACHE_BYTES = 4 * 1024 * 1024
+RECORD_CACHE_BYTES = 8 * 1024 * 1024
+# Roughly what an OrderedDict entry costs over its key and value
+ENTRY_OVERHEAD = 200
+
+def isbn_forms(isbn):
+	'''
+	The ISBN-10 and ISBN-13 forms of a valid ISBN, as check_isbn returns
+	it. ISBN-13s with a prefix other than 978 have no ISBN-10.
+	'''
+	if len(isbn) == 10:
+		body = '978' + isbn[:9]
+		check = (10 - sum((3 if i % 2 else 1) * int(d) for i, d in enumerate(body)) % 10) % 10
+		return [isbn, body + unicode(check)]
+	if isbn.startswith('978'):
+		body = isbn[3:12]
+		check = (11 - sum((10 - i) * int(d) for i, d in enumerate(body)) % 11) % 11
+		return [isbn, body + ('X' if check == 10 else unicode(check))]
+	return [isbn]
+
+class Record(object):
+
+	'''
+	A publication record as the cache keeps it: the fields of a record
+	dict (see RECORD_FIELDS) in slots, with the comments HTML compressed
+	until asked for. Reads like a (read-only) record dict.
+	'''
+
+	__slots__ = ('isfdb_id', 'isbn', 'title', 'authors', 'publisher', 'pubdate', 'cover_url',
+		'packed_comments', 'fetched')
+
+	def __init__(self, record, fetched=None):
+		for f in RECORD_FIELDS:
+			if f != 'comments':
+				setattr(self, f, record.get(f))
+		self.authors = tuple(self.authors or ())
+		if isinstance(record, Record):
+			self.packed_comments = record.packed_comments
+		else:
+			self.packed_comments = pack_comments(record.get('comments'))
+		self.fetched = fetched
+
+	@property
+	def comments(self):
+		return unpack_comments(self.packed_comments)
+
+	@property
+	def nbytes(self):
+		return sys.getsizeof(self) + sum(sys.getsizeof(getattr(self, f)) for f in self.__slots__) + \
+			sum(sys.getsizeof(a) for a in self.authors)
+
+	def __getitem__(self, key):
+		if key not in RECORD_FIELDS:
+			raise KeyError(key)
+		if key == 'authors':
+			return list(self.authors)
+		return getattr(self, key)
+
+	def get(self, key, default=None):
+		return self[key] if key in RECORD_FIELDS else default
+
+	def __contains__(self, key):
+		return key in RECORD_FIELDS
+
+	def keys(self):
+		return list(RECORD_FIELDS)
+
+def pack_comments(html):
+	if html:
+		return zlib.compress(html.encode('utf-8'))
+
+def unpack_comments(data):
+	if data is None:
+		return None
+	if isinstance(data, unicode): # stored by an older version
+		return data
+	return zlib.decompress(bytes(data)).decode('utf-8')
+
+def entry_size(key, value):
+	return ENTRY_OVERHEAD + sys.getsizeof(key) + (value.nbytes if isinstance(value, Record) else sys.getsizeof(value))
+
+class LRUCache(object):
+
+	'''
+	A dict-like map holding at most max_bytes worth of entries (as sized
+	by entry_size), dropping the least recently used to make room. Safe
+	to share between threads.
+	'''
+
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.entries = OrderedDict() # key -> (value, size), oldest first
+		self.nbytes = 0
+		self.lock = RLock()
+
+	def get(self, key, default=None):
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is None:
+				return default
+			self.entries[key] = entry
+			return entry[0]
+
+	def __getitem__(self, key):
+		with self.lock:
+			if key not in self.entries:
+				raise KeyError(key)
+			return self.get(key)
+
+	def __setitem__(self, key, value):
+		size = entry_size(key, value)
+		with self.lock:
+			self.pop(key)
+			if size > self.max_bytes:
+				return
+			self.entries[key] = (value, size)
+			self.nbytes += size
+			while self.nbytes > self.max_bytes:
+				k, (v, s) = self.entries.popitem(last=False)
+				self.nbytes -= s
+				stats.count('lru_evictions')
+
+	def pop(self, key, default=None):
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is None:
+				return default
+			self.nbytes -= entry[1]
+			return entry[0]
+
+	def __contains__(self, key):
+		with self.lock:
+			return key in self.entries
+
+	def __len__(self):
+		with self.lock:
+			return len(self.entries)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.nbytes = 0
+
+	# The rest of the dict interface calibre's Source uses on its caches
+	# (dump_caches, load_caches, get_related_isbns). None of it counts as a
+	# use of the entries.
+
+	def copy(self):
+		'''
+		A plain OrderedDict of the entries, least recently used first.
+		'''
+		with self.lock:
+			return OrderedDict((key, entry[0]) for key, entry in self.entries.iteritems())
+
+	def update(self, other=(), **kwargs):
+		items = other.items() if hasattr(other, 'items') else other
+		with self.lock:
+			for key, value in items:
+				self[key] = value
+			for key, value in kwargs.items():
+				self[key] = value
+
+	def items(self):
+		with self.lock:
+			return [(key, entry[0]) for key, entry in self.entries.iteritems()]
+
+	def iteritems(self):
+		# Over a snapshot, so other threads can go on using the cache
+		return iter(self.items())
+
+	def keys(self):
+		with self.lock:
+			return list(self.entries)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS publications (
+	isfdb_id TEXT PRIMARY KEY,
+	isbn TEXT,
+	title TEXT NOT NULL,
+	authors TEXT NOT NULL,
+	publisher TEXT,
+	pubdate TEXT,
+	comments TEXT,
+	cover_url TEXT,
+	fetched REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS publications_isbn ON publications (isbn);
+CREATE TABLE IF NOT EXISTS isbn_to_identifier (
+	isbn TEXT PRIMARY KEY,
+	isfdb_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS identifier_to_cover_url (
+	isfdb_id TEXT PRIMARY KEY,
+	cover_url TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS missing (
+	query TEXT PRIMARY KEY,
+	checked REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS validators (
+	url TEXT PRIMARY KEY,
+	etag TEXT,
+	last_modified TEXT,
+	isfdb_ids TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS identifier_to_title (
+	isfdb_id TEXT PRIMARY KEY,
+	title_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS titles (
+	title_id TEXT PRIMARY KEY,
+	series TEXT,
+	series_index REAL,
+	tags TEXT NOT NULL,
+	fetched REAL NOT NULL
+);
+'''
+
+class MetadataCache(object):
+
+	'''
+	Persistent store of parsed ISFDB publication records.
+
+	A record is a plain dict with the keys in RECORD_FIELDS; authors is a
+	list and pubdate is the raw ISFDB date text (e.g. 2008-08-00). Records
+	are looked up by ISFDB id, found from an ISBN through the ISBN to ISFDB
+	id map, and are only returned while they are younger than the caller's
+	max_age (in seconds).
+
+	Recently used records are also kept in memory, as compact Records, up
+	to RECORD_CACHE_BYTES. Comments are stored compressed.
+
+	For pages that came with an ETag or Last-Modified header, it keeps
+	those validators and the ids of the records read from the page, so an
+	expired record can be revalidated rather than downloaded again.
+
+	It also remembers search queries that ISFDB had no match for, again
+	only for as long as the caller's max_age, and the work level data
+	(WORK_FIELDS) of title records, keyed by title id.
+	'''
+
+	def __init__(self, path=DEFAULT_CACHE_PATH):
+		self.path = path
+		self.lock = RLock()
+		self._conn = None
+		self.recent = LRUCache(RECORD_CACHE_BYTES)
+
+	@property
+	def conn(self):
+		# This must only be called once we have the lock
+		if self._conn is None:
+			dirname = os.path.dirname(self.path)
+			if dirname and not os.path.exists(dirname):
+				os.makedirs(dirname)
+			self._conn = sqlite3.connect(self.path, check_same_thread=False)
+			self._conn.executescript(SCHEMA)
+		return self._conn
+
+	def get(self, isfdb_id, max_age):
+		record = self.recent.get(isfdb_id)
+		if record is not None and max_age > 0 and record.fetched >= time.time() - max_age:
+			return record
+		return self._get('isfdb_id', isfdb_id, max_age)
+
+	def _get(self, column, value, max_age):
+		if not value or max_age <= 0:
+			return None
+		with self.lock:
+			row = self.conn.execute(
+				'SELECT %s, fetched FROM publications WHERE %s = ? AND fetched >= ?' %
+				(', '.join(RECORD_FIELDS), column), (value, time.time() - max_age)).fetchone()
+		if row is None:
+			return None
+		fields = dict(zip(RECORD_FIELDS, row))
+		fields['authors'] = json.loads(fields['authors'])
+		comments, fields['comments'] = fields['comments'], None
+		record = Record(fields, row[-1])
+		record.packed_comments = bytes(comments) if isinstance(comments, buffer) else comments
+		self.recent[record.isfdb_id] = record
+		return record
+
+	def put(self, record):
+		fetched = time.time()
+		record = Record(record, fetched)
+		values = [getattr(record, f) for f in RECORD_FIELDS if f != 'comments']
+		values[RECORD_FIELDS.index('authors')] = json.dumps(record.authors)
+		values.insert(RECORD_FIELDS.index('comments'), None if record.packed_comments is None else
+			sqlite3.Binary(record.packed_comments))
+		with self.lock:
+			with self.conn:
+				self.conn.execute(
+					'INSERT OR REPLACE INTO publications (%s, fetched) VALUES (%s, ?)' %
+					(', '.join(RECORD_FIELDS), ', '.join('?' * len(RECORD_FIELDS))), values + [fetched])
+		self.recent[record.isfdb_id] = record
+
+	def get_identifier(self, isbn):
+		return self._get_mapping('isbn_to_identifier', 'isbn', 'isfdb_id', isbn)
+
+	def put_identifier(self, isbn, isfdb_id):
+		self._put_mapping('isbn_to_identifier', 'isbn', 'isfdb_id', isbn, isfdb_id)
+
+	def get_cover_url(self, isfdb_id):
+		return self._get_mapping('identifier_to_cover_url', 'isfdb_id', 'cover_url', isfdb_id)
+
+	def put_cover_url(self, isfdb_id, url):
+		self._put_mapping('identifier_to_cover_url', 'isfdb_id', 'cover_url', isfdb_id, url)
+
+	def _get_mapping(self, table, key_column, value_column, key):
+		with self.lock:
+			row = self.conn.execute('SELECT %s FROM %s WHERE %s = ?' % (value_column, table, key_column),
+				(key,)).fetchone()
+		if row is not None:
+			return row[0]
+
+	def _put_mapping(self, table, key_column, value_column, key, value):
+		with self.lock:
+			with self.conn:
+				self.conn.execute('INSERT OR REPLACE INTO %s (%s, %s) VALUES (?, ?)' % (table, key_column, value_column),
+					(key, value))
+
+	def get_validators(self, url):
+		'''
+		(etag, last_modified) as sent with the page at url, or None.
+		'''
+		with self.lock:
+			return self.conn.execute('SELECT etag, last_modified FROM validators WHERE url = ?',
+				(url,)).fetchone()
+
+	def put_validators(self, url, etag, last_modified, isfdb_ids):
+		with self.lock:
+			with self.conn:
+				if etag or last_modified:
+					self.conn.execute('INSERT OR REPLACE INTO validators (url, etag, last_modified, isfdb_ids) '
+						'VALUES (?, ?, ?, ?)', (url, etag, last_modified, json.dumps(isfdb_ids)))
+				else:
+					self.conn.execute('DELETE FROM validators WHERE url = ?', (url,))
+
+	def revalidate(self, url):
+		'''
+		The server says the page at url has not changed: return the records
+		read from it, as fresh as if just fetched, or None if they are no
+		longer all in the cache.
+		'''
+		with self.lock:
+			row = self.conn.execute('SELECT isfdb_ids FROM validators WHERE url = ?', (url,)).fetchone()
+			if row is None:
+				return None
+			records = [self.get(isfdb_id, ANY_AGE) for isfdb_id in json.loads(row[0])]
+			if not records or None in records:
+				return None
+			fetched = time.time()
+			with self.conn:
+				self.conn.executemany('UPDATE publications SET fetched = ? WHERE isfdb_id = ?',
+					[(fetched, r.isfdb_id) for r in records])
+			for record in records:
+				record.fetched = fetched
+				self.recent[record.isfdb_id] = record
+			return records
+
+	def get_title_id(self, isfdb_id):
+		return self._get_mapping('identifier_to_title', 'isfdb_id', 'title_id', isfdb_id)
+
+	def put_title_id(self, isfdb_id, title_id):
+		self._put_mapping('identifier_to_title', 'isfdb_id', 'title_id', isfdb_id, title_id)
+
+	def get_title(self, title_id, max_age):
+		if not title_id or max_age <= 0:
+			return None
+		with self.lock:
+			row = self.conn.execute('SELECT %s FROM titles WHERE title_id = ? AND fetched >= ?' %
+				', '.join(WORK_FIELDS), (title_id, time.time() - max_age)).fetchone()
+		if row is None:
+			return None
+		work = dict(zip(WORK_FIELDS, row))
+		work['tags'] = json.loads(work['tags'])
+		return work
+
+	def put_title(self, title_id, work):
+		values = [work.get(f) for f in WORK_FIELDS]
+		values[WORK_FIELDS.index('tags')] = json.dumps(work.get('tags') or [])
+		with self.lock:
+			with self.conn:
+				self.conn.execute('INSERT OR REPLACE INTO titles (title_id, %s, fetched) VALUES (?, %s, ?)' %
+					(', '.join(WORK_FIELDS), ', '.join('?' * len(WORK_FIELDS))), [title_id] + values + [time.time()])
+
+	def is_missing(self, query, max_age):
+		if not query or max_age <= 0:
+			return False
+		with self.lock:
+			row = self.conn.execute('SELECT 1 FROM missing WHERE query = ? AND checked >= ?',
+				(query, time.time() - max_age)).fetchone()
+		return row is not None
+
+	def put_missing(self, query):
+		with self.lock:
+			with self.conn:
+				self.conn.execute('INSERT OR REPLACE INTO missing (query, checked) VALUES (?, ?)',
+					(query, time.time()))
+
+	def purge(self, max_age, missing_max_age=None):
+		'''
+		Drop records and title data older than max_age, the validators of
+		pages whose records are gone and, if missing_max_age is given,
+		misses older than that.
+		'''
+		with self.lock:
+			with self.conn:
+				self.conn.execute('DELETE FROM publications WHERE fetched < ?', (time.time() - max_age,))
+				self.recent.clear()
+				self.conn.execute('DELETE FROM titles WHERE fetched < ?', (time.time() - max_age,))
+				if missing_max_age is not None:
+					self.conn.execute('DELETE FROM missing WHERE checked < ?', (time.time() - missing_max_age,))
+				kept = set(row[0] for row in self.conn.execute('SELECT isfdb_id FROM publications'))
+				stale = [(url,) for url, isfdb_ids in self.conn.execute('SELECT url, isfdb_ids FROM validators')
+					if not kept.issuperset(json.loads(isfdb_ids))]
+				self.conn.executemany('DELETE FROM validators WHERE url = ?', stale)
+
+	def purge_expired(self):
+		'''
+		Purge what has outlived the plugin's KEY_CACHE_TTL and
+		KEY_MISSING_TTL, keeping everything the TTL of which is 0 (turned
+		off) so that turning the cache back on finds it as it was.
+		'''
+		import calibre_plugins.isfdb.config as cfg
+		day = 24 * 60 * 60
+		ttl, missing_ttl = cfg.get_option(cfg.KEY_CACHE_TTL), cfg.get_option(cfg.KEY_MISSING_TTL)
+		self.purge(ttl * day if ttl > 0 else ANY_AGE, missing_ttl * day if missing_ttl > 0 else None)
+
+_cache = None
+_cache_lock = RLock()
+
+def open_cache(path):
+	'''
+	Switch the process-wide cache to another database file, purging what
+	has expired from it.
+	'''
+	global _cache
+	with _cache_lock:
+		_cache = MetadataCache(path)
+		_cache.purge_expired()
+		return _cache
+
+def get_cache():
+	'''
+	Return the process-wide cache. Calibre may create several instances of
+	the plugin, but they all share the one database connection. Expired
+	entries are purged when it is first opened, so that the file does not
+	grow without limit.
+	'''
+	global _cache
+	with _cache_lock:
+		if _cache is None:
+			_cache = MetadataCache()
+			_cache.purge_expired()
+		return _cache
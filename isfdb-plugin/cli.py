@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import argparse
+
+from calibre import prints
+
+def build_index(plugin, opts):
+	from calibre_plugins.isfdb.offline import build_index, DEFAULT_INDEX_PATH
+	index_path = opts.index or DEFAULT_INDEX_PATH
+	count = build_index(opts.dump, index_path, report=prints)
+	prints('Indexed %d publications into %s' % (count, index_path))
+
+def prewarm(plugin, opts):
+	import io
+	import calibre_plugins.isfdb.config as cfg
+	from calibre.utils.logging import ThreadSafeLog
+	from calibre_plugins.isfdb.prewarm import prewarm, read_items
+	from calibre_plugins.isfdb.ratelimit import get_limiter
+	if cfg.get_option(cfg.KEY_CACHE_TTL) <= 0:
+		prints('The local cache is disabled in the plugin\'s options, nothing would be kept')
+		return
+	if opts.rate:
+		cfg.option_overrides[cfg.KEY_REQUESTS_PER_SECOND] = opts.rate
+		get_limiter().set_max_rate(opts.rate)
+	if opts.threads:
+		cfg.option_overrides[cfg.KEY_MAX_THREADS] = opts.threads
+	with io.open(opts.list, encoding='utf-8', errors='replace') as f:
+		items = list(read_items(f))
+	state_path = opts.state or opts.list + '.done'
+	prints('Prewarming the cache for %d books (progress is kept in %s)' % (len(items), state_path))
+	found, not_found, skipped = prewarm(plugin, ThreadSafeLog(level=ThreadSafeLog.ERROR), items,
+			budget=opts.budget, state_path=state_path, report=prints, timeout=opts.timeout)
+	prints('%d books cached, %d not found, %d done earlier' % (found, not_found, skipped))
+
+def identify(plugin, opts):
+	import io, json, os, sys
+	import calibre_plugins.isfdb.config as cfg
+	from calibre.utils.logging import ThreadSafeLog
+	from calibre_plugins.isfdb.batch import read_books, write_batch
+	from calibre_plugins.isfdb.ratelimit import get_limiter
+	if opts.base_url:
+		plugin.set_base_url(opts.base_url)
+	if opts.max_downloads is not None:
+		cfg.option_overrides[cfg.KEY_MAX_DOWNLOADS] = opts.max_downloads
+	if opts.append_contents is not None:
+		cfg.option_overrides[cfg.KEY_APPEND_CONTENTS] = opts.append_contents
+	if opts.threads:
+		cfg.option_overrides[cfg.KEY_MAX_THREADS] = opts.threads
+	if opts.rate:
+		cfg.option_overrides[cfg.KEY_REQUESTS_PER_SECOND] = opts.rate
+		get_limiter().set_max_rate(opts.rate)
+	if opts.no_cache:
+		cfg.option_overrides[cfg.KEY_CACHE_TTL] = 0
+	if opts.cover_dir:
+		opts.covers = True
+		# Before the batch runs rather than when the first cover comes in
+		if not os.path.isdir(opts.cover_dir):
+			os.makedirs(opts.cover_dir)
+	books = read_books(opts.books)
+	# Progress goes to stderr, so that the results can go to stdout
+	report = lambda msg: prints(msg, file=sys.stderr)
+	report('Identifying %d books against %s, %d at a time' % (len(books), plugin.BASE_URL, opts.concurrency))
+	output = io.open(opts.output, 'w', encoding='utf-8') if opts.output else io.open(sys.stdout.fileno(),
+		'w', encoding='utf-8', closefd=False)
+	try:
+		summary = write_batch(plugin, ThreadSafeLog(level=ThreadSafeLog.ERROR), books, output,
+			concurrency=opts.concurrency, covers=opts.covers, cover_dir=opts.cover_dir,
+			report=report if opts.output else (lambda msg: None), timeout=opts.timeout)
+	finally:
+		output.close()
+	report('%(books)d books, %(found)d found, %(errors)d errors in %(seconds).1fs (%(books_per_second).1f books/s)' % summary)
+	counters = summary['stats']['counters']
+	report(', '.join('%s=%d' % item for item in sorted(counters.items())))
+	if opts.summary:
+		with open(opts.summary, 'wb') as f:
+			json.dump(summary, f, indent=2, sort_keys=True)
+
+def main(plugin, args):
+	'''
+	Entry point for: calibre-debug -r ISFDB -- <command> [options]
+	'''
+	parser = argparse.ArgumentParser(prog='calibre-debug -r ISFDB --')
+	commands = parser.add_subparsers(dest='command')
+
+	p = commands.add_parser('build-index', help='Build the offline index from an ISFDB database backup')
+	p.add_argument('dump', help='The MySQL backup, as a .sql or .sql.gz file')
+	p.add_argument('--index', help='Where to write the index (default: the one the plugin uses)')
+	p.set_defaults(func=build_index)
+
+	p = commands.add_parser('prewarm', help='Fill the cache for a list of books ahead of time')
+	p.add_argument('list', help='A file with a book a line: isbn:<isbn>, isfdb:<id> or a bare ISBN. '
+		'Lines in the form of calibre\'s identifiers column work too.')
+	p.add_argument('--state', help='Where to keep track of the books done, so that a run can be resumed '
+		'(default: the list file name plus .done)')
+	p.add_argument('--budget', type=int, default=0, help='Stop after about this many requests (default: no limit)')
+	p.add_argument('--rate', type=float, help='Maximum requests per second (default: as in the plugin\'s options)')
+	p.add_argument('--threads', type=int, help='Simultaneous lookups (default: as in the plugin\'s options)')
+	p.add_argument('--timeout', type=int, default=30)
+	p.set_defaults(func=prewarm)
+
+	p = commands.add_parser('identify', help='Identify a list of books and write the results as JSON lines')
+	p.add_argument('books', help='A CSV file with a header row, or a .jsonl file with a JSON object a line. '
+		'The fields are title, authors (separated by &), identifiers (isbn:...,isfdb:...), isbn and isfdb.')
+	p.add_argument('-o', '--output', help='Where to write the results (default: stdout)')
+	p.add_argument('--concurrency', type=int, default=4, help='Books identified at a time (default: 4)')
+	p.add_argument('--covers', action='store_true', help='Download each book\'s cover as well')
+	p.add_argument('--cover-dir', help='Save the covers to this directory, creating it if need be (implies --covers)')
+	p.add_argument('--max-downloads', type=int, help='Override the plugin\'s maximum number of details pages per book')
+	p.add_argument('--append-contents', dest='append_contents', action='store_true', default=None,
+		help='Add the contents list to the comments')
+	p.add_argument('--no-append-contents', dest='append_contents', action='store_false')
+	p.add_argument('--threads', type=int, help='Simultaneous details downloads (default: as in the plugin\'s options)')
+	p.add_argument('--rate', type=float, help='Maximum requests per second (default: as in the plugin\'s options)')
+	p.add_argument('--no-cache', action='store_true', help='Ignore the plugin\'s cache')
+	p.add_argument('--base-url', help='Use this server instead of isfdb.org, e.g. the benchmarks\' stand-in')
+	p.add_argument('--summary', help='Also write a summary of the run, with the plugin\'s stats, to this JSON file')
+	p.add_argument('--timeout', type=int, default=30)
+	p.set_defaults(func=identify)
+
+	opts = parser.parse_args(args)
+	opts.func(plugin, opts)
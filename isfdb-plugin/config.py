@@ -12,19 +12,48 @@ try:
 except ImportError:
 	from PyQt4 import QtGui
 try:
-	from PyQt5.Qt import QLabel, QGridLayout, Qt, QGroupBox, QCheckBox
+	from PyQt5.Qt import QLabel, QGridLayout, Qt, QGroupBox, QCheckBox, QComboBox, QLineEdit
 except ImportError:
-	from PyQt4.Qt import QLabel, QGridLayout, Qt, QGroupBox, QCheckBox
+	from PyQt4.Qt import QLabel, QGridLayout, Qt, QGroupBox, QCheckBox, QComboBox, QLineEdit
 from calibre.gui2.metadata.config import ConfigWidget as DefaultConfigWidget
 from calibre.utils.config import JSONConfig
 
 STORE_NAME = 'Options'
 KEY_MAX_DOWNLOADS = 'maxDownloads'
 KEY_APPEND_CONTENTS = 'appendContents'
+KEY_CACHE_TTL = 'cacheTTL'
+KEY_MAX_THREADS = 'maxThreads'
+KEY_REQUESTS_PER_SECOND = 'requestsPerSecond'
+KEY_BACKEND = 'backend'
+KEY_OFFLINE_INDEX = 'offlineIndex'
+KEY_PARALLEL_QUERIES = 'parallelQueries'
+KEY_MISSING_TTL = 'missingTTL'
+KEY_EVENT_LOOP = 'eventLoop'
+KEY_TITLE_DETAILS = 'titleDetails'
+KEY_EVENT_LOOP_CONNECTIONS = 'eventLoopConnections'
+
+BACKEND_HTML = 'html'
+BACKEND_XML = 'xml'
+BACKEND_OFFLINE = 'offline'
+BACKENDS = [
+	(BACKEND_HTML, 'ISFDB web pages'),
+	(BACKEND_XML, 'ISFDB XML web API'),
+	(BACKEND_OFFLINE, 'Local index of an ISFDB database backup')
+]
 
 DEFAULT_STORE_VALUES = {
 	KEY_MAX_DOWNLOADS: 1,
-	KEY_APPEND_CONTENTS: False
+	KEY_APPEND_CONTENTS: False,
+	KEY_CACHE_TTL: 30,
+	KEY_MAX_THREADS: 4,
+	KEY_REQUESTS_PER_SECOND: 2.0,
+	KEY_BACKEND: BACKEND_HTML,
+	KEY_OFFLINE_INDEX: '',
+	KEY_PARALLEL_QUERIES: False,
+	KEY_MISSING_TTL: 7,
+	KEY_EVENT_LOOP: False,
+	KEY_TITLE_DETAILS: False,
+	KEY_EVENT_LOOP_CONNECTIONS: 32
 }
 
 # This is where all preferences for this plugin will be stored.
@@ -33,6 +62,28 @@ plugin_prefs = JSONConfig('plugins/ISFDB')
 # Set defaults.
 plugin_prefs.defaults[STORE_NAME] = DEFAULT_STORE_VALUES
 
+# Values that apply to this process only, e.g. for benchmark or command line
+# runs. They take precedence over the saved options but are never saved.
+option_overrides = {}
+
+def get_option(key):
+	'''
+	Options saved by older versions of the plugin may lack newer keys.
+	'''
+	if key in option_overrides:
+		return option_overrides[key]
+	return plugin_prefs[STORE_NAME].get(key, DEFAULT_STORE_VALUES[key])
+
+def apply_options(prefs):
+	'''
+	Put the options that need no restart into effect for downloads already
+	under way.
+	'''
+	from calibre_plugins.isfdb.ratelimit import get_limiter
+	from calibre_plugins.isfdb.engine import get_loop
+	get_limiter().set_max_rate(prefs[KEY_REQUESTS_PER_SECOND])
+	get_loop().set_max_per_host(prefs[KEY_EVENT_LOOP_CONNECTIONS])
+
 class ConfigWidget(DefaultConfigWidget):
 	def __init__(self, plugin):
 		DefaultConfigWidget.__init__(self, plugin)
@@ -65,9 +116,118 @@ class ConfigWidget(DefaultConfigWidget):
 		self.contents_checkbox.setChecked(c.get(KEY_APPEND_CONTENTS, DEFAULT_STORE_VALUES[KEY_APPEND_CONTENTS]))
 		other_group_box_layout.addWidget(self.contents_checkbox, 2, 0, 1, 3)
 
+		# Local cache of downloaded records.
+		ttl_label = QLabel('Days to keep downloaded records in the local cache (0 = disabled):', self)
+		ttl_label.setToolTip('Publication records fetched from ISFDB are stored on disk and reused\n'
+							 'without contacting ISFDB until they are older than this.')
+		other_group_box_layout.addWidget(ttl_label, 3, 0, 1, 1)
+		self.cache_ttl_spin = QtGui.QSpinBox(self)
+		self.cache_ttl_spin.setMinimum(0)
+		self.cache_ttl_spin.setMaximum(3650)
+		self.cache_ttl_spin.setProperty('value', c.get(KEY_CACHE_TTL, DEFAULT_STORE_VALUES[KEY_CACHE_TTL]))
+		other_group_box_layout.addWidget(self.cache_ttl_spin, 3, 1, 1, 1)
+
+		# Size of the shared download pool.
+		threads_label = QLabel('Maximum simultaneous ISFDB page downloads:', self)
+		threads_label.setToolTip('Shared by all metadata download jobs. Takes effect after\n'
+								 'restarting calibre.')
+		other_group_box_layout.addWidget(threads_label, 4, 0, 1, 1)
+		self.max_threads_spin = QtGui.QSpinBox(self)
+		self.max_threads_spin.setMinimum(1)
+		self.max_threads_spin.setMaximum(16)
+		self.max_threads_spin.setProperty('value', c.get(KEY_MAX_THREADS, DEFAULT_STORE_VALUES[KEY_MAX_THREADS]))
+		other_group_box_layout.addWidget(self.max_threads_spin, 4, 1, 1, 1)
+
+		# Global request rate.
+		rate_label = QLabel('Maximum requests per second to ISFDB:', self)
+		rate_label.setToolTip('Shared by all metadata and cover download jobs. The plugin slows\n'
+							  'down further on its own if ISFDB starts timing out or refusing requests.')
+		other_group_box_layout.addWidget(rate_label, 5, 0, 1, 1)
+		self.rate_spin = QtGui.QDoubleSpinBox(self)
+		self.rate_spin.setMinimum(0.1)
+		self.rate_spin.setMaximum(20)
+		self.rate_spin.setSingleStep(0.5)
+		self.rate_spin.setProperty('value', c.get(KEY_REQUESTS_PER_SECOND, DEFAULT_STORE_VALUES[KEY_REQUESTS_PER_SECOND]))
+		other_group_box_layout.addWidget(self.rate_spin, 5, 1, 1, 1)
+
+		# Where publication records come from.
+		backend_label = QLabel('Read publication records from:', self)
+		backend_label.setToolTip('The XML web API returns a whole publication record for an ISBN in a\n'
+								 'single, smaller response. Title/author searches always use the web pages.')
+		other_group_box_layout.addWidget(backend_label, 6, 0, 1, 1)
+		self.backend_combo = QComboBox(self)
+		for key, text in BACKENDS:
+			self.backend_combo.addItem(text, key)
+		backend = c.get(KEY_BACKEND, DEFAULT_STORE_VALUES[KEY_BACKEND])
+		self.backend_combo.setCurrentIndex([key for key, text in BACKENDS].index(backend))
+		other_group_box_layout.addWidget(self.backend_combo, 6, 1, 1, 1)
+
+		# Location of the offline index.
+		index_label = QLabel('Local index file (blank = default location):', self)
+		index_label.setToolTip('Build it from an ISFDB database backup with:\n'
+							   'calibre-debug -r ISFDB -- build-index <backup.sql>')
+		other_group_box_layout.addWidget(index_label, 7, 0, 1, 1)
+		self.index_edit = QLineEdit(self)
+		self.index_edit.setText(c.get(KEY_OFFLINE_INDEX, DEFAULT_STORE_VALUES[KEY_OFFLINE_INDEX]))
+		other_group_box_layout.addWidget(self.index_edit, 7, 1, 1, 2)
+
+		# Title/author query alongside the ISBN one.
+		self.parallel_checkbox = QCheckBox('Send the title/author search together with the ISBN search', self)
+		self.parallel_checkbox.setToolTip('Saves a round trip when ISFDB does not know the ISBN, at the cost\n'
+										  'of a search request that is not needed when it does.')
+		self.parallel_checkbox.setChecked(c.get(KEY_PARALLEL_QUERIES, DEFAULT_STORE_VALUES[KEY_PARALLEL_QUERIES]))
+		other_group_box_layout.addWidget(self.parallel_checkbox, 8, 0, 1, 3)
+
+		# Remembered failed searches.
+		missing_label = QLabel('Days to remember books ISFDB does not have (0 = disabled):', self)
+		missing_label.setToolTip('ISBN and title/author searches that found nothing are not repeated\n'
+								 'until they are older than this.')
+		other_group_box_layout.addWidget(missing_label, 9, 0, 1, 1)
+		self.missing_ttl_spin = QtGui.QSpinBox(self)
+		self.missing_ttl_spin.setMinimum(0)
+		self.missing_ttl_spin.setMaximum(365)
+		self.missing_ttl_spin.setProperty('value', c.get(KEY_MISSING_TTL, DEFAULT_STORE_VALUES[KEY_MISSING_TTL]))
+		other_group_box_layout.addWidget(self.missing_ttl_spin, 9, 1, 1, 1)
+
+		# Downloads made without a thread each.
+		self.event_loop_checkbox = QCheckBox('Download pages and covers on a single network thread', self)
+		self.event_loop_checkbox.setToolTip('Keeps many downloads in flight at once during bulk downloads, leaving\n'
+											'the download threads free for parsing. Not used through a proxy.')
+		self.event_loop_checkbox.setChecked(c.get(KEY_EVENT_LOOP, DEFAULT_STORE_VALUES[KEY_EVENT_LOOP]))
+		other_group_box_layout.addWidget(self.event_loop_checkbox, 10, 0, 1, 3)
+
+		# Work level metadata.
+		self.title_details_checkbox = QCheckBox('Download series and tags from the title record', self)
+		self.title_details_checkbox.setToolTip('One more page per book, shared by all of its editions and kept in the\n'
+											   'local cache like the publication records.')
+		self.title_details_checkbox.setChecked(c.get(KEY_TITLE_DETAILS, DEFAULT_STORE_VALUES[KEY_TITLE_DETAILS]))
+		other_group_box_layout.addWidget(self.title_details_checkbox, 11, 0, 1, 3)
+
+		# Connections of the network thread.
+		connections_label = QLabel('Connections to ISFDB on the network thread:', self)
+		connections_label.setToolTip('Downloads beyond this many wait their turn without taking up a thread.\n'
+									 'The requests per second limit still applies.')
+		other_group_box_layout.addWidget(connections_label, 12, 0, 1, 1)
+		self.connections_spin = QtGui.QSpinBox(self)
+		self.connections_spin.setMinimum(1)
+		self.connections_spin.setMaximum(256)
+		self.connections_spin.setProperty('value', c.get(KEY_EVENT_LOOP_CONNECTIONS, DEFAULT_STORE_VALUES[KEY_EVENT_LOOP_CONNECTIONS]))
+		other_group_box_layout.addWidget(self.connections_spin, 12, 1, 1, 1)
+
 	def commit(self):
 		DefaultConfigWidget.commit(self)
-		new_prefs = {}
+		new_prefs = dict(plugin_prefs[STORE_NAME])
 		new_prefs[KEY_MAX_DOWNLOADS] = int(unicode(self.max_downloads_spin.value()))
 		new_prefs[KEY_APPEND_CONTENTS] = self.contents_checkbox.checkState() == Qt.Checked
+		new_prefs[KEY_CACHE_TTL] = int(unicode(self.cache_ttl_spin.value()))
+		new_prefs[KEY_MAX_THREADS] = int(unicode(self.max_threads_spin.value()))
+		new_prefs[KEY_REQUESTS_PER_SECOND] = float(self.rate_spin.value())
+		new_prefs[KEY_BACKEND] = BACKENDS[self.backend_combo.currentIndex()][0]
+		new_prefs[KEY_OFFLINE_INDEX] = unicode(self.index_edit.text()).strip()
+		new_prefs[KEY_PARALLEL_QUERIES] = self.parallel_checkbox.checkState() == Qt.Checked
+		new_prefs[KEY_MISSING_TTL] = int(unicode(self.missing_ttl_spin.value()))
+		new_prefs[KEY_EVENT_LOOP] = self.event_loop_checkbox.checkState() == Qt.Checked
+		new_prefs[KEY_TITLE_DETAILS] = self.title_details_checkbox.checkState() == Qt.Checked
+		new_prefs[KEY_EVENT_LOOP_CONNECTIONS] = int(unicode(self.connections_spin.value()))
+		apply_options(new_prefs)
 		plugin_prefs[STORE_NAME] = new_prefs
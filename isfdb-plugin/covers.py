@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import re, struct
+
+from calibre_plugins.isfdb.stats import stats
+
+# How much of an image to read looking for its dimensions. JPEGs with a
+# large EXIF block can keep them further in than this; they are ranked by
+# file size alone.
+PROBE_BYTES = 16 * 1024
+
+# JPEG start of frame markers, which carry the dimensions
+JPEG_SOF = frozenset(range(0xc0, 0xd0)) - frozenset([0xc4, 0xc8, 0xcc])
+
+def image_size(data):
+	'''
+	(width, height) of the JPEG, PNG or GIF whose first bytes are data, or
+	None if they do not say.
+	'''
+	if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR' and len(data) >= 24:
+		return struct.unpack(b'>II', data[16:24])
+	if data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 10:
+		return struct.unpack(b'<HH', data[6:10])
+	if data[:2] != b'\xff\xd8':
+		return None
+	i = 2
+	while i + 4 <= len(data):
+		if data[i] != b'\xff':
+			return None
+		marker = ord(data[i+1])
+		if marker == 0xff: # fill byte
+			i += 1
+			continue
+		if marker == 0x01 or 0xd0 <= marker <= 0xd8: # no length
+			i += 2
+			continue
+		if marker in JPEG_SOF:
+			if i + 9 > len(data):
+				return None
+			height, width = struct.unpack(b'>HH', data[i+5:i+9])
+			return width, height
+		i += 2 + struct.unpack(b'>H', data[i+2:i+4])[0]
+	return None
+
+class CoverProbe(object):
+
+	'''
+	What the start of a cover image says about it: its dimensions if found,
+	its size in bytes if known, and the whole image if it was small enough
+	(or the server ignored the range) to come down in one go.
+	'''
+
+	def __init__(self, url):
+		self.url = url
+		self.width = self.height = self.size = 0
+		self.data = None
+
+	@property
+	def area(self):
+		return self.width * self.height
+
+def probe_cover(session, url, timeout):
+	'''
+	Read just enough of the image at url to learn its dimensions, asking
+	for the first PROBE_BYTES only. Returns a CoverProbe.
+	'''
+	chunks = []
+	stopped = []
+	def consumer(data):
+		# Only called for a 200, when the server sends the whole image
+		chunks.append(data)
+		if image_size(b''.join(chunks)) is not None or sum(map(len, chunks)) >= PROBE_BYTES:
+			stopped.append(True)
+			return True
+	with stats.timer('cover_probe'):
+		response = session.open(url, timeout=timeout, consumer=consumer, headers=probe_headers())
+	return read_probe(url, response, bool(stopped))
+
+def probe_headers():
+	return {'Range': 'bytes=0-%d' % (PROBE_BYTES - 1)}
+
+def read_probe(url, response, stopped=False):
+	'''
+	The CoverProbe for the response to a probe of url, stopped if the
+	consumer cut a 200 short.
+	'''
+	probe = CoverProbe(url)
+	data = response.read()
+	size = image_size(data)
+	if size is not None:
+		probe.width, probe.height = size
+	headers = response.info()
+	content_range = re.search(r'/(\d+)$', headers.get('content-range', ''))
+	if response.getcode() == 206 and content_range is not None:
+		probe.size = int(content_range.group(1))
+		if len(data) == probe.size:
+			probe.data = data
+	elif response.getcode() == 200 and not stopped:
+		probe.size, probe.data = len(data), data
+	elif headers.get('content-length', '').isdigit() and not headers.get('content-encoding'):
+		probe.size = int(headers['content-length'])
+	return probe
+
+def largest_cover(log, session, urls, timeout, event_loop=False):
+	'''
+	Probe the cover images at urls in parallel and return the CoverProbe
+	of the biggest, by dimensions and then file size. Ties go to the
+	earlier url. None if none of them could be read. With event_loop the
+	probes are made on the event loop (see Session.open_async) instead of
+	the shared pool; an image sent whole despite the range is then read
+	in full.
+	'''
+	from calibre_plugins.isfdb.pool import get_flights, get_pool, submit_future
+	if event_loop:
+		futures = [session.open_async(url, timeout=timeout, headers=probe_headers()) for url in urls]
+	else:
+		flights = get_flights()
+		futures = [submit_future(get_pool(), flights.do, ('probe', url), probe_cover, session, url, timeout)
+			for url in urls]
+	best = None
+	for url, future in zip(urls, futures):
+		try:
+			result = future.result(timeout)
+			probe = read_probe(url, result) if event_loop else result
+		except:
+			log.exception('Failed to probe cover: %s' % url)
+			continue
+		log.info('Cover %s: %dx%d, %d bytes' % (url, probe.width, probe.height, probe.size))
+		if best is None or (probe.area, probe.size) > (best.area, best.size):
+			best = probe
+	return best
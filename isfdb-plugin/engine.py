@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import ssl, time, errno, socket, select, traceback
+from collections import deque
+from threading import Thread, RLock
+from urlparse import urlsplit
+
+from calibre_plugins.isfdb.stats import stats
+
+IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, 10035) # 10035: WSAEWOULDBLOCK
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, 10035)
+RECV_SIZE = 64 * 1024
+# Like a browser, never open more connections than this to one host
+MAX_CONNECTIONS_PER_HOST = 6
+
+def _socketpair():
+	'''
+	A connected pair of sockets, used to wake the loop from other threads.
+	Windows has neither socket.socketpair nor select on pipes.
+	'''
+	if hasattr(socket, 'socketpair'):
+		return socket.socketpair()
+	listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	try:
+		listener.bind(('127.0.0.1', 0))
+		listener.listen(1)
+		a = socket.create_connection(listener.getsockname())
+		b = listener.accept()[0]
+	finally:
+		listener.close()
+	return a, b
+
+class ResponseParser(object):
+
+	'''
+	Incremental parser for an HTTP/1.1 response: feed it what arrives on
+	the socket until done is set.
+	'''
+
+	def __init__(self):
+		self.buf = b''
+		self.status = self.headers = None
+		self.body = []
+		self.length = self.chunk_left = None
+		self.chunked = self.done = False
+		self.keep_alive = True
+
+	def feed(self, data):
+		self.buf += data
+		if self.headers is None:
+			end = self.buf.find(b'\r\n\r\n')
+			if end < 0:
+				return
+			head, self.buf = self.buf[:end], self.buf[end + 4:]
+			self._parse_head(head)
+		if self.chunked:
+			self._feed_chunked()
+		elif self.length is not None:
+			self.body.append(self.buf[:self.length])
+			self.length -= len(self.body[-1])
+			self.buf = b''
+			self.done = self.length <= 0
+		else:
+			# Delimited by the server closing the connection
+			self.body.append(self.buf)
+			self.buf = b''
+
+	def eof(self):
+		'''
+		The server closed the connection. Returns whether that ended a
+		complete response.
+		'''
+		if self.headers is not None and not self.chunked and self.length is None:
+			self.done = True
+		return self.done
+
+	def _parse_head(self, head):
+		lines = head.decode('iso-8859-1').split('\r\n')
+		version, status = lines[0].split(None, 2)[:2]
+		self.status = int(status)
+		self.headers = {}
+		for line in lines[1:]:
+			name, sep, value = line.partition(':')
+			if sep:
+				name, value = name.strip().lower(), value.strip()
+				self.headers[name] = self.headers[name] + ', ' + value if name in self.headers else value
+		connection = self.headers.get('connection', '').lower()
+		self.keep_alive = 'close' not in connection and (version != 'HTTP/1.0' or 'keep-alive' in connection)
+		if self.status in (204, 304) or 100 <= self.status < 200:
+			self.length = 0
+		elif 'chunked' in self.headers.get('transfer-encoding', '').lower():
+			self.chunked = True
+		elif self.headers.get('content-length', '').isdigit():
+			self.length = int(self.headers['content-length'])
+		else:
+			self.keep_alive = False
+		self.done = self.length == 0
+
+	def _feed_chunked(self):
+		while not self.done:
+			if self.chunk_left is None:
+				end = self.buf.find(b'\r\n')
+				if end < 0:
+					return
+				size = int(self.buf[:end].split(b';')[0].strip() or b'0', 16)
+				self.buf = self.buf[end + 2:]
+				self.chunk_left = size if size else -1
+			elif self.chunk_left == -1:
+				# Trailers, up to an empty line
+				end = self.buf.find(b'\r\n')
+				if end < 0:
+					return
+				line, self.buf = self.buf[:end], self.buf[end + 2:]
+				self.done = not line
+			else:
+				if self.chunk_left:
+					data = self.buf[:self.chunk_left]
+					self.body.append(data)
+					self.buf = self.buf[len(data):]
+					self.chunk_left -= len(data)
+					if self.chunk_left:
+						return
+				if len(self.buf) < 2:
+					return
+				self.buf = self.buf[2:] # the CRLF ending the chunk
+				self.chunk_left = None
+
+class Request(object):
+
+	def __init__(self, url, headers, timeout, callback):
+		parts = urlsplit(url)
+		self.url, self.callback = url, callback
+		self.scheme, self.host = parts.scheme.lower(), parts.netloc
+		path = parts.path or '/'
+		if parts.query:
+			path += '?' + parts.query
+		lines = ['GET %s HTTP/1.1' % path] + ['%s: %s' % item for item in headers.items()]
+		self.data = ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8')
+		self.timeout = timeout
+		self.deadline = None
+		self.started = self.attempt = 0
+
+	@property
+	def key(self):
+		return (self.scheme, self.host)
+
+class Connection(object):
+
+	'''
+	A non-blocking keep-alive connection owned by the loop thread.
+	'''
+
+	def __init__(self, key, sock):
+		self.key, self.sock = key, sock
+		self.state = 'connecting'
+		self.want_write = True
+		self.request = self.parser = None
+		self.out = b''
+		self.reused = False
+		self.received = 0
+
+	def fileno(self):
+		return self.sock.fileno()
+
+class EventLoop(object):
+
+	'''
+	Runs many HTTP(S) requests at once on a single thread using select(),
+	so requests in flight cost a socket rather than a waiting thread.
+	Connections are kept alive and reused per host, with at most
+	max_per_host of them open to any one host.
+
+	request() may be called from any thread. A request given a rate
+	limiter waits in the loop, not in a thread, until the limiter lets it
+	go. The callback gets (status, headers, body, error) on the loop thread
+	and so must be quick; anything slow belongs on a pool. Redirects and
+	retries are up to the caller, see Session.open_async.
+	'''
+
+	def __init__(self, name='ISFDB network', max_per_host=MAX_CONNECTIONS_PER_HOST):
+		self.name, self.max_per_host = name, max_per_host
+		self.lock = RLock()
+		self.incoming = deque()
+		self.waiting = []
+		self.active = []
+		self.idle = {}
+		self.addresses = {}
+		self.thread = None
+		self.wake_r = self.wake_w = None
+
+	def request(self, url, headers, timeout, callback, limiter=None):
+		req = Request(url, headers, timeout, callback)
+		req.limiter, req.queued = limiter, time.time()
+		with self.lock:
+			if self.thread is None:
+				self.wake_r, self.wake_w = _socketpair()
+				self.wake_r.setblocking(False)
+				self.thread = Thread(target=self._run, name=self.name)
+				self.thread.daemon = True
+				self.thread.start()
+			self.incoming.append(req)
+		self._wake()
+
+	def set_max_per_host(self, max_per_host):
+		self.max_per_host = max_per_host
+		if self.thread is not None:
+			# Start anything that was waiting for a connection
+			self._wake()
+
+	def _wake(self):
+		try:
+			self.wake_w.send(b'x')
+		except socket.error:
+			pass
+
+	def _run(self):
+		while True:
+			try:
+				self._tick()
+			except:
+				# Never let the loop die: fail whatever was in flight
+				traceback.print_exc()
+				for conn in list(self.active):
+					self._fail(conn, socket.error('ISFDB event loop error'))
+
+	def _tick(self):
+		with self.lock:
+			new, self.incoming = self.incoming, deque()
+		self.waiting.extend((0, req) for req in new)
+		if self.waiting:
+			now, waiting, self.waiting = time.time(), self.waiting, []
+			busy = {}
+			for conn in self.active:
+				busy[conn.key] = busy.get(conn.key, 0) + 1
+			for when, req in waiting:
+				if not self.idle.get(req.key) and busy.get(req.key, 0) >= self.max_per_host:
+					# Wait for one of the host's connections to finish
+					self.waiting.append((when, req))
+					continue
+				delay = 0
+				if when <= now and req.limiter is not None:
+					delay = req.limiter.try_acquire()
+				if when > now or delay:
+					self.waiting.append((max(when, now + delay), req))
+				else:
+					stats.add_time('rate_limit_wait', now - req.queued)
+					stats.count('requests')
+					self._start(req)
+					busy[req.key] = busy.get(req.key, 0) + 1
+
+		readers, writers = [self.wake_r], []
+		for conn in self.active:
+			(writers if conn.want_write else readers).append(conn)
+		for conns in self.idle.values():
+			# Only read so we notice the server closing them
+			readers.extend(conns)
+		# Requests waiting for a connection rather than the rate limiter
+		# (when is in the past) are looked at again once one finishes
+		now = time.time()
+		wakeups = [conn.request.deadline for conn in self.active] + [when for when, req in self.waiting if when > now]
+		timeout = max(0, min(wakeups) - now) if wakeups else None
+
+		try:
+			readable, writable, failed = select.select(readers, writers, writers, timeout)
+		except select.error as e:
+			if e.args[0] == errno.EINTR:
+				return
+			raise
+
+		for conn in readable:
+			if conn is self.wake_r:
+				try:
+					while self.wake_r.recv(1024):
+						pass
+				except socket.error:
+					pass
+			elif conn.request is None:
+				self._drop_idle(conn)
+			else:
+				self._step(conn)
+		for conn in set(writable) | set(failed):
+			if conn.request is not None:
+				self._step(conn)
+
+		now = time.time()
+		for conn in list(self.active):
+			if conn.request is not None and now >= conn.request.deadline:
+				stats.count('timeouts')
+				self._fail(conn, socket.timeout('timed out'), retry=False)
+
+	def _start(self, req):
+		req.attempt += 1
+		req.started = time.time()
+		req.deadline = req.started + req.timeout
+		idle = self.idle.get(req.key)
+		if idle:
+			conn = idle.pop()
+			conn.reused = True
+		else:
+			try:
+				conn = self._connect(req)
+			except Exception as e:
+				self._complete(req, None, None, None, e)
+				return
+		conn.request, conn.parser = req, ResponseParser()
+		conn.out, conn.received = req.data, 0
+		if conn.state == 'idle':
+			conn.state, conn.want_write = 'sending', True
+		self.active.append(conn)
+
+	def _connect(self, req):
+		host, sep, port = req.host.rpartition(':')
+		if not sep or not port.isdigit():
+			host, port = req.host, 443 if req.scheme == 'https' else 80
+		address = self.addresses.get((host, port))
+		if address is None:
+			family, socktype, proto, name, sockaddr = socket.getaddrinfo(host, int(port), 0, socket.SOCK_STREAM)[0]
+			address = self.addresses[(host, port)] = (family, sockaddr)
+		sock = socket.socket(address[0], socket.SOCK_STREAM)
+		sock.setblocking(False)
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		err = sock.connect_ex(address[1])
+		if err not in IN_PROGRESS:
+			sock.close()
+			raise socket.error(err, errno.errorcode.get(err, 'connect failed'))
+		conn = Connection(req.key, sock)
+		conn.host = host
+		return conn
+
+	def _step(self, conn):
+		try:
+			if conn.state == 'connecting':
+				err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+				if err:
+					raise socket.error(err, errno.errorcode.get(err, 'connect failed'))
+				if conn.key[0] == 'https':
+					conn.sock = self._wrap(conn.sock, conn.host)
+					conn.state = 'handshake'
+				else:
+					conn.state = 'sending'
+			if conn.state == 'handshake':
+				try:
+					conn.sock.do_handshake()
+				except ssl.SSLError as e:
+					if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+						conn.want_write = e.args[0] == ssl.SSL_ERROR_WANT_WRITE
+						return
+					raise
+				conn.state = 'sending'
+			if conn.state == 'sending':
+				conn.want_write = True
+				if not self._send(conn):
+					return
+				conn.state, conn.want_write = 'receiving', False
+				return
+			if conn.state == 'receiving':
+				self._receive(conn)
+		except Exception as e:
+			self._fail(conn, e)
+
+	def _wrap(self, sock, host):
+		try:
+			context = ssl.create_default_context()
+		except AttributeError: # Python < 2.7.9
+			return ssl.wrap_socket(sock, do_handshake_on_connect=False)
+		return context.wrap_socket(sock, server_hostname=host, do_handshake_on_connect=False)
+
+	def _send(self, conn):
+		while conn.out:
+			try:
+				sent = conn.sock.send(conn.out)
+			except ssl.SSLError as e:
+				if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+					return False
+				raise
+			except socket.error as e:
+				if e.args[0] in WOULD_BLOCK:
+					return False
+				raise
+			conn.out = conn.out[sent:]
+		return True
+
+	def _receive(self, conn):
+		while True:
+			try:
+				data = conn.sock.recv(RECV_SIZE)
+			except ssl.SSLError as e:
+				if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+					return
+				raise
+			except socket.error as e:
+				if e.args[0] in WOULD_BLOCK:
+					return
+				raise
+			if not data:
+				if conn.parser.eof():
+					conn.parser.keep_alive = False
+					return self._finish(conn)
+				raise socket.error(errno.ECONNRESET, 'Connection closed by server')
+			conn.received += len(data)
+			conn.parser.feed(data)
+			if conn.parser.done:
+				return self._finish(conn)
+
+	def _finish(self, conn):
+		req, parser = conn.request, conn.parser
+		self.active.remove(conn)
+		stats.add_time('network', time.time() - req.started)
+		stats.count('bytes_received', conn.received)
+		if conn.reused:
+			stats.count('connections_reused')
+		conn.request = conn.parser = None
+		if parser.keep_alive:
+			conn.state, conn.want_write = 'idle', False
+			self.idle.setdefault(conn.key, []).append(conn)
+		else:
+			conn.sock.close()
+		self._complete(req, parser.status, parser.headers, b''.join(parser.body), None)
+
+	def _fail(self, conn, error, retry=True):
+		req = conn.request
+		if conn in self.active:
+			self.active.remove(conn)
+		try:
+			conn.sock.close()
+		except:
+			pass
+		conn.request = conn.parser = None
+		if req is None:
+			return
+		if retry and conn.reused and conn.received == 0 and req.attempt == 1:
+			# A kept alive connection the server had already given up on
+			self._start(req)
+			return
+		self._complete(req, None, None, None, error)
+
+	def _drop_idle(self, conn):
+		conns = self.idle.get(conn.key, [])
+		if conn in conns:
+			conns.remove(conn)
+		try:
+			conn.sock.close()
+		except:
+			pass
+
+	def _complete(self, req, status, headers, body, error):
+		try:
+			req.callback(status, headers, body, error)
+		except:
+			traceback.print_exc()
+
+_loop = None
+_loop_lock = RLock()
+
+def get_loop():
+	'''
+	Return the process-wide event loop, shared by every session. It opens
+	up to KEY_EVENT_LOOP_CONNECTIONS connections to ISFDB; requests beyond
+	that wait in the loop, costing no thread.
+	'''
+	global _loop
+	import calibre_plugins.isfdb.config as cfg
+	with _loop_lock:
+		if _loop is None:
+			_loop = EventLoop(max_per_host=cfg.get_option(cfg.KEY_EVENT_LOOP_CONNECTIONS))
+		return _loop
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, re, gzip, sqlite3
+from threading import RLock
+
+from calibre.constants import config_dir
+
+from calibre_plugins.isfdb.cache import EDITED_TYPES, isbn_forms
+
+DEFAULT_INDEX_PATH = os.path.join(config_dir, 'plugins', 'ISFDB-offline.sqlite')
+
+# The tables of the ISFDB MySQL backup we need, and the columns we keep.
+TABLES = {
+	'pubs': ('pub_id', 'pub_title', 'pub_year', 'publisher_id', 'pub_ctype', 'pub_isbn', 'pub_frontimage'),
+	'authors': ('author_id', 'author_canonical'),
+	'pub_authors': ('pa_id', 'pub_id', 'author_id'),
+	'publishers': ('publisher_id', 'publisher_name'),
+}
+
+SCHEMA = '''
+CREATE TABLE pubs (pub_id INTEGER PRIMARY KEY, pub_title TEXT, pub_year TEXT, publisher_id INTEGER,
+	pub_ctype TEXT, pub_isbn TEXT, pub_frontimage TEXT);
+CREATE TABLE authors (author_id INTEGER PRIMARY KEY, author_canonical TEXT);
+CREATE TABLE pub_authors (pa_id INTEGER PRIMARY KEY, pub_id INTEGER, author_id INTEGER);
+CREATE TABLE publishers (publisher_id INTEGER PRIMARY KEY, publisher_name TEXT);
+'''
+
+INDEXES = '''
+CREATE INDEX pubs_isbn ON pubs (pub_isbn);
+CREATE INDEX pub_authors_pub ON pub_authors (pub_id);
+CREATE VIRTUAL TABLE pub_search USING fts4 (title, authors);
+INSERT INTO pub_search (docid, title, authors)
+	SELECT p.pub_id, p.pub_title,
+		(SELECT group_concat(a.author_canonical, ' ') FROM pub_authors pa JOIN authors a ON a.author_id = pa.author_id
+			WHERE pa.pub_id = p.pub_id)
+	FROM pubs p;
+'''
+
+CREATE_RE = re.compile(r'^CREATE TABLE `(\w+)`')
+COLUMN_RE = re.compile(r'^\s+`(\w+)`')
+INSERT_RE = re.compile(r'^INSERT INTO `(\w+)` VALUES ')
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+MYSQL_ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+
+def parse_values(text, pos=0):
+	'''
+	Yield the row tuples of the VALUES list of a MySQL INSERT statement,
+	starting at pos. Strings come back unescaped, NULL as None and numbers
+	as the text of the number.
+	'''
+	n = len(text)
+	while pos < n:
+		if text[pos] != '(':
+			pos += 1
+			continue
+		pos += 1
+		row = []
+		while True:
+			c = text[pos]
+			if c == "'":
+				pos += 1
+				chunks = []
+				while True:
+					c = text[pos]
+					if c == '\\':
+						chunks.append(MYSQL_ESCAPES.get(text[pos+1], text[pos+1]))
+						pos += 2
+					elif c == "'":
+						if text[pos+1:pos+2] == "'":
+							chunks.append("'")
+							pos += 2
+						else:
+							pos += 1
+							break
+					else:
+						end = pos
+						while end < n and text[end] not in "\\'":
+							end += 1
+						chunks.append(text[pos:end])
+						pos = end
+				row.append(''.join(chunks))
+			else:
+				end = pos
+				while text[end] not in ',)':
+					end += 1
+				value = text[pos:end].strip()
+				row.append(None if value == 'NULL' else value)
+				pos = end
+			if text[pos] == ')':
+				pos += 1
+				break
+			pos += 1 # the comma between values
+		yield tuple(row)
+
+def build_index(dump_path, index_path=DEFAULT_INDEX_PATH, report=None):
+	'''
+	Build the offline index from an ISFDB MySQL backup (plain or gzipped
+	.sql). The dump is read line by line, so even the full backup needs
+	little memory. Returns the number of publications indexed.
+	'''
+	opener = gzip.open if dump_path.endswith('.gz') else open
+	tmp_path = index_path + '.tmp'
+	if os.path.exists(tmp_path):
+		os.remove(tmp_path)
+	conn = sqlite3.connect(tmp_path)
+	conn.execute('PRAGMA synchronous = OFF')
+	conn.execute('PRAGMA journal_mode = OFF')
+	conn.executescript(SCHEMA)
+
+	columns = {}
+	table = None
+	with opener(dump_path, 'rb') as f:
+		for line in f:
+			line = line.decode('cp1252', 'replace')
+			m = CREATE_RE.match(line)
+			if m is not None:
+				table = m.group(1)
+				columns[table] = []
+				continue
+			if table is not None:
+				m = COLUMN_RE.match(line)
+				if m is not None:
+					columns[table].append(m.group(1))
+					continue
+				table = None
+			m = INSERT_RE.match(line)
+			if m is None or m.group(1) not in TABLES:
+				continue
+			name = m.group(1)
+			keep = [columns[name].index(c) for c in TABLES[name]]
+			conn.executemany('INSERT OR REPLACE INTO %s VALUES (%s)' % (name, ', '.join('?' * len(keep))),
+				(tuple(row[i] for i in keep) for row in parse_values(line, m.end())))
+			if report is not None:
+				report('Loaded rows into %s' % name)
+
+	if report is not None:
+		report('Building search indexes')
+	conn.executescript(INDEXES)
+	count = conn.execute('SELECT count(*) FROM pubs').fetchone()[0]
+	conn.commit()
+	conn.close()
+	if os.path.exists(index_path):
+		os.remove(index_path)
+	os.rename(tmp_path, index_path)
+	return count
+
+class OfflineIndex(object):
+
+	'''
+	Read-only access to an index built by build_index. Returns records in the
+	same format as the online backends (see cache.RECORD_FIELDS), without
+	comments, which the backup only holds as separate content titles.
+	'''
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = RLock()
+		self.conn = sqlite3.connect(path, check_same_thread=False)
+
+	def get(self, pub_id):
+		records = self._records('p.pub_id = ?', (pub_id,))
+		if records:
+			return records[0]
+
+	def find_isbn(self, isbn):
+		variants = isbn_forms(isbn)
+		return self._records('p.pub_isbn IN (%s)' % ', '.join('?' * len(variants)), variants)
+
+	def search(self, title_tokens, author_tokens, limit):
+		terms = ['title:%s' % t for t in title_tokens] + ['authors:%s' % t for t in author_tokens]
+		if not terms:
+			return []
+		return self._records('p.pub_id IN (SELECT docid FROM pub_search WHERE pub_search MATCH ?)',
+			(' '.join(terms),), limit)
+
+	def _records(self, where, args, limit=-1):
+		with self.lock:
+			rows = self.conn.execute('SELECT p.pub_id, p.pub_title, p.pub_year, pb.publisher_name, p.pub_ctype, '
+				'p.pub_isbn, p.pub_frontimage FROM pubs p LEFT JOIN publishers pb ON pb.publisher_id = p.publisher_id '
+				'WHERE %s ORDER BY p.pub_title, p.pub_id LIMIT ?' % where, tuple(args) + (limit,)).fetchall()
+			records = []
+			for pub_id, title, year, publisher, ctype, isbn, image in rows:
+				authors = [a for a, in self.conn.execute('SELECT a.author_canonical FROM pub_authors pa '
+					'JOIN authors a ON a.author_id = pa.author_id WHERE pa.pub_id = ? ORDER BY pa.pa_id', (pub_id,))]
+				if (ctype or '').upper() in EDITED_TYPES:
+					authors = [a + ' (Editor)' for a in authors]
+				if not title or not authors:
+					continue
+				records.append({
+					'isfdb_id': unicode(pub_id),
+					'title': title,
+					'authors': authors,
+					'isbn': isbn or None,
+					'publisher': publisher,
+					'pubdate': year,
+					'comments': None,
+					# The image column may carry a credit link after a '|'
+					'cover_url': (image or '').split('|')[0].strip() or None,
+				})
+			return records
+
+def search_tokens(tokens):
+	'''
+	Reduce query tokens to words that are safe inside an FTS MATCH expression.
+	'''
+	return [w for t in tokens for w in TOKEN_RE.findall(t)]
+
+_index = None
+_index_lock = RLock()
+
+def get_index(path):
+	'''
+	Return the process-wide index for path, or None if it has not been built.
+	'''
+	global _index
+	with _index_lock:
+		if _index is None or _index.path != path:
+			_index = OfflineIndex(path) if os.path.exists(path) else None
+		return _index
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import re
+from threading import local
+
+from lxml import etree
+from lxml.html import HTMLParser, HtmlElementClassLookup, document_fromstring
+
+from calibre.utils.icu import lower
+
+from calibre_plugins.isfdb.rank import Query, GOOD_SCORE, best
+from calibre_plugins.isfdb.stats import stats
+
+# ISFDB serves its pages as cp1252, whatever the meta tag says
+PAGE_ENCODING = 'windows-1252'
+
+# What calibre's clean_ascii_chars strips: ASCII control characters other
+# than tab, newline and carriage return. cp1252 shares these with ASCII, so
+# they can be removed before decoding.
+CONTROL_CHARS = re.compile(b'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+# Bytes cp1252 leaves undefined. libxml2 stops converting at the first one,
+# so pages containing them take the slow path.
+UNDEFINED_CP1252 = re.compile(b'[\x81\x8d\x8f\x90\x9d]')
+
+# lxml parsers must not be shared between threads
+_local = local()
+
+def _parser():
+	parser = getattr(_local, 'parser', None)
+	if parser is None:
+		parser = _local.parser = HTMLParser(encoding=PAGE_ENCODING)
+	return parser
+
+def page_to_tree(raw):
+	'''
+	Turn a downloaded ISFDB page (bytes) into an lxml tree, letting libxml2
+	decode it rather than going through unicode and clean_ascii_chars.
+	'''
+	if UNDEFINED_CP1252.search(raw) is not None:
+		from calibre.utils.cleantext import clean_ascii_chars
+		with stats.timer('decode'):
+			text = clean_ascii_chars(raw.decode('cp1252', errors='replace'))
+		with stats.timer('lxml_parse'):
+			return document_fromstring(text)
+	if CONTROL_CHARS.search(raw) is not None:
+		with stats.timer('clean_ascii_chars'):
+			raw = CONTROL_CHARS.sub(b'', raw)
+	with stats.timer('lxml_parse'):
+		return document_fromstring(raw, parser=_parser())
+
+# Search results (adv_search_results.cgi, se.cgi)
+SEARCH_ROWS = etree.XPath('//div[@id="main"]/table/tr')
+ROW_CELLS = etree.XPath('td')
+ROW_AUTHOR_LINKS = etree.XPath('td[3]/a')
+ROW_FORMATS = etree.XPath('td[8]/text()')
+ROW_HREF = etree.XPath('td[1]/a/@href')
+
+UNSUPPORTED_FORMATS = [] # is there anything to exclude?
+
+# How ISFDB says a search found nothing: se.cgi "... found 0 matches.",
+# adv_search_results.cgi "No records found". Anything else without rows,
+# such as a maintenance page, says nothing about the book.
+NO_RECORDS = re.compile(br'found 0 matches|No records found', re.IGNORECASE)
+NO_RECORDS_OVERLAP = 32
+
+# adv_search_results.cgi lists this many rows per page (see START=)
+SEARCH_PAGE_SIZE = 100
+MAX_SEARCH_PAGES = 5
+# A page that has come this far is most likely a full one, with another
+# page after it
+LIKELY_FULL_ROWS = SEARCH_PAGE_SIZE // 2
+
+def search_page_url(query, page):
+	'''
+	The url of the given page (counting from 0) of an advanced search, or
+	None for searches that are not paged.
+	'''
+	if 'START=' not in query:
+		return None
+	return re.sub(r'START=\d+', 'START=%d' % (page * SEARCH_PAGE_SIZE), query)
+
+def next_search_page_url(url):
+	'''
+	The url of the page after the one at url, or None if there is none to
+	read: the search is not paged or MAX_SEARCH_PAGES have been read.
+	'''
+	match = re.search(r'START=(\d+)', url)
+	if match is None:
+		return None
+	page = int(match.group(1)) // SEARCH_PAGE_SIZE + 1
+	return search_page_url(url, page) if page < MAX_SEARCH_PAGES else None
+
+class SearchResults(object):
+
+	'''
+	Parse a search results page as it arrives, scoring each row that
+	matches the query (see rank.Query). matches() gives the details urls of
+	the best max_results rows. feed() returns True once that many rows with
+	a good score (see rank.GOOD_SCORE) have been found, after which the
+	rest of the page need not be read. no_records is set if ISFDB said it
+	found nothing.
+
+	Once the page looks like a full one (LIKELY_FULL_ROWS), prefetch is
+	called with it, if given, and can set next_page to the SearchResults
+	of the next page, already on its way. That is cancelled if there turns
+	out to be no need for it.
+	'''
+
+	def __init__(self, title_tokens, author_tokens, max_results, prefetch=None):
+		self.query = Query(title_tokens, author_tokens)
+		self.max_results = max_results
+		self.prefetch = prefetch
+		self.url = self.previous = self.next_page = None
+		self.candidates = []
+		self.closed = self.cancelled = False
+		self.good = 0
+		self.rows = 0
+		self.no_records = False
+		self._tail = b''
+		self._parser = None
+
+	@property
+	def parser(self):
+		# Created by the thread that feeds the page: lxml parsers and trees
+		# must stay with one thread, so feed and close from the same one
+		if self._parser is None:
+			self._parser = etree.HTMLPullParser(events=('end',), tag='tr', encoding=PAGE_ENCODING)
+			self._parser.set_element_class_lookup(HtmlElementClassLookup())
+		return self._parser
+
+	@property
+	def done(self):
+		return self.good >= self.max_results
+
+	@property
+	def full(self):
+		'''
+		Whether this was a complete page, so there may be another one.
+		'''
+		return self.rows >= SEARCH_PAGE_SIZE
+
+	def sibling(self):
+		'''
+		A new SearchResults for the same query, to read another page into.
+		'''
+		results = SearchResults([], [], self.max_results, self.prefetch)
+		results.query, results.previous = self.query, self
+		return results
+
+	def found(self):
+		'''
+		The number of matching rows on this page and the ones before it.
+		'''
+		results, found = self, 0
+		while results is not None:
+			found += len(results.candidates)
+			results = results.previous
+		return found
+
+	def cancel(self):
+		'''
+		Stop reading this page, which is no longer wanted.
+		'''
+		self.cancelled = True
+
+	def feed(self, data):
+		if self.done or self.cancelled:
+			return True
+		# See page_to_tree; a stray byte must not cut the page short here
+		if UNDEFINED_CP1252.search(data) is not None:
+			data = UNDEFINED_CP1252.sub(b'?', data)
+		if CONTROL_CHARS.search(data) is not None:
+			data = CONTROL_CHARS.sub(b'', data)
+		if not self.rows and not self.no_records:
+			# The message may straddle two chunks
+			text = self._tail + data
+			self.no_records = NO_RECORDS.search(text) is not None
+			self._tail = text[-NO_RECORDS_OVERLAP:]
+		with stats.timer('search_parse'):
+			self.parser.feed(data)
+			self._read_rows()
+		return self.done
+
+	def close(self):
+		if not self.done and not self.closed and not self.cancelled:
+			self.closed = True
+			with stats.timer('search_parse'):
+				self.parser.close()
+				self._read_rows()
+		self._parser = None
+		return self.matches()
+
+	def matches(self):
+		return best(self.candidates, self.max_results)
+
+	def _read_rows(self):
+		for event, row in self.parser.read_events():
+			table = row.getparent()
+			main = table.getparent() if table is not None else None
+			if main is None or table.tag != 'table' or main.tag != 'div' or main.get('id') != 'main':
+				continue
+			cells = ROW_CELLS(row)
+			if cells: # not the header
+				self.rows += 1
+				if self.rows == LIKELY_FULL_ROWS and self.prefetch is not None and not self.done:
+					self.prefetch(self)
+			if cells and not self.done:
+				candidate = self.score(row, cells)
+				if candidate is not None:
+					self.candidates.append(candidate)
+					if candidate[0] >= GOOD_SCORE:
+						self.good += 1
+			# Rows are not needed once looked at
+			row.clear()
+
+	def score(self, row, cells):
+		'''
+		(score, details url) for a search result row, if it matches the query.
+		'''
+		title = lower(cells[0].text_content().strip())
+		authors = []
+		for c in ROW_AUTHOR_LINKS(row):
+			author = c.text_content().split(',')[0].strip()
+			if author:
+				authors.append(author)
+		authors = lower(' '.join(authors))
+		if not self.query.accepts(title, authors):
+			return
+
+		# Validate that the format is one we are interested in
+		format = ''.join(ROW_FORMATS(row)).strip()
+		if format.lower() in UNSUPPORTED_FORMATS:
+			return
+		# Get the detailed url to query next
+		url = ''.join(ROW_HREF(row))
+		if not url:
+			return
+
+		# The remaining columns are plain text
+		cell = lambda i: (cells[i].text or '').strip() if len(cells) > i else ''
+		return self.query.score(title, authors, date=cell(1), isbn=cell(4), format=format,
+				type_=cell(8), verified=cell(10) == 'Verified'), url
+
+# Publication pages (pl.cgi)
+DETAIL_ITEMS = etree.XPath('//div[@id="content"]//td[@class="pubheader"]/ul/li')
+DETAIL_ITEMS_NO_TABLE = etree.XPath('//div[@id="content"]/div/ul/li') # no table (on records with no image)
+DESCENDANT_LINKS = etree.XPath('.//a')
+CHILD_LINKS = etree.XPath('a')
+CONTENTS_LIST = etree.XPath('//div[@class="ContentBox"][2]/ul')
+CONTENTS_TITLE_LINKS = etree.XPath('//div[@class="ContentBox"][2]/ul/li/a[contains(@href, "title.cgi?")][1]')
+COVER_SRC = etree.XPath('//div[@id="content"]//table/tr[1]/td[1]/a/img/@src')
+
+# Title pages (title.cgi)
+TITLE_ITEMS = etree.XPath('//div[@id="content"]/div[@class="ContentBox"][1]/ul/li')
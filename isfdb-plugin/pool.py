@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import sys, time, traceback
+from Queue import Queue
+from threading import Thread, Condition, Event, RLock
+
+import calibre_plugins.isfdb.config as cfg
+from calibre_plugins.isfdb.stats import stats
+
+# How often a JobGroup waiting for its jobs looks at the abort flag
+ABORT_POLL = 0.2
+
+class WorkerPool(object):
+
+	'''
+	A fixed number of daemon threads running jobs from a shared queue.
+
+	Threads are started on first use, so a pool that is never needed costs
+	nothing. Jobs should handle their own errors; anything that escapes is
+	printed, with its traceback, and the thread goes on to the next job.
+	'''
+
+	def __init__(self, size, name='ISFDB worker'):
+		self.size, self.name = max(1, size), name
+		self.jobs = Queue()
+		self.threads = []
+		self.lock = RLock()
+
+	def submit(self, func, *args):
+		with self.lock:
+			if not self.threads:
+				for i in range(self.size):
+					t = Thread(target=self._run, name='%s %d' % (self.name, i))
+					t.daemon = True
+					t.start()
+					self.threads.append(t)
+		self.jobs.put((func, args))
+
+	def shutdown(self):
+		'''
+		Stop the threads once the jobs already queued have run.
+		'''
+		with self.lock:
+			for t in self.threads:
+				self.jobs.put(None)
+			self.threads = []
+
+	def _run(self):
+		while True:
+			job = self.jobs.get()
+			if job is None:
+				break
+			func, args = job
+			try:
+				func(*args)
+			except:
+				print('%s: job %r failed:' % (self.name, func), file=sys.stderr)
+				traceback.print_exc()
+
+class JobGroup(object):
+
+	'''
+	A set of jobs submitted to a pool that a caller can wait on as a whole.
+	The waiting thread is woken when a job finishes, and checks for abort
+	in between.
+	'''
+
+	def __init__(self, pool):
+		self.pool = pool
+		self.pending = 0
+		self.cond = Condition()
+
+	def submit(self, func, *args):
+		with self.cond:
+			self.pending += 1
+		self.pool.submit(self._run, func, args)
+
+	def submit_after(self, future, func, *args):
+		'''
+		Run func on the pool once future is done. It counts as pending from
+		now on, but takes up no thread while future is outstanding.
+		'''
+		with self.cond:
+			self.pending += 1
+		future.add_done_callback(lambda f: self.pool.submit(self._run, func, args))
+
+	def _run(self, func, args):
+		try:
+			func(*args)
+		finally:
+			with self.cond:
+				self.pending -= 1
+				self.cond.notify_all()
+
+	def wait(self, abort=None, timeout=None):
+		'''
+		Block until every job has finished, abort is set (noticed within
+		ABORT_POLL seconds) or timeout seconds have passed. Returns True if
+		all jobs finished.
+		'''
+		deadline = None if timeout is None else time.time() + timeout
+		with self.cond:
+			while self.pending:
+				if abort is not None and abort.is_set():
+					return False
+				step = ABORT_POLL
+				if deadline is not None:
+					step = min(step, deadline - time.time())
+					if step <= 0:
+						return False
+				self.cond.wait(step)
+			return True
+
+class Future(object):
+
+	'''
+	The eventual result of a single job, for one caller to collect later.
+	'''
+
+	def __init__(self):
+		self.done = Event()
+		self.value = self.exc_info = None
+		self.callbacks = []
+		self.lock = RLock()
+
+	def run(self, func, args):
+		try:
+			value = func(*args)
+		except:
+			self.set_exception()
+		else:
+			self.set_result(value)
+
+	def set_result(self, value):
+		self.value = value
+		self._finish()
+
+	def set_exception(self, exc_info=None):
+		'''
+		Fail with exc_info, by default the exception being handled.
+		'''
+		self.exc_info = exc_info or sys.exc_info()
+		self._finish()
+
+	def _finish(self):
+		with self.lock:
+			self.done.set()
+			callbacks, self.callbacks = self.callbacks, []
+		for callback in callbacks:
+			callback(self)
+
+	def add_done_callback(self, callback):
+		'''
+		Call callback(future) once the job is done, in the thread that
+		finishes it, or right away if it already has.
+		'''
+		with self.lock:
+			if not self.done.is_set():
+				self.callbacks.append(callback)
+				return
+		callback(self)
+
+	def result(self, timeout=None):
+		'''
+		Wait for the job and return its result, re-raising anything it raised.
+		'''
+		if not self.done.wait(timeout):
+			raise RuntimeError('Timed out waiting for job')
+		if self.exc_info is not None:
+			raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+		return self.value
+
+def submit_future(pool, func, *args):
+	future = Future()
+	pool.submit(future.run, func, args)
+	return future
+
+def submit_future_after(pool, after, func, *args):
+	'''
+	Like submit_future, but func only runs once the Future after is done,
+	taking up no thread until then.
+	'''
+	future = Future()
+	after.add_done_callback(lambda f: pool.submit(future.run, func, args))
+	return future
+
+class SingleFlight(object):
+
+	'''
+	Lets concurrent callers asking for the same thing share one call: while
+	a call for a key is in flight, others for that key wait for its result
+	(or exception) instead of making their own. Nothing is kept once the
+	call is done; that is what the caches are for.
+	'''
+
+	def __init__(self):
+		self.calls = {}
+		self.lock = RLock()
+
+	def do(self, key, func, *args):
+		'''
+		Return func(*args), run in this thread unless a call for key is
+		already in flight.
+		'''
+		with self.lock:
+			future = self.calls.get(key)
+			leader = future is None
+			if leader:
+				future = self.calls[key] = Future()
+		if not leader:
+			stats.count('shared_calls')
+			return future.result()
+		try:
+			future.run(func, args)
+		finally:
+			self._forget(key, future)
+		return future.result()
+
+	def share(self, key, start):
+		'''
+		Return the Future of the call in flight for key, or the one start()
+		returns for a new call.
+		'''
+		with self.lock:
+			future = self.calls.get(key)
+			if future is not None:
+				stats.count('shared_calls')
+				return future
+			future = self.calls[key] = start()
+		future.add_done_callback(lambda f: self._forget(key, f))
+		return future
+
+	def _forget(self, key, future):
+		with self.lock:
+			if self.calls.get(key) is future:
+				del self.calls[key]
+
+_pool = None
+_flights = None
+_pool_lock = RLock()
+
+def get_pool():
+	'''
+	Return the process-wide pool used for detail page fetches, shared by
+	every identify call so that concurrent jobs cannot exceed its size.
+	'''
+	global _pool
+	with _pool_lock:
+		if _pool is None:
+			_pool = WorkerPool(cfg.get_option(cfg.KEY_MAX_THREADS))
+		return _pool
+
+def get_flights():
+	'''
+	Return the process-wide SingleFlight, so that identify and
+	download_cover jobs running at the same time share their downloads.
+	'''
+	global _flights
+	with _pool_lock:
+		if _flights is None:
+			_flights = SingleFlight()
+		return _flights
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import io, os, re, time
+from threading import Event
+
+from calibre.ebooks.metadata import check_isbn
+
+from calibre_plugins.isfdb.stats import stats
+
+# Tokens of a list line: isfdb:<id>, isbn:<isbn> or a bare ISBN, so that
+# calibre's identifiers column (isbn:...,isfdb:...) can be used as is
+TOKEN_RE = re.compile(r'(?:(isfdb|isbn):)?([0-9Xx-]+)', re.IGNORECASE)
+
+def read_items(lines):
+	'''
+	Yield (key, identifiers) for each book in a list of lines, one book a
+	line. A book with an ISFDB id is looked up by that, otherwise by its
+	ISBN. key is the book as written to the state file, e.g. isbn:... .
+	Lines with neither are skipped, as are duplicates.
+	'''
+	seen = set()
+	for line in lines:
+		identifiers = {}
+		for kind, value in TOKEN_RE.findall(line.split('#')[0]):
+			kind = kind.lower()
+			if kind == 'isfdb':
+				identifiers.setdefault('isfdb', value)
+			else:
+				isbn = check_isbn(value)
+				if isbn:
+					identifiers.setdefault('isbn', isbn)
+		if 'isfdb' in identifiers:
+			key = 'isfdb:' + identifiers['isfdb']
+		elif 'isbn' in identifiers:
+			key = 'isbn:' + identifiers['isbn']
+		else:
+			continue
+		if key not in seen:
+			seen.add(key)
+			yield key, identifiers
+
+def read_state(path):
+	'''
+	The keys of the books a previous run already has in the cache.
+	'''
+	if not path or not os.path.exists(path):
+		return set()
+	with io.open(path, encoding='utf-8') as f:
+		return set(line.strip() for line in f if line.strip())
+
+def prewarm(plugin, log, items, abort=None, budget=0, state_path=None, report=None, timeout=30):
+	'''
+	Look up items (see read_items) so that later identify and
+	download_cover calls for them are answered from the cache: their
+	publication records, ISBN to ISFDB id mappings and cover urls (and
+	title records, if those are wanted).
+
+	Books listed in the file at state_path are skipped and each book
+	found is added to it, so that an interrupted run can be resumed.
+	Books not found are tried again next time; searches ISFDB had no
+	match for are remembered by the cache anyway. No new lookups are
+	started once budget requests (0 = no limit) have been made or abort
+	is set. The request rate is that of the plugin's rate limiter.
+
+	Returns (found, not_found, skipped) counts.
+	'''
+	abort = abort or Event()
+	report = report or (lambda msg: None)
+	done = read_state(state_path)
+	items = list(items)
+	todo = [(key, identifiers) for key, identifiers in items if key not in done]
+	skipped = len(items) - len(todo)
+	if skipped:
+		report('Skipping %d books already done by an earlier run' % skipped)
+
+	start_requests = stats.snapshot()['counters'].get('requests', 0)
+	started = time.time()
+	found = not_found = 0
+	state = io.open(state_path, 'a', encoding='utf-8') if state_path else None
+	try:
+		books = [('', [], identifiers) for key, identifiers in todo]
+		for n, (i, results) in enumerate(plugin.identify_batch(log, books, abort, timeout=timeout), 1):
+			key = todo[i][0]
+			if results:
+				found += 1
+				if state is not None:
+					state.write(key + '\n')
+					state.flush()
+			else:
+				not_found += 1
+			used = stats.snapshot()['counters'].get('requests', 0) - start_requests
+			report('[%d/%d] %s: %s (%d requests, %.1f books/s)' % (n, len(todo), key,
+				'cached' if results else 'not found', used, n / max(time.time() - started, 0.001)))
+			if budget and used >= budget and not abort.is_set():
+				report('Request budget of %d used up, stopping' % budget)
+				abort.set()
+	finally:
+		if state is not None:
+			state.close()
+	return found, not_found, skipped
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import re
+
+from calibre.utils.icu import lower
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+# Formats and publication types of actual books, as opposed to audio
+# editions, magazines and the like
+BOOK_FORMATS = frozenset(['hc', 'tp', 'pb', 'ebook'])
+BOOK_TYPES = frozenset(['NOVEL', 'COLLECTION', 'ANTHOLOGY', 'OMNIBUS', 'NONFICTION', 'CHAPBOOK'])
+
+TITLE_WEIGHT = 4
+EXACT_TITLE_BONUS = 1
+AUTHOR_WEIGHT = 3
+VERIFIED_BONUS = 1
+DETAIL_BONUS = 0.5 # each of: an ISBN, a full date, a book format, a book type
+PERFECT_SCORE = TITLE_WEIGHT + EXACT_TITLE_BONUS + AUTHOR_WEIGHT + VERIFIED_BONUS + 4 * DETAIL_BONUS
+
+# Candidates scoring below this fraction of the best one are not fetched
+MIN_RELATIVE_SCORE = 0.7
+# Enough to survive that cut however good the other candidates are; with
+# an exact title and all the authors a row gets there
+GOOD_SCORE = PERFECT_SCORE * MIN_RELATIVE_SCORE
+
+class Query(object):
+
+	'''
+	The title and author tokens of an identify query, normalized once.
+	'''
+
+	def __init__(self, title_tokens, author_tokens):
+		self.title_tokens = [lower(t) for t in title_tokens]
+		self.author_tokens = [lower(a) for a in author_tokens]
+		self.title_words = frozenset(self.title_tokens)
+
+	def accepts(self, title, authors):
+		'''
+		The plugin's original test: some title token appears in the title and
+		some author token in the authors. title and authors are lower case.
+		'''
+		if self.title_tokens and not any(t in title for t in self.title_tokens):
+			return False
+		if self.author_tokens and not any(a in authors for a in self.author_tokens):
+			return False
+		return True
+
+	def score(self, title, authors, date, isbn, format, type_, verified):
+		'''
+		How good a candidate a search result row is, from 0 to PERFECT_SCORE.
+		title and authors are lower case.
+		'''
+		score = 0
+		if self.title_tokens:
+			words = frozenset(WORD.findall(title))
+			score += TITLE_WEIGHT * len(self.title_words & words) / len(self.title_words)
+			if words == self.title_words:
+				score += EXACT_TITLE_BONUS
+		else:
+			score += TITLE_WEIGHT + EXACT_TITLE_BONUS
+		if self.author_tokens:
+			score += AUTHOR_WEIGHT * sum(1 for a in self.author_tokens if a in authors) / len(self.author_tokens)
+		else:
+			score += AUTHOR_WEIGHT
+		if verified:
+			score += VERIFIED_BONUS
+		if isbn:
+			score += DETAIL_BONUS
+		if date and not date.startswith('0000') and not date.endswith('-00'):
+			score += DETAIL_BONUS
+		if format in BOOK_FORMATS:
+			score += DETAIL_BONUS
+		if type_ in BOOK_TYPES:
+			score += DETAIL_BONUS
+		return score
+
+def best(candidates, limit):
+	'''
+	The urls of the best of candidates, a list of (score, url) in page
+	order: at most limit of them, best first, leaving out any that score
+	well below the best one. Ties keep page order.
+	'''
+	ranked = sorted(enumerate(candidates), key=lambda x: (-x[1][0], x[0]))
+	if not ranked:
+		return []
+	cutoff = ranked[0][1][0] * MIN_RELATIVE_SCORE
+	return [url for i, (score, url) in ranked[:limit] if score >= cutoff]
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+from threading import RLock
+
+import calibre_plugins.isfdb.config as cfg
+
+class RateLimiter(object):
+
+	'''
+	Token bucket limiting how many requests per second the plugin sends.
+
+	The rate adapts to how the server copes: every throttled, failed or
+	timed out request halves it (down to min_rate) and pauses all callers
+	for a while, every successful one wins back a tenth of the configured
+	rate. Bursts of up to one second's worth of requests are allowed.
+	clock returns the current time in seconds.
+	'''
+
+	def __init__(self, max_rate, min_rate=0.2, clock=time.time):
+		self.lock = RLock()
+		self.clock = clock
+		self.set_max_rate(max_rate)
+		self.min_rate = min(min_rate, self.max_rate)
+		self.tokens = 1.0
+		self.last = clock()
+		self.paused_until = 0
+
+	def set_max_rate(self, max_rate):
+		with self.lock:
+			self.max_rate = self.rate = max(0.01, float(max_rate))
+
+	def acquire(self):
+		'''
+		Block until a request may be sent.
+		'''
+		while True:
+			delay = self.try_acquire()
+			if not delay:
+				return
+			time.sleep(delay)
+
+	def try_acquire(self):
+		'''
+		Take the go-ahead for a request if there is one, returning 0.
+		Otherwise return how many seconds to wait before asking again.
+		'''
+		with self.lock:
+			now = self.clock()
+			self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last) * self.rate)
+			self.last = now
+			if now < self.paused_until:
+				return self.paused_until - now
+			if self.tokens >= 1:
+				self.tokens -= 1
+				return 0
+			return (1 - self.tokens) / self.rate
+
+	def success(self):
+		with self.lock:
+			self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+	def failure(self, retry_after=None):
+		with self.lock:
+			self.rate = max(self.min_rate, self.rate / 2)
+			self.tokens = 0
+			pause = retry_after if retry_after is not None else 1 / self.rate
+			self.paused_until = max(self.paused_until, self.clock() + pause)
+
+_limiter = None
+_limiter_lock = RLock()
+
+def get_limiter():
+	'''
+	Return the process-wide limiter shared by every session.
+	'''
+	global _limiter
+	with _limiter_lock:
+		if _limiter is None:
+			_limiter = RateLimiter(cfg.get_option(cfg.KEY_REQUESTS_PER_SECOND))
+		return _limiter
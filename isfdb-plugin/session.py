@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time, socket, zlib, httplib
+from urlparse import urlsplit, urljoin
+from urllib2 import HTTPError, URLError
+from cStringIO import StringIO
+from threading import RLock
+
+from calibre import get_proxies, random_user_agent
+
+from calibre_plugins.isfdb.stats import stats
+
+REDIRECT_CODES = (301, 302, 303, 307)
+STREAM_CHUNK_SIZE = 16 * 1024
+# When a consumer stops reading early, a remainder up to this size is still
+# read so the connection can be kept alive; anything larger is dropped.
+DRAIN_LIMIT = 32 * 1024
+
+def is_throttled(code):
+	return code == 429 or code >= 500
+
+def feed_consumer(response, consumer):
+	'''
+	Pass the body of a response that arrived whole (see Session.open_async)
+	to a consumer the way Session.open would have: in chunks, stopping once
+	it returns True, and only for a 200.
+	'''
+	if response.getcode() != 200:
+		return
+	data = response.read()
+	for i in range(0, len(data), STREAM_CHUNK_SIZE):
+		if consumer(data[i:i + STREAM_CHUNK_SIZE]):
+			return
+
+class Response(object):
+
+	'''
+	A fully read, decompressed response (or as much of it as a consumer
+	wanted, see Session.open). Provides the parts of the urllib2/mechanize
+	response interface that the plugin uses.
+	'''
+
+	def __init__(self, url, code, headers, data):
+		self.url, self.code, self.headers, self.data = url, code, headers, data
+
+	def read(self):
+		return self.data
+
+	def geturl(self):
+		return self.url
+
+	def getcode(self):
+		return self.code
+
+	def info(self):
+		return self.headers
+
+def decode_body(data, encoding):
+	encoding = (encoding or '').lower()
+	if encoding == 'gzip':
+		return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+	if encoding == 'deflate':
+		try:
+			return zlib.decompress(data)
+		except zlib.error:
+			# Some servers send a raw deflate stream without the zlib header
+			return zlib.decompress(data, -zlib.MAX_WBITS)
+	return data
+
+class Session(object):
+
+	'''
+	Keep-alive HTTP(S) connections pooled per host, with gzip/deflate
+	transfer encoding. A single session is safe to share between threads:
+	a connection is only ever used by the thread that checked it out.
+
+	Every request first waits on the rate limiter, if one is given, and
+	reports back whether the server throttled it. Throttled (429/5xx) and
+	timed out requests are retried up to retries times.
+
+	open() can pass the body of a successful response to a consumer as it
+	arrives, which may stop the download by returning True. Other requests
+	for a url that is already being downloaded, with the same headers,
+	wait for that download rather than making their own (see
+	pool.SingleFlight).
+	'''
+
+	def __init__(self, user_agent=None, limiter=None, max_redirects=5, retries=2):
+		self.user_agent = user_agent or random_user_agent(allow_ie=False)
+		self.limiter = limiter
+		self.max_redirects, self.retries = max_redirects, retries
+		self.idle = {}
+		self.lock = RLock()
+
+	def open(self, url, timeout=30, headers=None, consumer=None):
+		if consumer is None:
+			# Callers wanting the same page at the same time share one download
+			from calibre_plugins.isfdb.pool import get_flights
+			return get_flights().do(self._flight_key(url, headers), self._open, url, timeout, headers, consumer)
+		return self._open(url, timeout, headers, consumer)
+
+	def _open(self, url, timeout, headers, consumer):
+		state = {'redirects': 0, 'retries': 0}
+		while True:
+			try:
+				response = self._request(url, timeout, headers, consumer)
+			except URLError as e:
+				url = self._next_url(url, None, e, state)
+				continue
+			next_url = self._next_url(url, response, None, state)
+			if next_url is None:
+				return response
+			url = next_url
+
+	def open_async(self, url, timeout=30, headers=None):
+		'''
+		Like open, but return a Future for the response at once. The request
+		is made on the shared event loop (see engine.py), so nothing waits
+		for the server in a thread of its own. Requests through a proxy fall
+		back to open on the shared pool.
+		'''
+		from calibre_plugins.isfdb.pool import get_flights
+		return get_flights().share(self._flight_key(url, headers), lambda: self._open_async(url, timeout, headers))
+
+	def _flight_key(self, url, headers):
+		return ('GET', url) + tuple(sorted((headers or {}).items()))
+
+	def _open_async(self, url, timeout, headers):
+		from calibre_plugins.isfdb.pool import Future, get_pool, submit_future
+		if get_proxies(debug=False).get(urlsplit(url).scheme.lower()):
+			return submit_future(get_pool(), self._open, url, timeout, headers, None)
+		future = Future()
+		self._request_async(future, url, timeout, headers, {'redirects': 0, 'retries': 0})
+		return future
+
+	def _request_async(self, future, url, timeout, headers, state):
+		from calibre_plugins.isfdb.engine import get_loop
+		def done(status, response_headers, data, error):
+			try:
+				if error is not None:
+					if self.limiter is not None and isinstance(error, socket.timeout):
+						self.limiter.failure()
+					error = URLError(error)
+					response = None
+				else:
+					self._report(status, response_headers)
+					with stats.timer('decompress'):
+						data = decode_body(data, response_headers.get('content-encoding'))
+					response = Response(url, status, response_headers, data)
+				next_url = self._next_url(url, response, error, state)
+			except:
+				future.set_exception()
+				return
+			if next_url is None:
+				future.set_result(response)
+			else:
+				self._request_async(future, next_url, timeout, headers, state)
+		get_loop().request(url, self._headers(urlsplit(url).netloc, headers), timeout, done, self.limiter)
+
+	def _next_url(self, url, response, error, state):
+		'''
+		What to do after a request for url has either given response or
+		failed with error: returns the url to request next, None if response
+		is the final one, or raises. state carries the redirect and retry
+		counts from one request of an open to the next.
+		'''
+		if error is not None:
+			if isinstance(error.reason, socket.timeout) and state['retries'] < self.retries:
+				state['retries'] += 1
+				stats.count('retries')
+				return url
+			raise error
+		location = response.headers.get('location')
+		if response.code in REDIRECT_CODES and location:
+			if state['redirects'] >= self.max_redirects:
+				raise URLError('Too many redirects: %r' % url)
+			state['redirects'] += 1
+			stats.count('redirects')
+			return urljoin(url, location)
+		if is_throttled(response.code) and state['retries'] < self.retries:
+			state['retries'] += 1
+			stats.count('retries')
+			return url
+		if response.code >= 400:
+			raise HTTPError(response.url, response.code, httplib.responses.get(response.code, ''),
+				response.headers, StringIO(response.data))
+
+	def _headers(self, host, headers):
+		request_headers = {
+			'Host': host,
+			'User-Agent': self.user_agent,
+			'Accept-Encoding': 'gzip, deflate',
+			'Connection': 'keep-alive',
+		}
+		if headers:
+			request_headers.update(headers)
+		return request_headers
+
+	def _report(self, status, response_headers):
+		'''
+		Tell the rate limiter how a request went.
+		'''
+		if self.limiter is not None:
+			if is_throttled(status):
+				stats.count('throttled')
+				retry_after = response_headers.get('retry-after', '')
+				self.limiter.failure(int(retry_after) if retry_after.isdigit() else None)
+			else:
+				self.limiter.success()
+
+	def _request(self, url, timeout, headers, consumer=None):
+		parts = urlsplit(url)
+		scheme, host = parts.scheme.lower(), parts.netloc
+		path = parts.path or '/'
+		if parts.query:
+			path += '?' + parts.query
+
+		proxy = get_proxies(debug=False).get(scheme)
+		if proxy and scheme == 'http':
+			# Plain http goes through the proxy with an absolute url
+			key, path = ('http', proxy, None), url
+		else:
+			key = (scheme, host, proxy)
+
+		request_headers = self._headers(host, headers)
+
+		if self.limiter is not None:
+			with stats.timer('rate_limit_wait'):
+				self.limiter.acquire()
+		stats.count('requests')
+		start = time.time()
+
+		# A pooled connection may have been closed by the server since its
+		# last use, in which case we retry once on a fresh one.
+		for attempt in range(2):
+			conn, reused = self._checkout(key, timeout)
+			try:
+				conn.request('GET', path, headers=request_headers)
+				r = conn.getresponse()
+				if consumer is not None and r.status == 200:
+					data, received, complete = self._stream(r, consumer)
+				else:
+					data = r.read()
+					received, complete = len(data), True
+			except socket.timeout as e:
+				conn.close()
+				stats.count('timeouts')
+				if self.limiter is not None:
+					self.limiter.failure()
+				raise URLError(e)
+			except (httplib.HTTPException, socket.error) as e:
+				conn.close()
+				if reused and attempt == 0:
+					continue
+				raise URLError(e)
+			break
+		stats.add_time('network', time.time() - start)
+		stats.count('bytes_received', received)
+		if reused:
+			stats.count('connections_reused')
+
+		response_headers = dict(r.getheaders())
+		self._report(r.status, response_headers)
+		if r.will_close or not complete:
+			conn.close()
+		else:
+			self._checkin(key, conn)
+		if consumer is None or r.status != 200:
+			with stats.timer('decompress'):
+				data = decode_body(data, response_headers.get('content-encoding'))
+		return Response(url, r.status, response_headers, data)
+
+	def _stream(self, r, consumer):
+		'''
+		Read the body of r in chunks, passing each to consumer once
+		decompressed, until it returns True. Returns the data read (also
+		decompressed), the number of bytes received and whether the whole
+		body was read.
+		'''
+		encoding = (r.getheader('content-encoding') or '').lower()
+		if encoding == 'gzip':
+			decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		elif encoding == 'deflate':
+			decompressor = zlib.decompressobj()
+		else:
+			decompressor = None
+		chunks, received = [], 0
+		while True:
+			chunk = r.read(STREAM_CHUNK_SIZE)
+			if not chunk:
+				tail = decompressor.flush() if decompressor is not None else b''
+				if tail:
+					chunks.append(tail)
+					consumer(tail)
+				return b''.join(chunks), received, True
+			received += len(chunk)
+			if decompressor is not None:
+				with stats.timer('decompress'):
+					chunk = decompressor.decompress(chunk)
+			chunks.append(chunk)
+			if chunk and consumer(chunk):
+				break
+		# r.length is what is left of a Content-Length body, None if chunked
+		if r.length is not None and r.length <= DRAIN_LIMIT:
+			received += len(r.read())
+			return b''.join(chunks), received, True
+		stats.count('streams_cut_short')
+		return b''.join(chunks), received, False
+
+	def _checkout(self, key, timeout):
+		with self.lock:
+			idle = self.idle.get(key)
+			conn = idle.pop() if idle else None
+		if conn is not None:
+			conn.timeout = timeout
+			if conn.sock is not None:
+				conn.sock.settimeout(timeout)
+			return conn, True
+
+		scheme, host, proxy = key
+		if scheme == 'https':
+			if proxy:
+				conn = httplib.HTTPSConnection(proxy, timeout=timeout)
+				conn.set_tunnel(host)
+			else:
+				conn = httplib.HTTPSConnection(host, timeout=timeout)
+		else:
+			conn = httplib.HTTPConnection(host, timeout=timeout)
+		return conn, False
+
+	def _checkin(self, key, conn):
+		with self.lock:
+			self.idle.setdefault(key, []).append(conn)
+
+	def close(self):
+		with self.lock:
+			for conns in self.idle.values():
+				for conn in conns:
+					conn.close()
+			self.idle.clear()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time, json
+from contextlib import contextmanager
+from threading import RLock
+
+class Stats(object):
+
+	'''
+	Process-wide timers and counters for the plugin's hot paths.
+
+	Timers are per phase (network, decode, lxml_parse, ...) and record how
+	often the phase ran, its total and its worst time. Counters are plain
+	running totals (requests, bytes, cache hits, ...). Phases can nest, so
+	timings are not meant to add up to the wall clock time.
+	'''
+
+	def __init__(self):
+		self.lock = RLock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.started = time.time()
+			self.timers = {}
+			self.counters = {}
+
+	@contextmanager
+	def timer(self, phase):
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.add_time(phase, time.time() - start)
+
+	def add_time(self, phase, seconds):
+		with self.lock:
+			t = self.timers.get(phase)
+			if t is None:
+				t = self.timers[phase] = [0, 0.0, 0.0]
+			t[0] += 1
+			t[1] += seconds
+			t[2] = max(t[2], seconds)
+
+	def count(self, name, n=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def snapshot(self):
+		'''
+		Everything recorded since the last reset, as plain data.
+		'''
+		with self.lock:
+			return {
+				'elapsed_ms': (time.time() - self.started) * 1000,
+				'timers': dict((phase, {'count': n, 'total_ms': total * 1000,
+					'mean_ms': total * 1000 / n, 'max_ms': worst * 1000})
+					for phase, (n, total, worst) in self.timers.items()),
+				'counters': dict(self.counters),
+			}
+
+	def to_json(self):
+		return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+	def log_summary(self, log):
+		snap = self.snapshot()
+		log.info('ISFDB stats over %.1fs:' % (snap['elapsed_ms'] / 1000))
+		for phase, t in sorted(snap['timers'].items(), key=lambda x: -x[1]['total_ms']):
+			log.info('  %-24s %6d x %9.1fms total %8.2fms mean %8.1fms max' % (phase, t['count'],
+				t['total_ms'], t['mean_ms'], t['max_ms']))
+		if snap['counters']:
+			log.info('  ' + ', '.join('%s=%d' % item for item in sorted(snap['counters'].items())))
+
+	def log_summary_every(self, log, phase, every):
+		'''
+		log_summary, but only once phase has been timed for the first time
+		and then every every times. For calls that are each only a small
+		part of the work, such as calibre's identify.
+		'''
+		with self.lock:
+			n = self.timers.get(phase, [0])[0]
+		if n and (n - 1) % every == 0:
+			self.log_summary(log)
+
+stats = Stats()
@@ -9,44 +9,154 @@ __docformat__ = 'restructuredtext en'
 
 import socket, re, datetime
 from collections import OrderedDict
-from threading import Thread
 
-from lxml.html import fromstring, tostring
+from lxml.html import tostring
 
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.library.comments import sanitize_comments_html
-from calibre.utils.cleantext import clean_ascii_chars
+from calibre.utils.icu import lower
 
 import calibre_plugins.isfdb.config as cfg
+import calibre_plugins.isfdb.parse as parse
+from calibre_plugins.isfdb.parse import page_to_tree
+from calibre_plugins.isfdb.stats import stats
 
-class Worker(Thread): # Get details
+def convert_date_text(date_text):
+	# 2008-08-00
+	try:
+		year = int(date_text[0:4])
+		month = int(date_text[5:7])
+		if month == 0:
+			month = 1
+		day = int(date_text[8:10])
+		if day == 0:
+			day = 1
+		from calibre.utils.date import utc_tz
+		pubdate = datetime.datetime(year, month, day, tzinfo=utc_tz)
+		return pubdate
+	except:
+		return None # not a parseable date
 
+def parse_cover_url(root):
+	img_src = parse.COVER_SRC(root)
+	if img_src:
+		# A plain string: an lxml "smart" string keeps the whole tree alive
+		# and cannot be pickled (see Source.dump_caches)
+		return unicode(img_src[0])
+
+def parse_title_record(root):
+	'''
+	The work level data (see cache.WORK_FIELDS) on a title page.
+	'''
+	work = {'series': None, 'series_index': None, 'tags': []}
+	for node in parse.TITLE_ITEMS(root):
+		if not len(node):
+			continue
+		section = node[0].text_content().strip().rstrip(':')
+		if section == 'Series':
+			links = parse.CHILD_LINKS(node)
+			if links:
+				work['series'] = links[0].text_content().strip() or None
+		elif section == 'Series Number':
+			try:
+				work['series_index'] = float((node[0].tail or '').strip())
+			except ValueError:
+				pass
+		elif section == 'Current Tags':
+			work['tags'] = [a.text_content().strip() for a in parse.CHILD_LINKS(node)
+				if 'tag.cgi?' in a.get('href', '') and a.text_content().strip()]
+	return work
+
+def revalidation_headers(cache, url):
 	'''
-	Get book details from ISFDB book page in a separate thread.
+	Headers making a request for url conditional on the page having changed
+	since it was cached, if the server sent validators with it. None
+	when the cache is turned off.
 	'''
+	import calibre_plugins.isfdb.config as cfg
+	if cfg.get_option(cfg.KEY_CACHE_TTL) <= 0:
+		return None
+	validators = cache.get_validators(url)
+	if validators is None:
+		return None
+	etag, last_modified = validators
+	headers = {}
+	if etag:
+		headers['If-None-Match'] = etag
+	if last_modified:
+		headers['If-Modified-Since'] = last_modified
+	return headers
+
+def record_to_metadata(record):
+	'''
+	Build a Metadata object from a parsed (or cached) publication record.
+	'''
+	mi = Metadata(record['title'], record['authors'])
+	mi.set_identifier('isfdb', record['isfdb_id'])
+
+	if record.get('isbn'):
+		mi.isbn = record['isbn']
+	if record.get('publisher'):
+		mi.publisher = record['publisher']
+	pubdate = convert_date_text(record.get('pubdate') or '')
+	if pubdate:
+		mi.pubdate = pubdate
+	if record.get('comments') and cfg.get_option(cfg.KEY_APPEND_CONTENTS):
+		mi.comments = record['comments']
+	# Only there when the title record was read, see ISFDB.title_details
+	if record.get('series'):
+		mi.series = record['series']
+		if record.get('series_index') is not None:
+			mi.series_index = record['series_index']
+	if record.get('tags'):
+		mi.tags = record['tags']
 
-	def __init__(self, url, result_queue, browser, log, relevance, plugin, timeout=20):
-        print("Ohai")
-		Thread.__init__(self)
-		self.daemon = True
+	mi.has_cover = bool(record.get('cover_url'))
+	mi.cover_url = record.get('cover_url') # This is purely so we can run a test for it!!!
+	return mi
+
+class Worker(object): # Get details
+
+	'''
+	Get book details from ISFDB book page. Run on the shared pool. If
+	response is set to a Future for the page (see Session.open_async) the
+	page is taken from that instead of being downloaded here.
+
+	A page that was cached with validators is only downloaded if it has
+	changed; otherwise its cached records are used as they are.
+	'''
+
+	def __init__(self, url, result_queue, log, relevance, plugin, timeout=20):
 		self.url, self.result_queue = url, result_queue
 		self.log, self.timeout = log, timeout
 		self.relevance, self.plugin = relevance, plugin
-		self.browser = browser.clone_browser()
+		self.session = plugin.session
 		self.cover_url = self.isfdb_id = self.isbn = None
+		self.response = None
+		self.conditional = True
+		self.not_modified = False
+		self.validators = (None, None)
 
 	def run(self):
-        print("Ohai")
 		try:
 			self.get_details()
 		except:
 			self.log.exception('get_details failed for url: %r'%self.url)
 
-	def get_details(self):
+	def fetch(self):
 		try:
-            print('ISFDB url: %r'%self.url)
 			self.log.info('ISFDB url: %r'%self.url)
-			raw = self.browser.open_novisit(self.url, timeout=self.timeout).read().strip()
+			if self.response is not None:
+				response = self.response.result()
+			else:
+				headers = revalidation_headers(self.plugin.metadata_cache, self.url) if self.conditional else None
+				response = self.plugin.open_url(self.url, self.timeout, headers)
+			self.not_modified = response.getcode() == 304
+			if self.not_modified:
+				return
+			info = response.info()
+			self.validators = (info.get('etag'), info.get('last-modified'))
+			raw = response.read().strip()
 		except Exception as e:
 			if callable(getattr(e, 'getcode', None)) and \
 					e.getcode() == 404:
@@ -61,21 +171,74 @@ class Worker(Thread): # Get details
 				msg = 'Failed to make details query: %r'%self.url
 				self.log.exception(msg)
 			return
+		return raw
+
+	def get_details(self):
+		# Another identify fetching the same page at the same time (a
+		# download_cover, or a book in the same batch with the same match)
+		# lends us its records rather than having it fetched and parsed twice
+		from calibre_plugins.isfdb.pool import get_flights
+		for record in get_flights().do(('details', self.url), self.load):
+			self.isfdb_id, self.isbn, self.cover_url = record['isfdb_id'], record['isbn'], record.get('cover_url')
+			self.publish(record)
+
+	def load(self):
+		'''
+		Fetch and parse the page, returning the records found on it (cached
+		as well, and with the data of their title records if wanted) and
+		logging anything that went wrong.
+		'''
+		cache = self.plugin.metadata_cache
+		loaded = self.load_records()
+		if self.not_modified:
+			loaded = cache.revalidate(self.url)
+			if loaded is not None:
+				stats.count('not_modified')
+				self.log.info('Not modified since cached: %r' % self.url)
+			else:
+				# The records are gone from the cache, so ask again for the page
+				self.conditional, self.response, self.not_modified = False, None, False
+				loaded = self.load_records()
+		if not self.not_modified:
+			self.store(loaded)
+		records = []
+		for record in loaded:
+			work = self.plugin.title_details(self.log, record, self.timeout)
+			records.append(dict(record, **work) if work else record)
+		return records
+
+	def store(self, loaded):
+		'''
+		Cache the records read from the page, along with its validators.
+		'''
+		cache = self.plugin.metadata_cache
+		for record in loaded:
+			cache.put(record)
+			if record.get('title_id'):
+				cache.put_title_id(record['isfdb_id'], record['title_id'])
+		if loaded:
+			cache.put_validators(self.url, self.validators[0], self.validators[1],
+				[record['isfdb_id'] for record in loaded])
 
-		raw = raw.decode('cp1252', errors='replace')
+	def load_records(self):
+		raw = self.fetch()
+		if raw is None:
+			return []
 
-		if '<title>404 - ' in raw:
+		if b'<title>404 - ' in raw:
 			self.log.error('URL malformed: %r'%self.url)
-			return
+			return []
 
 		try:
-			root = fromstring(clean_ascii_chars(raw))
+			root = page_to_tree(raw)
 		except:
 			msg = 'Failed to parse ISFDB details page: %r'%self.url
 			self.log.exception(msg)
-			return
+			return []
 
-		self.parse_details(root)
+		with stats.timer('details_extract'):
+			record = self.parse_details(root)
+		return [record] if record is not None else []
 
 	def parse_details(self, root):
 		isfdb_id = None
@@ -90,9 +253,9 @@ class Worker(Thread): # Get details
 		except:
 			self.log.exception('Error parsing ISFDB ID for url: %r' % self.url)
         
-		detail_nodes = root.xpath('//div[@id="content"]//td[@class="pubheader"]/ul/li')
+		detail_nodes = parse.DETAIL_ITEMS(root)
 		if not detail_nodes:
-			detail_nodes = root.xpath('//div[@id="content"]/div/ul/li') # no table (on records with no image)
+			detail_nodes = parse.DETAIL_ITEMS_NO_TABLE(root)
 
 		for detail_node in detail_nodes:
 			section = detail_node[0].text_content().strip().rstrip(':')
@@ -105,7 +268,7 @@ class Worker(Thread): # Get details
 						title = detail_node[1].text_content().strip()
                     #self.log.info(title)
 				elif section == 'Authors' or section == 'Editors':
-					for a in detail_node.xpath('.//a'):
+					for a in parse.DESCENDANT_LINKS(detail_node):
 						author = a.text_content().strip()
 						if section.startswith('Editors'):
 							authors.append(author + ' (Editor)')
@@ -116,10 +279,10 @@ class Worker(Thread): # Get details
 					isbn = detail_node[0].tail.strip('[] \n')
                     #self.log.info(isbn)
 				elif section == 'Publisher':
-					publisher = detail_node.xpath('a')[0].text_content().strip()
+					publisher = parse.CHILD_LINKS(detail_node)[0].text_content().strip()
                     #self.log.info(publisher)
 				elif section == 'Date':
-					pubdate = self._convert_date_text(detail_node[0].tail.strip())
+					pubdate = detail_node[0].tail.strip()
                     #self.log.info(pubdate)
 			except:
 				self.log.exception('Error parsing section %r for url: %r' % (section, self.url) )
@@ -130,70 +293,53 @@ class Worker(Thread): # Get details
 				authors))
 			return
 
-		mi = Metadata(title, authors)
-		mi.set_identifier('isfdb', isfdb_id)
-		self.isfdb_id = isfdb_id
-
-		if isbn:
-			self.isbn = mi.isbn = isbn
-		if publisher:
-			mi.publisher = publisher
-		if pubdate:
-			mi.pubdate = pubdate
-			
+		record = {'isfdb_id': isfdb_id, 'title': title, 'authors': authors,
+			'isbn': isbn, 'publisher': publisher, 'pubdate': pubdate}
+
 		try:
-			mi.comments = self.parse_comments(root)
+			record['comments'] = self.parse_comments(root)
 		except:
 			self.log.exception('Error parsing comments for url: %r'%self.url)
 
 		try:
-			self.cover_url = self.parse_cover(root)
+			record['cover_url'] = self.parse_cover(root)
 		except:
 			self.log.exception('Error parsing cover for url: %r'%self.url)
-		
-		mi.has_cover = bool(self.cover_url)
-		mi.cover_url = self.cover_url # This is purely so we can run a test for it!!!
-
-		mi.source_relevance = self.relevance
-
-		if self.isfdb_id:
-			if self.isbn:
-				self.plugin.cache_isbn_to_identifier(self.isbn, self.isfdb_id)
 
-		self.plugin.clean_downloaded_metadata(mi)
-		self.result_queue.put(mi)
-
-	def _convert_date_text(self, date_text):
-		# 2008-08-00
 		try:
-			year = int(date_text[0:4])
-			month = int(date_text[5:7])
-			if month == 0:
-				month = 1
-			day = int(date_text[8:10])
-			if day == 0:
-				day = 1
-			from calibre.utils.date import utc_tz
-			pubdate = datetime.datetime(year, month, day, tzinfo=utc_tz)
-			return pubdate
+			record['title_id'] = self.parse_title_id(root, title)
 		except:
-			return None # not a parseable date
+			self.log.exception('Error parsing title record for url: %r'%self.url)
+
+		return record
+
+	def publish(self, record):
+		self.plugin.queue_record(record, self.relevance, self.result_queue)
 
 	def parse_comments(self, root):
-		default_append_contents = cfg.DEFAULT_STORE_VALUES[cfg.KEY_APPEND_CONTENTS]
-		append_contents = cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_APPEND_CONTENTS, default_append_contents)
-		comments = ''
-		if append_contents:
-			contents_node = root.xpath('//div[@class="ContentBox"][2]/ul')
-			if contents_node:
-				contents = tostring(contents_node[0], method='html')
-				comments += contents
-		if comments:
-			return comments
+		# Always extracted so that cached records can honour a later change
+		# of KEY_APPEND_CONTENTS; see record_to_metadata.
+		contents_node = parse.CONTENTS_LIST(root)
+		if contents_node:
+			return tostring(contents_node[0], method='html')
 
 	def parse_cover(self, root):
-		img_src = root.xpath('//div[@id="content"]//table/tr[1]/td[1]/a/img/@src')
-		if img_src:
-			page_url = img_src[0]
-			self.plugin.cache_identifier_to_cover_url(self.isfdb_id, page_url)
-			return page_url
+		return parse_cover_url(root)
+
+	def parse_title_id(self, root, title):
+		'''
+		The title record of the work this is an edition of: the contents
+		entry with the publication's title, or the only entry there is.
+		'''
+		links = parse.CONTENTS_TITLE_LINKS(root)
+		title = lower(title)
+		for a in links:
+			if lower(a.text_content().strip()) == title:
+				break
+		else:
+			if len(links) != 1:
+				return None
+			a = links[0]
+		match = re.search('title\.cgi\?(\d+)', a.get('href', ''))
+		if match is not None:
+			return match.group(1)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import re
+from io import BytesIO
+
+from lxml import etree
+from lxml.html import builder as E, tostring
+
+from calibre_plugins.isfdb.cache import EDITED_TYPES
+from calibre_plugins.isfdb.stats import stats
+from calibre_plugins.isfdb.worker import Worker
+
+# How the web API says it has nothing for a query
+XML_NO_RECORDS = re.compile(br'<Records>\s*0\s*</Records>')
+
+def _text(node, path):
+	text = node.findtext(path)
+	if text:
+		return text.strip() or None
+
+def _contents_html(contents):
+	if contents is None:
+		return None
+	items = []
+	for entry in contents:
+		title = _text(entry, 'cTitle') or _text(entry, 'Title')
+		if not title:
+			continue
+		authors = [a.text.strip() for a in entry.iter('cAuthor', 'Author') if a.text and a.text.strip()]
+		items.append(E.LI(title + (' by ' + ', '.join(authors) if authors else '')))
+	if items:
+		return tostring(E.UL(*items), method='html')
+
+def parse_publications(raw):
+	'''
+	Yield a record (see cache.RECORD_FIELDS) for each <Publication> in a
+	response from the ISFDB web API. The XML is parsed incrementally and
+	each publication is discarded once read, so a response listing many
+	editions never has to be held as a whole tree.
+	'''
+	for event, pub in etree.iterparse(BytesIO(raw), tag='Publication'):
+		authors = [a.text.strip() for a in pub.iterfind('Authors/Author') if a.text and a.text.strip()]
+		if (_text(pub, 'Type') or '').upper() in EDITED_TYPES:
+			authors = [a + ' (Editor)' for a in authors]
+		record = {
+			'isfdb_id': _text(pub, 'Record'),
+			'title': _text(pub, 'Title'),
+			'authors': authors,
+			'isbn': _text(pub, 'Isbn'),
+			'publisher': _text(pub, 'Publisher'),
+			'pubdate': _text(pub, 'Year'),
+			'comments': _contents_html(pub.find('Contents')),
+			'cover_url': _text(pub, 'Image'),
+		}
+
+		pub.clear()
+		while pub.getprevious() is not None:
+			del pub.getparent()[0]
+
+		if record['isfdb_id'] and record['title'] and record['authors']:
+			yield record
+
+class XMLWorker(Worker):
+
+	'''
+	Get book details from the ISFDB web API instead of the HTML book page.
+	'''
+
+	def load_records(self):
+		raw = self.fetch()
+		if raw is None:
+			return []
+
+		try:
+			with stats.timer('xml_parse'):
+				records = list(parse_publications(raw))
+		except:
+			self.log.exception('Failed to parse ISFDB XML response: %r' % self.url)
+			return []
+
+		if not records:
+			self.log.error('No publication found at: %r' % self.url)
+		return records
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, shutil, tempfile, unittest
+from Queue import Queue, Empty
+from threading import Event
+
+from server import start_server
+
+class PluginTestCase(unittest.TestCase):
+
+	'''
+	Runs each test with a cache of its own and the plugin pointed at a
+	stand-in server of its own, started with server_options. The plugin's
+	options are those in options over the defaults below.
+	'''
+
+	options = {}
+	server_options = {}
+
+	def setUp(self):
+		from calibre.customize.ui import find_plugin
+		from calibre.utils.logging import ThreadSafeLog
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.cache import open_cache
+		from calibre_plugins.isfdb.ratelimit import get_limiter
+		self.tdir = tempfile.mkdtemp(prefix='isfdb-test-')
+		self.cache = open_cache(os.path.join(self.tdir, 'cache.sqlite'))
+		self.saved_options = dict(cfg.option_overrides)
+		cfg.option_overrides.update({
+			cfg.KEY_CACHE_TTL: 30,
+			cfg.KEY_REQUESTS_PER_SECOND: 10000,
+			cfg.KEY_BACKEND: cfg.BACKEND_HTML,
+		})
+		cfg.option_overrides.update(self.options)
+		get_limiter().set_max_rate(10000)
+
+		self.server = start_server(**self.server_options)
+		self.plugin = find_plugin('ISFDB')
+		self.saved_base_url = self.plugin.BASE_URL
+		self.plugin.set_base_url(self.server.base_url)
+		# Nothing left over in memory from other tests
+		self.plugin._isbn_to_identifier_cache.clear()
+		self.plugin._identifier_to_cover_url_cache.clear()
+		self.plugin._cover_candidates.clear()
+		self.log = ThreadSafeLog(level=ThreadSafeLog.ERROR)
+
+	def tearDown(self):
+		import calibre_plugins.isfdb.config as cfg
+		self.plugin.set_base_url(self.saved_base_url)
+		cfg.option_overrides.clear()
+		cfg.option_overrides.update(self.saved_options)
+		# Let the server's threads for kept-alive connections finish
+		self.plugin.session.close()
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.tdir, ignore_errors=True)
+
+	def identify(self, **kwargs):
+		'''
+		The results of an identify call, most relevant first.
+		'''
+		rq = Queue()
+		self.plugin.identify(self.log, rq, Event(), timeout=10, **kwargs)
+		results = []
+		while True:
+			try:
+				results.append(rq.get_nowait())
+			except Empty:
+				return sorted(results, key=lambda mi: mi.source_relevance)
+
+	def assertRequests(self, count, func, *args, **kwargs):
+		'''
+		Call func, checking that it sends count requests to the server.
+		Returns what func returns.
+		'''
+		before = self.server.requests
+		result = func(*args, **kwargs)
+		self.assertEqual(self.server.requests - before, count)
+		return result
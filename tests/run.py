@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Offline tests for the ISFDB plugin. They read the pages in bench/fixtures
+and talk to the stand-in server in bench/server.py, so nothing touches
+isfdb.org. Install the plugin, then:
+
+	calibre-customize -b isfdb-plugin
+	calibre-debug -e tests/run.py
+
+Name test modules (e.g. test_cache) to run only those.
+'''
+
+import os, sys, unittest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS), 'bench'))
+sys.path.insert(0, TESTS)
+
+def main(args):
+	loader = unittest.defaultTestLoader
+	if args:
+		suite = loader.loadTestsFromNames(args)
+	else:
+		suite = loader.discover(TESTS, pattern='test_*.py', top_level_dir=TESTS)
+	result = unittest.TextTestRunner(verbosity=2).run(suite)
+	return 0 if result.wasSuccessful() else 1
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	sys.exit(main(args[1:] if args[:1] == ['--'] else args))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import io, json, os, sys, unittest
+
+from base import PluginTestCase
+
+class IdentifyCommandTest(PluginTestCase):
+
+	def run_command(self, books, *args):
+		from calibre_plugins.isfdb.cli import main
+		path = os.path.join(self.tdir, 'books.csv')
+		with open(path, 'wb') as f:
+			f.write(books)
+		output = os.path.join(self.tdir, 'results.jsonl')
+		main(self.plugin, ['identify', path, '-o', output, '--base-url', self.server.base_url] + list(args))
+		with io.open(output, encoding='utf-8') as f:
+			return sorted((json.loads(line) for line in f), key=lambda r: r['index'])
+
+	def test_results(self):
+		results = self.run_command(b'title,authors,isbn\n'
+			b'Black House,Stephen King & Peter Straub,9780345470638\n'
+			b'Black House,Stephen King & Peter Straub,\n', '--concurrency', '2')
+		self.assertEqual([r['index'] for r in results], [0, 1])
+		for r in results:
+			self.assertEqual(r['authors'], ['Stephen King', 'Peter Straub'])
+			self.assertEqual(r['results'][0]['title'], 'Black House')
+			self.assertGreater(r['seconds'], 0)
+		self.assertEqual(results[0]['identifiers'], {'isbn': '9780345470638'})
+
+	def test_stdout(self):
+		path = os.path.join(self.tdir, 'books.csv')
+		with open(path, 'wb') as f:
+			f.write(b'title,authors,isbn\nBlack House,Stephen King & Peter Straub,\n,,9780345470638\n')
+		from calibre_plugins.isfdb.cli import main
+		# The results are written to file descriptor 1, not sys.stdout
+		captured = os.path.join(self.tdir, 'stdout')
+		sys.stdout.flush()
+		saved = os.dup(1)
+		try:
+			with open(captured, 'wb') as f:
+				os.dup2(f.fileno(), 1)
+				main(self.plugin, ['identify', path, '--base-url', self.server.base_url])
+				sys.stdout.flush()
+		finally:
+			os.dup2(saved, 1)
+			os.close(saved)
+		with io.open(captured, encoding='utf-8') as f:
+			lines = f.read().splitlines()
+		# Nothing but the results
+		self.assertEqual(sorted(json.loads(line)['index'] for line in lines), [0, 1])
+
+	def test_missing_cover_dir_is_created(self):
+		cover_dir = os.path.join(self.tdir, 'covers', 'new')
+		results = self.run_command(b'isbn\n9780345470638\n', '--cover-dir', cover_dir)
+		self.assertGreater(results[0]['cover_bytes'], 0)
+		self.assertTrue(os.path.isfile(os.path.join(cover_dir, '0.jpg')))
+
+if __name__ == '__main__':
+	unittest.main()
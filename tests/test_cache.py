@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, pickle, shutil, tempfile, time, unittest
+from Queue import Queue
+from threading import Event
+
+from base import PluginTestCase
+
+BLACK_HOUSE = dict(title='Black House', authors=['Stephen King', 'Peter Straub'])
+
+class IsbnFormsTest(unittest.TestCase):
+
+	def test_both_forms(self):
+		from calibre_plugins.isfdb.cache import isbn_forms
+		self.assertEqual(isbn_forms('034547063X'), ['034547063X', '9780345470638'])
+		self.assertEqual(isbn_forms('9780345470638'), ['9780345470638', '034547063X'])
+		self.assertEqual(isbn_forms('9791032305690'), ['9791032305690'])
+
+class IsbnCacheTest(PluginTestCase):
+
+	# Like isfdb.org, so that nothing is revalidated
+	server_options = {'validators': False}
+
+	def test_repeat_isbn_identify_is_cached(self):
+		results = self.assertRequests(3, self.identify, identifiers={'isbn': '9780345470638'}, **BLACK_HOUSE)
+		self.assertEqual(results[0].title, 'Black House')
+		# Found under either form of the ISBN, with no requests at all
+		for isbn in ('9780345470638', '034547063X', '0-345-47063-X'):
+			again = self.assertRequests(0, self.identify, identifiers={'isbn': isbn}, **BLACK_HOUSE)
+			self.assertEqual(again[0].identifiers, results[0].identifiers)
+
+	def test_cover_lookup_caches_record(self):
+		# The search, the book page and the image
+		identifiers = {'isbn': '9780345470638'}
+		self.assertRequests(3, self.plugin.download_cover, self.log, Queue(), Event(),
+			identifiers=identifiers, timeout=10)
+		results = self.assertRequests(0, self.identify, title='', identifiers=identifiers)
+		self.assertEqual(results[0].title, 'Black House')
+
+	def test_dump_and_load_caches(self):
+		# As calibre does when metadata download runs in a worker process
+		isfdb_id = self.identify(identifiers={'isbn': '9780345470638'}, **BLACK_HOUSE)[0].identifiers['isfdb']
+		dump = pickle.loads(pickle.dumps(self.plugin.dump_caches()))
+		self.plugin._isbn_to_identifier_cache.clear()
+		self.plugin._identifier_to_cover_url_cache.clear()
+		self.plugin.load_caches(dump)
+		self.assertEqual(sorted(self.plugin.get_related_isbns(isfdb_id)), ['034547063X', '9780345470638'])
+		self.assertIn(isfdb_id, self.plugin._identifier_to_cover_url_cache)
+
+	def test_repeat_isbn_identify_xml(self):
+		import calibre_plugins.isfdb.config as cfg
+		cfg.option_overrides[cfg.KEY_BACKEND] = cfg.BACKEND_XML
+		self.assertRequests(1, self.identify, identifiers={'isbn': '9780345470638'}, **BLACK_HOUSE)
+		self.assertRequests(0, self.identify, identifiers={'isbn': '9780345470638'}, **BLACK_HOUSE)
+
+def record(isfdb_id):
+	return {'isfdb_id': isfdb_id, 'isbn': None, 'title': 'Black House', 'authors': ['Stephen King'],
+		'publisher': None, 'pubdate': None, 'comments': '<p>Comments</p>', 'cover_url': None}
+
+class PurgeTest(unittest.TestCase):
+
+	def setUp(self):
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.cache import MetadataCache
+		self.tdir = tempfile.mkdtemp(prefix='isfdb-test-')
+		self.cache = MetadataCache(os.path.join(self.tdir, 'cache.sqlite'))
+		self.saved_options = dict(cfg.option_overrides)
+		cfg.option_overrides.update({cfg.KEY_CACHE_TTL: 1, cfg.KEY_MISSING_TTL: 1})
+
+	def tearDown(self):
+		import calibre_plugins.isfdb.config as cfg
+		cfg.option_overrides.clear()
+		cfg.option_overrides.update(self.saved_options)
+		shutil.rmtree(self.tdir, ignore_errors=True)
+
+	def age(self, table, column, days):
+		with self.cache.lock:
+			with self.cache.conn:
+				self.cache.conn.execute('UPDATE %s SET %s = ?' % (table, column), (time.time() - days * 24 * 60 * 60,))
+
+	def test_purge_expired(self):
+		from calibre_plugins.isfdb.cache import ANY_AGE
+		self.cache.put(record('1'))
+		self.cache.put_validators('http://isfdb/pl.cgi?1', '"etag"', None, ['1'])
+		self.cache.put_missing('query')
+		self.cache.put_title('10', {'series': 'S', 'series_index': 1.0, 'tags': []})
+		self.age('publications', 'fetched', 2)
+		self.age('missing', 'checked', 2)
+		self.age('titles', 'fetched', 2)
+		self.cache.put(record('2'))
+		self.cache.put_validators('http://isfdb/pl.cgi?2', '"etag"', None, ['2'])
+
+		self.cache.purge_expired()
+		self.assertEqual(self.cache.get('1', ANY_AGE), None)
+		self.assertEqual(self.cache.get_validators('http://isfdb/pl.cgi?1'), None)
+		self.assertEqual(self.cache.get_title('10', ANY_AGE), None)
+		self.assertFalse(self.cache.is_missing('query', ANY_AGE))
+		# What has not expired stays
+		self.assertEqual(self.cache.get('2', ANY_AGE)['comments'], '<p>Comments</p>')
+		self.assertNotEqual(self.cache.get_validators('http://isfdb/pl.cgi?2'), None)
+
+	def test_turned_off_cache_is_kept(self):
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.cache import ANY_AGE
+		self.cache.put(record('1'))
+		self.age('publications', 'fetched', 100)
+		cfg.option_overrides[cfg.KEY_CACHE_TTL] = 0
+		self.cache.purge_expired()
+		self.assertNotEqual(self.cache.get('1', ANY_AGE), None)
+
+class LRUCacheTest(unittest.TestCase):
+
+	def test_eviction(self):
+		from calibre_plugins.isfdb.cache import LRUCache, entry_size
+		lru = LRUCache(3 * entry_size('key0', 'value0'))
+		for i in range(3):
+			lru['key%d' % i] = 'value%d' % i
+		lru.get('key0')
+		lru['key3'] = 'value3'
+		# The least recently used goes
+		self.assertNotIn('key1', lru)
+		self.assertEqual([k in lru for k in ('key0', 'key2', 'key3')], [True] * 3)
+		self.assertEqual(len(lru), 3)
+		self.assertLessEqual(lru.nbytes, lru.max_bytes)
+
+	def test_dict_interface(self):
+		from calibre_plugins.isfdb.cache import LRUCache
+		lru = LRUCache(1024)
+		lru.update({'a': '1'}, b='2')
+		lru.update([('c', '3')])
+		lru.get('a')
+		self.assertEqual(list(lru.copy().items()), [('b', '2'), ('c', '3'), ('a', '1')])
+		self.assertEqual(sorted(lru.keys()), ['a', 'b', 'c'])
+		self.assertEqual(sorted(lru.iteritems()), sorted(lru.items()))
+		# Reading them leaves the order alone
+		self.assertEqual(lru.keys(), ['b', 'c', 'a'])
+
+if __name__ == '__main__':
+	unittest.main()
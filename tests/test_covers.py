@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+from Queue import Queue
+from threading import Event
+
+from base import PluginTestCase
+
+class EditionCoversTest(PluginTestCase):
+
+	def setUp(self):
+		PluginTestCase.setUp(self)
+		import calibre_plugins.isfdb.config as cfg
+		cfg.option_overrides[cfg.KEY_MAX_DOWNLOADS] = 2
+
+	def download_cover(self, mi):
+		rq = Queue()
+		self.plugin.download_cover(self.log, rq, Event(), title=mi.title, authors=mi.authors,
+			identifiers=mi.identifiers, timeout=10)
+		return rq.get_nowait()[1]
+
+	def test_biggest_after_identify(self):
+		from calibre_plugins.isfdb.covers import image_size
+		# As in calibre, identify first, then the cover of the chosen result
+		results = self.identify(title='Black House', authors=['Stephen King', 'Peter Straub'])
+		self.assertEqual(len(results), 2)
+		sizes = [image_size(self.plugin.session.open(mi.cover_url).read()) for mi in results]
+		self.assertNotEqual(sizes[0], sizes[1])
+		smaller = results[sizes.index(min(sizes, key=lambda s: s[0] * s[1]))]
+		self.assertEqual(image_size(self.download_cover(smaller)), max(sizes, key=lambda s: s[0] * s[1]))
+
+	def test_single_cached_cover(self):
+		# Nothing to compare, so no probe
+		mi = self.identify(title='', identifiers={'isbn': '9780345470638'})[0]
+		self.assertRequests(1, self.download_cover, mi)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+from Queue import Queue
+from threading import Event
+
+from base import PluginTestCase
+
+class EventLoopTest(PluginTestCase):
+
+	def setUp(self):
+		PluginTestCase.setUp(self)
+		import calibre_plugins.isfdb.config as cfg
+		cfg.option_overrides.update({cfg.KEY_EVENT_LOOP: True, cfg.KEY_TITLE_DETAILS: True})
+		# Every download has to go through the event loop
+		def blocking_open(*args, **kwargs):
+			raise AssertionError('Session.open called with the event loop on')
+		self.plugin.session.open = blocking_open
+
+	def tearDown(self):
+		self.plugin.session.__dict__.pop('open', None)
+		PluginTestCase.tearDown(self)
+
+	def test_identify(self):
+		results = self.identify(title='Black House', authors=['Stephen King', 'Peter Straub'])
+		self.assertTrue(results)
+		self.assertEqual(results[0].title, 'Black House')
+		results = self.identify(title='', identifiers={'isbn': '9780345470638'})
+		self.assertEqual(len(results), 1)
+
+	def test_download_cover(self):
+		rq = Queue()
+		self.plugin.download_cover(self.log, rq, Event(), title='Black House',
+			authors=['Stephen King', 'Peter Straub'], timeout=10)
+		plugin, cdata = rq.get_nowait()
+		self.assertTrue(cdata.startswith(b'\xff\xd8'))
+
+	def test_largest_cover(self):
+		from calibre_plugins.isfdb.covers import largest_cover
+		urls = ['%s/images/P/%d.jpg' % (self.server.base_url, i) for i in range(4)]
+		probe = largest_cover(self.log, self.plugin.session, urls, 10, True)
+		del self.plugin.session.open
+		expected = largest_cover(self.log, self.plugin.session, urls, 10)
+		self.assertEqual((probe.url, probe.width, probe.height, probe.size),
+			(expected.url, expected.width, expected.height, expected.size))
+
+	def test_connections(self):
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.engine import get_loop
+		self.assertEqual(get_loop().max_per_host, cfg.get_option(cfg.KEY_EVENT_LOOP_CONNECTIONS))
+
+if __name__ == '__main__':
+	unittest.main()
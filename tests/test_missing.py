@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+from Queue import Queue
+from threading import Event
+
+from base import PluginTestCase
+from server import load_fixture
+
+NO_RECORDS_PAGE = b'''<html><body><div id="main">
+<h2>Advanced Search Results</h2>
+<h3>No records found</h3>
+</div></body></html>'''
+
+MAINTENANCE_PAGE = b'''<html><body>
+<h1>The ISFDB is down for maintenance</h1>
+</body></html>'''
+
+QUERY = 'http://www.isfdb.org/cgi-bin/adv_search_results.cgi?USE_1=pub_title&TERM_1=Nowhere&START=0'
+
+def feed(page, chunk=7):
+	from calibre_plugins.isfdb.parse import SearchResults
+	results = SearchResults(['nowhere'], ['nobody'], 5)
+	for i in range(0, len(page), chunk):
+		results.feed(page[i:i + chunk])
+	results.close()
+	return results
+
+class NoRecordsTest(unittest.TestCase):
+
+	def test_no_records(self):
+		# Fed in small chunks, so that the message is split between them
+		self.assertTrue(feed(load_fixture('se_isbn_nomatch.html')).no_records)
+		self.assertTrue(feed(NO_RECORDS_PAGE).no_records)
+
+	def test_other_pages(self):
+		self.assertFalse(feed(MAINTENANCE_PAGE).no_records)
+		results = feed(load_fixture('adv_search_results.html'), 4096)
+		self.assertFalse(results.no_records)
+		self.assertTrue(results.rows)
+
+class MissingCacheTest(PluginTestCase):
+
+	# An ISFDB that knows no ISBN at all
+	server_options = {'miss_rate': 1, 'validators': False}
+
+	def collect(self, page):
+		results = feed(page)
+		self.plugin._collect_search_results(self.log, results, [], QUERY, 10)
+
+	def test_unreadable_page_is_not_remembered(self):
+		self.collect(MAINTENANCE_PAGE)
+		self.assertFalse(self.cache.is_missing(QUERY, 60))
+
+	def test_no_records_is_remembered(self):
+		self.collect(NO_RECORDS_PAGE)
+		self.assertTrue(self.cache.is_missing(QUERY, 60))
+
+	def test_cover_of_missing_isbn(self):
+		identifiers = {'isbn': '9780000000002'}
+		self.assertRequests(1, self.identify, title='', identifiers=identifiers)
+		rq = Queue()
+		self.assertRequests(0, self.plugin.download_cover, self.log, rq, Event(),
+			identifiers=identifiers, timeout=10)
+		self.assertTrue(rq.empty())
+
+	def test_cover_lookup_remembers_miss(self):
+		# Without the miss remembered, the identify download_cover falls back
+		# to would search again
+		identifiers = {'isbn': '9780000000002'}
+		self.assertRequests(1, self.plugin.download_cover, self.log, Queue(), Event(),
+			title='', identifiers=identifiers, timeout=10)
+		self.assertRequests(0, self.identify, title='', identifiers=identifiers)
+
+if __name__ == '__main__':
+	unittest.main()
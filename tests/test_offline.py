@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, shutil, tempfile, unittest
+
+from server import FIXTURES
+
+class ParseValuesTest(unittest.TestCase):
+
+	def test_escapes(self):
+		from calibre_plugins.isfdb.offline import parse_values
+		rows = list(parse_values("(1,'O\\'Brien, it''s (odd)',NULL),(2,'a\\nb',3.5);"))
+		self.assertEqual(rows, [('1', "O'Brien, it's (odd)", None), ('2', 'a\nb', '3.5')])
+
+class OfflineIndexTest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		from calibre_plugins.isfdb.offline import build_index, OfflineIndex
+		cls.tdir = tempfile.mkdtemp(prefix='isfdb-test-')
+		path = os.path.join(cls.tdir, 'index.sqlite')
+		cls.count = build_index(os.path.join(FIXTURES, 'isfdb_backup.sql'), path)
+		cls.index = OfflineIndex(path)
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.index.conn.close()
+		shutil.rmtree(cls.tdir, ignore_errors=True)
+
+	def test_count(self):
+		self.assertEqual(self.count, 2)
+
+	def test_get(self):
+		record = self.index.get('4638')
+		self.assertEqual(record['title'], 'Black House')
+		self.assertEqual(record['authors'], ['Stephen King', 'Peter Straub'])
+		self.assertEqual(record['isbn'], '0375504397')
+		self.assertEqual(record['publisher'], 'Random House')
+		self.assertEqual(record['pubdate'], '2001-09-15')
+		# Without the credit link after the |
+		self.assertEqual(record['cover_url'], 'http://x/y.jpg')
+		self.assertEqual(self.index.get('999'), None)
+
+	def test_editors(self):
+		record = self.index.get('5')
+		self.assertEqual(record['authors'], ["O'Brien, it's (odd) (Editor)"])
+		self.assertEqual(record['cover_url'], None)
+
+	def test_find_isbn(self):
+		# Under either form of the ISBN
+		for isbn in ('0375504397', '9780375504396'):
+			self.assertEqual([r['isfdb_id'] for r in self.index.find_isbn(isbn)], ['4638'])
+		self.assertEqual(self.index.find_isbn('9780000000002'), [])
+
+	def test_search(self):
+		from calibre_plugins.isfdb.offline import search_tokens
+		records = self.index.search(search_tokens(['black', 'house']), search_tokens(['king']), 5)
+		self.assertEqual([r['isfdb_id'] for r in records], ['4638'])
+		self.assertEqual(self.index.search(search_tokens(['odd']), [], 5)[0]['isfdb_id'], '5')
+		self.assertEqual(self.index.search(search_tokens(['house']), search_tokens(['ellison']), 5), [])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+
+from base import PluginTestCase
+from server import isbn_to_pub_id
+
+ISBN = '9780345470638'
+
+BLACK_HOUSE = dict(title='Black House', authors=['Stephen King', 'Peter Straub'])
+
+class ParallelQueriesTest(PluginTestCase):
+
+	def setUp(self):
+		PluginTestCase.setUp(self)
+		import calibre_plugins.isfdb.config as cfg
+		cfg.option_overrides[cfg.KEY_PARALLEL_QUERIES] = True
+		# Keep hold of the title/author searches sent along with the ISBN one
+		self.parallel = []
+		search_ahead = self.plugin._search_ahead
+		def record(query, timeout, results):
+			future = search_ahead(query, timeout, results)
+			self.parallel.append((future, results))
+			return future
+		self.plugin._search_ahead = record
+
+	def tearDown(self):
+		# Let searches that were not waited for finish before the server goes
+		for future, results in self.parallel:
+			try:
+				future.result(10)
+			except Exception:
+				pass
+		del self.plugin._search_ahead
+		PluginTestCase.tearDown(self)
+
+	def identify_isbn(self):
+		return self.identify(identifiers={'isbn': ISBN}, **BLACK_HOUSE)
+
+	def test_isbn_miss(self):
+		self.server.miss_rate = 1
+		results = self.assertRequests(1 + 1 + 1, self.identify_isbn)
+		self.assertEqual(len(self.parallel), 1)
+		self.assertEqual(self.server.paths['/cgi-bin/se.cgi'], 1)
+		# The title/author search was sent once, and its results used
+		self.assertEqual(self.server.paths['/cgi-bin/adv_search_results.cgi'], 1)
+		self.assertEqual(len(results), 1)
+		self.assertEqual(results[0].title, 'Black House')
+		self.assertNotEqual(results[0].identifiers['isfdb'], unicode(isbn_to_pub_id(ISBN)))
+
+	def test_isbn_hit(self):
+		results = self.identify_isbn()
+		self.assertEqual(len(self.parallel), 1)
+		future, fallback = self.parallel[0]
+		# It may have been read already, but either way is not used
+		self.assertTrue(fallback.cancelled)
+		# Only the book the ISBN led to
+		self.assertEqual(len(results), 1)
+		self.assertEqual(results[0].identifiers['isfdb'], unicode(isbn_to_pub_id(ISBN)))
+
+if __name__ == '__main__':
+	unittest.main()
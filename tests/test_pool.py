@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import sys, time, unittest
+from cStringIO import StringIO
+from Queue import Queue
+from threading import Event, Thread, Timer, enumerate as threads
+
+from base import PluginTestCase
+
+class JobGroupTest(unittest.TestCase):
+
+	def setUp(self):
+		from calibre_plugins.isfdb.pool import WorkerPool
+		self.pool = WorkerPool(4, 'ISFDB test')
+		self.release = Event()
+
+	def tearDown(self):
+		self.release.set()
+		self.pool.shutdown()
+
+	def group(self, *jobs):
+		from calibre_plugins.isfdb.pool import JobGroup
+		group = JobGroup(self.pool)
+		for job in jobs:
+			group.submit(job)
+		return group
+
+	def test_finished(self):
+		start = time.time()
+		self.assertTrue(self.group(lambda: time.sleep(0.05)).wait(Event(), 10))
+		self.assertLess(time.time() - start, 0.5)
+
+	def test_abort(self):
+		from calibre_plugins.isfdb.pool import ABORT_POLL
+		abort = Event()
+		Timer(0.1, abort.set).start()
+		start = time.time()
+		self.assertFalse(self.group(lambda: self.release.wait(10)).wait(abort, 30))
+		self.assertLess(time.time() - start, 0.1 + 2 * ABORT_POLL + 0.2)
+
+	def test_waits_in_caller(self):
+		# Waiting takes no thread besides the caller's
+		before = set(threads())
+		seen = []
+		def job():
+			time.sleep(0.1)
+			seen.extend(t for t in threads() if t not in before and t not in self.pool.threads)
+		self.assertTrue(self.group(job).wait(Event(), 10))
+		self.assertEqual(seen, [])
+
+	def test_timeout(self):
+		start = time.time()
+		self.assertFalse(self.group(lambda: self.release.wait(10)).wait(Event(), 0.3))
+		self.assertLess(time.time() - start, 1)
+
+class WorkerPoolTest(unittest.TestCase):
+
+	def test_failed_job_is_reported(self):
+		from calibre_plugins.isfdb.pool import WorkerPool
+		pool = WorkerPool(1, 'ISFDB test')
+		ran = Event()
+		def fail():
+			raise ValueError('bad job')
+		stderr, sys.stderr = sys.stderr, StringIO()
+		try:
+			pool.submit(fail)
+			# The same thread goes on to the next job
+			pool.submit(ran.set)
+			self.assertTrue(ran.wait(5))
+			output = sys.stderr.getvalue()
+		finally:
+			sys.stderr = stderr
+			pool.shutdown()
+		self.assertIn('ValueError: bad job', output)
+
+class SingleFlightTest(unittest.TestCase):
+
+	def test_shared_call(self):
+		from calibre_plugins.isfdb.pool import SingleFlight
+		flights, release, calls, results = SingleFlight(), Event(), [], []
+		def call():
+			calls.append(1)
+			release.wait(10)
+			return 'result'
+		threads = [Thread(target=lambda: results.append(flights.do('key', call))) for i in range(2)]
+		for t in threads:
+			t.start()
+		time.sleep(0.1)
+		release.set()
+		for t in threads:
+			t.join(10)
+		self.assertEqual((calls, results), ([1], ['result', 'result']))
+		# Done calls are not remembered
+		self.assertEqual(flights.do('key', lambda: 'again'), 'again')
+
+class SharedDetailsTest(PluginTestCase):
+
+	# Long enough for the second lookup to start while the first waits
+	server_options = {'latency': 300}
+
+	def test_same_url(self):
+		from calibre_plugins.isfdb.worker import Worker
+		url = '%s/cgi-bin/pl.cgi?4638' % self.server.base_url
+		queues = [Queue(), Queue()]
+		workers = [Worker(url, rq, self.log, 0, self.plugin) for rq in queues]
+		threads = [Thread(target=w.run) for w in workers]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join(10)
+		self.assertEqual(self.server.paths['/cgi-bin/pl.cgi'], 1)
+		titles = [rq.get_nowait().title for rq in queues]
+		self.assertEqual(titles, ['Black House', 'Black House'])
+		self.assertEqual([w.isfdb_id for w in workers], ['4638', '4638'])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import io, os, unittest
+
+from base import PluginTestCase
+
+class PrewarmTest(PluginTestCase):
+
+	server_options = {'validators': False}
+
+	def prewarm(self, lines):
+		from calibre_plugins.isfdb.prewarm import prewarm, read_items
+		return prewarm(self.plugin, self.log, read_items(lines),
+			state_path=os.path.join(self.tdir, 'books.txt.done'), timeout=10)
+
+	def test_identify_after_prewarm_is_cached(self):
+		found, not_found, skipped = self.prewarm(['isbn:9780375504396', 'isfdb:4638'])
+		self.assertEqual((found, not_found, skipped), (2, 0, 0))
+		for identifiers in ({'isbn': '9780375504396'}, {'isfdb': '4638'}):
+			results = self.assertRequests(0, self.identify, title='Black House',
+				authors=['Stephen King', 'Peter Straub'], identifiers=identifiers)
+			self.assertEqual(len(results), 1)
+
+	def test_resume(self):
+		self.prewarm(['isbn:9780375504396'])
+		with io.open(os.path.join(self.tdir, 'books.txt.done'), encoding='utf-8') as f:
+			self.assertEqual(f.read().split(), ['isbn:9780375504396'])
+		found, not_found, skipped = self.assertRequests(0, self.prewarm, ['isbn:9780375504396'])
+		self.assertEqual((found, not_found, skipped), (0, 0, 1))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+
+from base import PluginTestCase
+
+class Clock(object):
+
+	'''
+	Time that only passes when told to.
+	'''
+
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+	def advance(self, seconds):
+		self.now += seconds
+
+class RateLimiterTest(unittest.TestCase):
+
+	def setUp(self):
+		from calibre_plugins.isfdb.ratelimit import RateLimiter
+		self.clock = Clock()
+		self.limiter = RateLimiter(4, clock=self.clock)
+
+	def test_refill(self):
+		limiter = self.limiter
+		self.assertEqual(limiter.try_acquire(), 0)
+		self.assertAlmostEqual(limiter.try_acquire(), 0.25)
+		self.clock.advance(0.25)
+		self.assertEqual(limiter.try_acquire(), 0)
+		# A quiet spell allows a burst of one second's worth, no more
+		self.clock.advance(60)
+		for i in range(4):
+			self.assertEqual(limiter.try_acquire(), 0)
+		self.assertAlmostEqual(limiter.try_acquire(), 0.25)
+
+	def test_failure_halves_rate(self):
+		limiter = self.limiter
+		limiter.failure()
+		self.assertEqual(limiter.rate, 2)
+		# Everyone waits out the pause
+		self.assertAlmostEqual(limiter.try_acquire(), 0.5)
+		limiter.failure()
+		self.assertEqual(limiter.rate, 1)
+		for i in range(10):
+			limiter.failure()
+		self.assertEqual(limiter.rate, limiter.min_rate)
+
+	def test_retry_after(self):
+		self.limiter.failure(retry_after=30)
+		self.assertAlmostEqual(self.limiter.try_acquire(), 30)
+		self.clock.advance(30)
+		self.assertEqual(self.limiter.try_acquire(), 0)
+
+	def test_success_recovers_rate(self):
+		limiter = self.limiter
+		limiter.failure()
+		limiter.failure()
+		limiter.success()
+		self.assertAlmostEqual(limiter.rate, 1.4)
+		for i in range(10):
+			limiter.success()
+		self.assertEqual(limiter.rate, 4)
+
+	def test_set_max_rate(self):
+		self.limiter.failure()
+		self.limiter.set_max_rate(10)
+		self.assertEqual((self.limiter.max_rate, self.limiter.rate), (10, 10))
+
+class SharedLimiterTest(PluginTestCase):
+
+	def test_apply_options(self):
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.ratelimit import get_limiter
+		from calibre_plugins.isfdb.engine import get_loop
+		prefs = dict(cfg.DEFAULT_STORE_VALUES)
+		prefs[cfg.KEY_REQUESTS_PER_SECOND] = 5.0
+		cfg.apply_options(prefs)
+		self.assertEqual(get_limiter().max_rate, 5)
+		self.assertEqual(get_loop().max_per_host, prefs[cfg.KEY_EVENT_LOOP_CONNECTIONS])
+
+	def test_shared_by_plugins(self):
+		from calibre_plugins.isfdb.ratelimit import get_limiter
+		other = type(self.plugin)(None)
+		try:
+			self.assertIs(other.session.limiter, get_limiter())
+			self.assertIs(self.plugin.session.limiter, get_limiter())
+			# Throttled for one is throttled for both
+			other.session.limiter.failure()
+			self.assertEqual(self.plugin.session.limiter.rate, 5000)
+		finally:
+			other.session.close()
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+from Queue import Queue
+
+from base import PluginTestCase
+
+class RevalidateTest(PluginTestCase):
+
+	def setUp(self):
+		PluginTestCase.setUp(self)
+		self.url = self.plugin._details_url('4638', False)
+
+	def worker(self):
+		from calibre_plugins.isfdb.worker import Worker
+		worker = Worker(self.url, Queue(), self.log, 0, self.plugin)
+		self.parsed = 0
+		parse_details = worker.parse_details
+		def counting_parse(root):
+			self.parsed += 1
+			return parse_details(root)
+		worker.parse_details = counting_parse
+		return worker
+
+	def test_not_modified(self):
+		from calibre_plugins.isfdb.stats import stats
+		first = self.assertRequests(1, self.worker().load)
+		self.assertIsNotNone(self.cache.get_validators(self.url))
+		stats.reset()
+		worker = self.worker()
+		# A 304, and the records come from the cache without being parsed
+		records = self.assertRequests(1, worker.load)
+		self.assertTrue(worker.not_modified)
+		self.assertEqual(self.parsed, 0)
+		self.assertEqual([r['title'] for r in records], [r['title'] for r in first])
+		self.assertEqual(stats.snapshot()['counters'].get('not_modified'), 1)
+
+	def test_evicted(self):
+		self.assertRequests(1, self.worker().load)
+		with self.cache.lock:
+			with self.cache.conn:
+				self.cache.conn.execute('DELETE FROM publications')
+		self.cache.recent.clear()
+		worker = self.worker()
+		# The 304, then the page again without conditions
+		records = self.assertRequests(2, worker.load)
+		self.assertFalse(worker.not_modified)
+		self.assertEqual(self.parsed, 1)
+		self.assertEqual(records[0]['isfdb_id'], '4638')
+		self.assertIsNotNone(self.cache.get('4638', 60))
+
+	def test_headers(self):
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.worker import revalidation_headers
+		self.assertIsNone(revalidation_headers(self.cache, self.url))
+		self.worker().load()
+		headers = revalidation_headers(self.cache, self.url)
+		self.assertIn('If-None-Match', headers)
+		self.assertIn('If-Modified-Since', headers)
+		# Nothing is conditional with the cache turned off
+		for ttl in (0, -1):
+			cfg.option_overrides[cfg.KEY_CACHE_TTL] = ttl
+			self.assertIsNone(revalidation_headers(self.cache, self.url))
+
+if __name__ == '__main__':
+	unittest.main()
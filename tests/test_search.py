@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+
+from base import PluginTestCase
+from server import load_fixture
+
+class SearchResultsTest(unittest.TestCase):
+
+	def feed(self, max_results):
+		'''
+		Feed the search results fixture the way a download arrives. Returns
+		the SearchResults and how many chunks it read.
+		'''
+		from calibre_plugins.isfdb.parse import SearchResults
+		page = load_fixture('adv_search_results.html')
+		results = SearchResults(['black', 'house'], ['king', 'straub'], max_results)
+		chunks = 0
+		for i in range(0, len(page), 4096):
+			chunks += 1
+			if results.feed(page[i:i + 4096]):
+				break
+		results.close()
+		return results, chunks
+
+	def test_whole_page(self):
+		results, chunks = self.feed(1000)
+		self.assertEqual(results.rows, 20)
+		self.assertEqual(len(results.candidates), 20)
+
+	def test_stops_early(self):
+		# Rows with the exact title and both authors are good enough to stop
+		# at, verified or not
+		from calibre_plugins.isfdb.rank import GOOD_SCORE, PERFECT_SCORE
+		results, chunks = self.feed(5)
+		self.assertEqual(chunks, 1)
+		self.assertLess(results.rows, 20)
+		self.assertEqual(len(results.matches()), 5)
+		self.assertTrue(all(GOOD_SCORE <= score < PERFECT_SCORE for score, url in results.candidates[:5]))
+
+	def test_good_score(self):
+		from calibre_plugins.isfdb.rank import Query, GOOD_SCORE
+		query = Query(['black', 'house'], ['king', 'straub'])
+		score = lambda title, authors: query.score(title, authors, date='', isbn='', format='', type_='', verified=False)
+		self.assertGreaterEqual(score('black house', 'stephen king peter straub'), GOOD_SCORE)
+		self.assertLess(score('black house', 'stephen king'), GOOD_SCORE)
+		self.assertLess(score('the black house', 'stephen king peter straub'), GOOD_SCORE)
+
+class PaginationTest(PluginTestCase):
+
+	SEARCHES = '/cgi-bin/adv_search_results.cgi'
+
+	def search(self, rows, max_results):
+		'''
+		Search for a book with rows results in all, returning the first page
+		as read before paging and the matches.
+		'''
+		import calibre_plugins.isfdb.config as cfg
+		from calibre_plugins.isfdb.stats import stats
+		self.server.search_rows = rows
+		cfg.option_overrides[cfg.KEY_MAX_DOWNLOADS] = max_results
+		stats.reset()
+		title, authors = 'Black House', ['Stephen King']
+		query = self.plugin.create_query(self.log, title=title, authors=authors)
+		results = self.plugin._search_results(self.log, title, authors, 10)
+		self.plugin._search(query, 10, results)
+		first = results.next_page
+		matches = []
+		self.plugin._collect_search_results(self.log, results, matches, query, 10)
+		# Let cancelled pages finish before the server goes away
+		page = results
+		while page.next_page is not None:
+			page = page.next_page
+			page.download.result(10)
+		return first, matches
+
+	def cancelled(self):
+		from calibre_plugins.isfdb.stats import stats
+		return stats.snapshot()['counters'].get('search_pages_cancelled', 0)
+
+	def test_pages(self):
+		from calibre_plugins.isfdb.parse import SEARCH_PAGE_SIZE
+		first, matches = self.search(2 * SEARCH_PAGE_SIZE + 20, 1000)
+		# The second page was on its way before the first was done
+		self.assertIsNotNone(first)
+		self.assertEqual(self.server.paths[self.SEARCHES], 3)
+		self.assertEqual(self.cancelled(), 0)
+		self.assertTrue(any(url.endswith('?%d' % (1000000 + 2 * SEARCH_PAGE_SIZE)) for url in matches))
+
+	def test_max_pages(self):
+		from calibre_plugins.isfdb.parse import SEARCH_PAGE_SIZE, MAX_SEARCH_PAGES
+		self.search(10 * SEARCH_PAGE_SIZE, 1000)
+		self.assertEqual(self.server.paths[self.SEARCHES], MAX_SEARCH_PAGES)
+
+	def test_early_stop(self):
+		from calibre_plugins.isfdb.parse import SEARCH_PAGE_SIZE
+		first, matches = self.search(10 * SEARCH_PAGE_SIZE, 5)
+		self.assertIsNone(first)
+		self.assertEqual(len(matches), 5)
+		self.assertEqual(self.server.paths[self.SEARCHES], 1)
+
+	def test_last_page_cancels_prefetch(self):
+		# The second page looks full half way through, but is the last one
+		from calibre_plugins.isfdb.parse import SEARCH_PAGE_SIZE, LIKELY_FULL_ROWS
+		self.search(SEARCH_PAGE_SIZE + LIKELY_FULL_ROWS + 10, 1000)
+		self.assertEqual(self.cancelled(), 1)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+from Queue import Queue
+from threading import Event
+
+from base import PluginTestCase
+
+class ListLog(object):
+
+	def __init__(self):
+		self.lines = []
+
+	def info(self, *args):
+		self.lines.append(' '.join('%s' % a for a in args))
+
+	error = exception = warn = __call__ = info
+
+	def summaries(self):
+		return sum(1 for line in self.lines if line.startswith('ISFDB stats over'))
+
+class IdentifySummaryTest(PluginTestCase):
+
+	def setUp(self):
+		PluginTestCase.setUp(self)
+		from calibre_plugins.isfdb.stats import stats
+		stats.reset()
+
+	def identify_logged(self):
+		log = ListLog()
+		self.plugin.identify(log, Queue(), Event(), title='', identifiers={'isbn': '9780345470638'}, timeout=10)
+		return log
+
+	def test_summary_in_identify_log(self):
+		import calibre_plugins.isfdb as isfdb
+		log = self.identify_logged()
+		self.assertEqual(log.summaries(), 1)
+		self.assertTrue(any(line.strip().startswith('identify ') for line in log.lines))
+		# Then only every STATS_LOG_INTERVAL calls
+		for i in range(1, isfdb.STATS_LOG_INTERVAL):
+			self.assertEqual(self.identify_logged().summaries(), 0)
+		self.assertEqual(self.identify_logged().summaries(), 1)
+
+if __name__ == '__main__':
+	unittest.main()
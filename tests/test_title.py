@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+
+from base import PluginTestCase
+from server import load_fixture
+
+class ParseTitleRecordTest(unittest.TestCase):
+
+	def test_title_fixture(self):
+		from calibre_plugins.isfdb.parse import page_to_tree
+		from calibre_plugins.isfdb.worker import parse_title_record
+		work = parse_title_record(page_to_tree(load_fixture('title.html')))
+		self.assertEqual(work, {
+			'series': 'The Talisman',
+			'series_index': 2.0,
+			# Not the link for adding tags
+			'tags': ['horror', 'dark fantasy', 'serial killer'],
+		})
+
+	def test_no_work_data(self):
+		from calibre_plugins.isfdb.parse import page_to_tree
+		from calibre_plugins.isfdb.worker import parse_title_record
+		work = parse_title_record(page_to_tree(load_fixture('pl.html')))
+		self.assertEqual(work, {'series': None, 'series_index': None, 'tags': []})
+
+class TitleDetailsTest(PluginTestCase):
+
+	def test_touched_fields(self):
+		import calibre_plugins.isfdb.config as cfg
+		self.assertNotIn('series', self.plugin.touched_fields)
+		self.assertNotIn('tags', self.plugin.touched_fields)
+		cfg.option_overrides[cfg.KEY_TITLE_DETAILS] = True
+		self.assertIn('series', self.plugin.touched_fields)
+		self.assertIn('tags', self.plugin.touched_fields)
+
+	def test_identify(self):
+		import calibre_plugins.isfdb.config as cfg
+		cfg.option_overrides[cfg.KEY_TITLE_DETAILS] = True
+		results = self.identify(title='', identifiers={'isbn': '9780345470638'})
+		self.assertEqual((results[0].series, results[0].series_index), ('The Talisman', 2.0))
+		self.assertEqual(results[0].tags, ['horror', 'dark fantasy', 'serial killer'])
+		self.assertEqual(self.server.paths['/cgi-bin/title.cgi'], 1)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+						print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2015, Xtina Schelin <xtina.schelin@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+
+from base import PluginTestCase
+from server import load_fixture
+
+ANTHOLOGY = b'''<?xml version="1.0" encoding="iso-8859-1" ?>
+<ISFDB>
+  <Records>2</Records>
+  <Publications>
+    <Publication>
+      <Record>300</Record>
+      <Title>Dangerous Visions</Title>
+      <Authors><Author>Harlan Ellison</Author></Authors>
+      <Year>1967-10-00</Year>
+      <Type>ANTHOLOGY</Type>
+      <Contents>
+        <Content><cTitle>Evensong</cTitle><cAuthor>Lester del Rey</cAuthor></Content>
+        <Content><cTitle>Flies</cTitle><cAuthor>Robert Silverberg</cAuthor></Content>
+      </Contents>
+    </Publication>
+    <Publication>
+      <Record>301</Record>
+      <Title>No authors</Title>
+    </Publication>
+  </Publications>
+</ISFDB>'''
+
+class ParsePublicationsTest(unittest.TestCase):
+
+	def test_getpub_fixture(self):
+		from calibre_plugins.isfdb.xmlapi import parse_publications
+		records = list(parse_publications(load_fixture('getpub.xml')))
+		self.assertEqual(len(records), 1)
+		record = records[0]
+		self.assertEqual(record['isfdb_id'], '4638')
+		self.assertEqual(record['title'], 'Black House')
+		self.assertEqual(record['authors'], ['Stephen King', 'Peter Straub'])
+		self.assertEqual(record['isbn'], '034547063X')
+		self.assertEqual(record['publisher'], 'Ballantine Books')
+		self.assertEqual(record['pubdate'], '2002-09-00')
+		self.assertEqual(record['cover_url'], 'http://images.amazon.com/images/P/034547063X.01.LZZZZZZZ.jpg')
+		self.assertEqual(record['comments'], None)
+
+	def test_metadata(self):
+		from calibre_plugins.isfdb.xmlapi import parse_publications
+		from calibre_plugins.isfdb.worker import record_to_metadata
+		mi = record_to_metadata(next(parse_publications(load_fixture('getpub.xml'))))
+		self.assertEqual(mi.identifiers, {'isfdb': '4638'})
+		self.assertEqual(mi.isbn, '034547063X')
+		self.assertEqual((mi.pubdate.year, mi.pubdate.month, mi.pubdate.day), (2002, 9, 1))
+		self.assertTrue(mi.has_cover)
+
+	def test_editors_and_contents(self):
+		from calibre_plugins.isfdb.xmlapi import parse_publications
+		records = list(parse_publications(ANTHOLOGY))
+		# The publication without authors is left out
+		self.assertEqual([r['isfdb_id'] for r in records], ['300'])
+		self.assertEqual(records[0]['authors'], ['Harlan Ellison (Editor)'])
+		self.assertIn('<li>Evensong by Lester del Rey</li>', records[0]['comments'])
+		self.assertIn('<li>Flies by Robert Silverberg</li>', records[0]['comments'])
+
+class XMLBackendTest(PluginTestCase):
+
+	def setUp(self):
+		PluginTestCase.setUp(self)
+		import calibre_plugins.isfdb.config as cfg
+		cfg.option_overrides[cfg.KEY_BACKEND] = cfg.BACKEND_XML
+
+	def test_identify_isbn(self):
+		# One getpub.cgi request, with no search or redirect first
+		results = self.assertRequests(1, self.identify, title='Black House',
+			authors=['Stephen King', 'Peter Straub'], identifiers={'isbn': '9780345470638'})
+		self.assertEqual(len(results), 1)
+		self.assertEqual(results[0].identifiers, {'isfdb': '4638'})
+		self.assertEqual(results[0].publisher, 'Ballantine Books')
+
+class XMLMissTest(PluginTestCase):
+
+	# An ISFDB that knows no ISBN at all
+	server_options = {'miss_rate': 1, 'validators': False}
+
+	def setUp(self):
+		PluginTestCase.setUp(self)
+		import calibre_plugins.isfdb.config as cfg
+		cfg.option_overrides[cfg.KEY_BACKEND] = cfg.BACKEND_XML
+
+	def test_isbn_only(self):
+		# As prewarm asks, with nothing to fall back to
+		identifiers = {'isbn': '9780000000002'}
+		self.assertEqual(self.assertRequests(1, self.identify, title='', identifiers=identifiers), [])
+		# Remembered as missing
+		self.assertEqual(self.assertRequests(0, self.identify, title='', identifiers=identifiers), [])
+
+	def test_title_only(self):
+		results = self.identify(title='Black House', identifiers={'isbn': '9780000000002'})
+		self.assertEqual(results, [])
+
+if __name__ == '__main__':
+	unittest.main()